@@ -30,9 +30,10 @@ logger.info("Flask app created; module imported,App_safe")
 
 # Flask app
 app = Flask(__name__)
-import os, psutil, threading, time, logging
+import os, threading, time, logging
 
 def log_mem():
+    import psutil  # only needed by this thread; kept off the import path
     while True:
         mem = psutil.Process(os.getpid()).memory_info().rss / 1024**2
         logger.info(f"[MEMORY USAGE] {mem:.2f} MB")
@@ -45,18 +46,57 @@ logger.info("✅ Memory monitor thread started")
 def healthz():
     return "ok", 200
 
+
+@app.get("/metrics/llm")
+def metrics_llm():
+    """Per-process LLM token / latency / cost counters and router health."""
+    import llm_metrics
+    import outbox
+    import retry_scheduler
+    from deepseek_client import LLM_ROUTER
+    return jsonify({**llm_metrics.snapshot(), "providers": LLM_ROUTER.snapshot(), "outbox": outbox.stats(),
+                    "retries": retry_scheduler.stats()}), 200
+
+
+@app.get("/warmup")
+def warmup():
+    """
+    Startup-probe hook: import the SDKs, parse the discovery documents, build the
+    API clients, refresh credentials and load state before the first real push.
+    Best effort: always 200, failed steps are reported in the body.
+    """
+    import lazy_imports
+    import google_clients
+    timings = {}
+
+    def step(name, fn):
+        start = time.perf_counter()
+        try:
+            fn()
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+        except Exception as e:
+            logger.warning(f"[WARMUP] {name} failed: {e}")
+            timings[name] = f"failed: {e}"
+
+    step("imports", lambda: lazy_imports.preload(background=False))
+    step("discovery", google_clients.load_all)
+    step("credentials", gmail_utils.get_credentials)
+    step("clients", lambda: [google_clients.build_service(api, version, gmail_utils.get_credentials())
+                             for api, version in google_clients.APIS])
+    step("state", lambda: (load_last_state(), load_processed_ids()))
+    ok = all(not isinstance(v, str) for v in timings.values())
+    logger.info(f"[WARMUP] {'done' if ok else 'degraded'} {timings}")
+    return jsonify({"status": "ok" if ok else "degraded", "timings_ms": timings}), 200
+
 import json
 import base64, time, os, json
 import time
-import googleapiclient.errors
 from datetime import datetime
 from typing import Optional, Dict, Any, List
 from calendar_utils import create_calendar_event, send_meeting_invite
 
 
 import requests
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from email.mime.text import MIMEText
 from time_parser import get_sender_timezone,parse_human_time
 from gmail_utils import (
@@ -66,17 +106,24 @@ from gmail_utils import (
     )
 from state_manager_bucket import (
     update_last_history_file,
-    ensure_failed_file_exists,
     load_last_state,
     save_last_state,
     load_processed_ids,
-    save_processed_ids
+    save_processed_ids,
+    is_processed,
+    mark_processed,
+    refresh_processed_ids
     )
 
     
 
 import gmail_utils
 from message_handle import process_single_message
+from calendar_batch import CalendarBatch
+from state_session import StateSession
+import failure_journal
+import retry_scheduler
+from state_manager_bucket import latest_history_state
 
 
 # --- logging setup (module-level) -------------------------------------------
@@ -157,9 +204,6 @@ DEFAULT_TZ = os.getenv("DEFAULT_TZ", "Asia/Shanghai")
 
 from datetime import datetime, timedelta
 import re
-import pytz
-import dateparser
-from dateutil import tz as dateutil_tz
 from email.utils import parsedate_tz
 
 logger = logging.getLogger(__name__)
@@ -245,6 +289,27 @@ def is_system_or_notification_email(msg: dict, my_email: str) -> bool:
     return False
 
 
+def _mark_done(done_ids, internal_dates) -> None:
+    """Record the run's processed ids (new and retried) in one save."""
+    try:
+        mark_processed(done_ids, internal_dates)
+    except Exception as e:
+        logger.warning(f"Failed to record processed ids: {e}")
+
+
+def _set_latest_history(session, service) -> None:
+    """Record the mailbox's current historyId in the run's state session."""
+    try:
+        history = latest_history_state(service)
+        if history:
+            session.set("history", history)
+            logger.info(f"✅ last_history_id -> {history['last_history_id']}")
+        else:
+            logger.warning("Failed to get latest historyId, skip update.")
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to update last_history_id.json: {e}")
+
+
 # -------------------------
 # Main work flow. Fetch the newest email from last time. Call LLM to check the intention and time of meeting.send reply to attendees. 
 # -------------------------
@@ -273,62 +338,62 @@ def gmail_webhook():
 
         logger.info(f"intializing logger, LOG_LEVEL={logging.getLevelName(logger.level)}")
 
-    if LLM_PROVIDER == "GEMINI":
-        if GEMINI_API_KEY == None:
-            logger.error("GEMINI_API_KEY not set")
-            return ("", 204)
-            #return  jsonify({"status": "no_messages"}),204 #return unfer webhook mode
-            #return
-    else:
-        if DEEPSEEK_API_KEY == None:
-                logger.warning("DEEPSEEK_API_KEY not set, using GEMINI as LLM provider")
-                return ("", 204)
-                #return  jsonify({"status": "no_messages"}),204  # return unfer webhook mode
-                #return#
+    # The LLM router fails over between providers, so only bail out if none is configured.
+    if GEMINI_API_KEY == None and DEEPSEEK_API_KEY == None:
+        logger.error("Neither GEMINI_API_KEY nor DEEPSEEK_API_KEY is set")
+        return ("", 204)
+    if LLM_PROVIDER == "GEMINI" and GEMINI_API_KEY == None:
+        logger.warning("GEMINI_API_KEY not set, routing LLM calls to DEEPSEEK")
+    elif LLM_PROVIDER != "GEMINI" and DEEPSEEK_API_KEY == None:
+        logger.warning("DEEPSEEK_API_KEY not set, routing LLM calls to GEMINI")
 
 
-    
 
+    # All state documents are read once here and written once at the end (state_session.py)
+    session = None
     try:
         logger.info("📩 get trigger from webhook")
         service,creds = get_gmail_service()
-        state = load_last_state()
+        refresh_processed_ids()  # what other instances wrote since this one loaded it (before the session reads it)
+        session = StateSession().load()
+        state = session.get("history", {})
+        if not isinstance(state, dict) or not state.get("last_history_id"):
+            state = {}
         last_hid = state.get("last_history_id")
         last_date = state.get("updated_at")
         msg_objs = []
-        # Exctract the failed ids and retry. 
-        failed_data=ensure_failed_file_exists(service)
-        if failed_data == "Error":
-            SystemExit()
+        # Retry the failed ids whose backoff has expired (retry_scheduler.py)
+        failed_data = retry_scheduler.due()
         retry_failed = [] # The list for saving the failed ids after retrying.
+        done_ids = []  # processed this run (retried and new), saved once by _mark_done
+        internal_dates = {}
         if failed_data:
-            logger.info(f"🔄 Retrying {len(failed_data)} previously failed messages.")
-            try:
-                for item in failed_data:
-                    msg_id = None
-                    msg_id=item["msg_id"]
+            logger.info(f"🔄 Retrying {len(failed_data)} previously failed messages that are due.")
+            for item in failed_data:
+                msg_id = item["msg_id"]
+                try:
                     # Fetch the message by ID
                     msg_obj = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
                     logger.info(f"📧 Processing msg_id={msg_id}")
 
-            # Process the message
-                    success = process_single_message(msg_obj, service,MY_EMAIL,creds)
+                    # Process the message
+                    result = process_single_message(msg_obj, service,MY_EMAIL,creds)
 
-                    if not success:
+                    if result.get("status") == "error":
                         logger.warning(f"⚠️ Failed to process msg_id={msg_id}")
-                        retry_failed.append(msg_id)
+                        retry_failed.append({"msg_id": msg_id, "reason": result.get("reason", "unknown_error")})
+                        retry_scheduler.failed(msg_id, result.get("reason", "unknown_error"), item.get("attempts", 0))
                     else:
                         mark_email_as_processed(service, msg_id,label_name=None, also_mark_read=True)
-                        
-            except Exception as e:
-                    logger.error(f"❌ Failed to process msg_id={msg_id} :{e}")
-                    retry_failed.append(msg_id)
+                        retry_scheduler.succeeded(msg_id)
+                        done_ids.append(msg_id)
+                        internal_dates[msg_id] = msg_obj.get("internalDate")
 
-    # Update the failed file with remaining failed ids
-            with open(FAILED_FILE, "w") as f:
-                json.dump(retry_failed, f, indent=2, ensure_ascii=False)
-        logger.info(f"✅ Retry done：Sucess {len(failed_data) - len(retry_failed)}，Failed {len(retry_failed)}")
-        state = load_last_state()
+                except Exception as e:
+                    logger.error(f"❌ Failed to process msg_id={msg_id} :{e}")
+                    retry_failed.append({"msg_id": msg_id, "reason": f"retry: {e}"})
+                    retry_scheduler.failed(msg_id, f"retry: {e}", item.get("attempts", 0))
+            logger.info(f"✅ Retry done：Sucess {len(failed_data) - len(retry_failed)}，Failed {len(retry_failed)}")
 
         if not state:
             # Failed to load last_state.json, probably the first time running.get the latest messages recent 30 days.
@@ -353,11 +418,8 @@ def gmail_webhook():
 
         if not msg_objs:
             logger.info("No new messages found.")
-            try:
-                update_last_history_file(service)
-                logger.info("✅ Updated last_history_id.json to the latest historyId.")
-            except Exception as e:
-                logger.warning(f"⚠️ Failed to update last_history_id.json: {e}")
+            _mark_done(done_ids, internal_dates)
+            _set_latest_history(session, service)
 
 
             return ("", 204)
@@ -367,40 +429,73 @@ def gmail_webhook():
         # === process messages ===
         last_msg_time = None    
         failed_list = [] 
+        # Batch mode: confirmed meetings are queued and inserted in one Calendar batch after the loop
+        calendar_batch = CalendarBatch(creds) if config.CALENDAR_BATCH else None
+        results = []
         for msg in msg_objs:
             msg_id = msg.get("id")
+            if is_processed(msg_id):
+                logger.info(f"⏭️ Skip already processed msg_id={msg_id}")
+                continue
+            internal_dates[msg_id] = msg.get("internalDate")
             if is_system_or_notification_email(msg, MY_EMAIL):#Filter the  Automated Emails
                 logger.info(f"⏭️ Skip system/notification email msg_id={msg_id}")
                 continue
-            result=process_single_message(msg, service,MY_EMAIL,creds)
+            result=process_single_message(msg, service,MY_EMAIL,creds,calendar_batch=calendar_batch)
+            if result.get("status") != "queued":
+                results.append(result)
+            # End of for loop
+        if calendar_batch is not None:
+            results.extend(calendar_batch.flush().values())
+        known_failures = None  # attempts so far, loaded once on the first failure
+        for result in results:
             if result.get("status") == "error":
                 failed_list.append({
                     "msg_id": result.get("msg_id"),
                     "reason": result.get("reason", "unknown_error"),
                 })
+                if known_failures is None:
+                    try:
+                        known_failures = failure_journal.load()
+                    except Exception as e:
+                        logger.warning(f"Failed to load failure records: {e}")
+                        known_failures = {}
+                attempts = (known_failures.get(result.get("msg_id")) or {}).get("attempts", 0)
+                retry_scheduler.failed(result.get("msg_id"), result.get("reason", "unknown_error"), attempts)
             else:
-                mark_email_as_processed(service, msg_id,label_name=None, also_mark_read=True)
-            # End of for loop
+                mark_email_as_processed(service, result.get("msg_id"),label_name=None, also_mark_read=True)
+        done_ids += [r.get("msg_id") for r in results if r.get("status") != "error" and r.get("msg_id")]
+        _mark_done(done_ids, internal_dates)
         # === Update last_history_id.json ===
         if failed_list:
-            try:
-                all_failed = {item["msg_id"]: item for item in retry_failed + failed_list}
-                merged_results = list(all_failed.values())
-                # Write to failed_ids.json
-                write_json(FAILED_FILE, merged_results)
-#                with open(FAILED_FILE, "w", encoding="utf-8") as f:
-#                    json.dump(merged_results, f, ensure_ascii=False, indent=2)
-                logger.warning(f"⚠️ There are {len(failed_list)} messages failed,Wrote failed_ids.json {FAILED_FILE}")
-            except Exception as e:
-                logger.error(f"❌ Failed to write failed_ids.json: {e}")
+            # Each failure was appended to the failure journal as it happened (failure_journal.py)
+            logger.warning(f"⚠️ There are {len(failed_list)} messages failed, recorded in the failure journal")
         else:
             logger.info("✅ All messages processed successfully.")
 
-        update_last_history_file(service)
+        _set_latest_history(session, service)
         return ("", 204)
     except Exception as e:
         logger.exception("Webhook processing failed due to an exception")
         return ("", 204)
+    finally:
+        failure_journal.maybe_compact()
+        if session is not None:
+            try:
+                session.flush()
+            except Exception as e:
+                logger.error(f"❌ Failed to write state: {e}")
+        if config.STATE_BACKEND == "sqlite":
+            # Changes of this run (processed ids, failures, history) -> GCS snapshot
+            import state_sqlite
+            state_sqlite.maybe_snapshot()
+        if config.MAIL_OUTBOX:
+            # Store the run's queued replies in one write; the worker sends them after the response
+            import outbox
+            try:
+                outbox.flush()
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to store queued mails (the worker retries): {e}")
         #return jsonify({"error": str(e)}), 200  # return unfer webhook mode
         #return
 
@@ -425,6 +520,22 @@ Its only role is to trigger the execution of the existing logic; it does not per
         return ("", 204)
 
 """
+# -------------------------
+# Heavy SDKs (genai, dateparser, googleapiclient, bs4, pytz) are imported on first use
+# (lazy_imports); load them in the background now that the app can take requests.
+# -------------------------
+if config.LAZY_PRELOAD:
+    import lazy_imports
+    lazy_imports.preload()
+if config.MAIL_OUTBOX:
+    # Deliver mails left queued by a previous instance
+    import outbox
+    outbox.start_worker()
+if config.STATE_BACKEND == "sqlite":
+    # Last snapshot when Cloud Run stops the instance
+    import state_sqlite
+    state_sqlite.snapshot_on_sigterm()
+
 # -------------------------
 # Run the app
 # -------------------------
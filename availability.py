@@ -0,0 +1,161 @@
+"""
+Owner availability from Calendar freebusy, cached over a rolling window.
+
+One freebusy query covers [now, now + AVAILABILITY_WINDOW_DAYS]. The busy
+intervals are kept merged and sorted by start, so a conflict check for a
+candidate time is a bisect, answered locally:
+
+  - candidate inside the window and the data younger than AVAILABILITY_TTL_S
+      -> no API call
+  - candidate past the window end -> only the missing tail is queried
+  - data older than the TTL       -> the window is queried again
+  - events this app creates are added to the index as they are created
+
+If freebusy fails the check is skipped (treated as free) rather than blocking
+the booking.
+"""
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+import config_bucket as config
+import llm_metrics
+from google_clients import calendar_client
+from logger_config import logger
+
+Interval = Tuple[float, float]  # (start, end) epoch seconds
+
+EVENT_DURATION = timedelta(hours=1)  # same as calendar_utils.prepare_calendar_event
+
+
+def _ts(value: str) -> float:
+    """RFC3339 from the Calendar API ('...Z' or with offset) -> epoch seconds."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def _rfc3339(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class BusyIndex:
+    """Sorted, non-overlapping busy intervals."""
+
+    def __init__(self):
+        self._starts: List[float] = []
+        self._ends: List[float] = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def add(self, start: float, end: float) -> None:
+        if end <= start:
+            return
+        # Absorb every interval that overlaps or touches [start, end]
+        lo = bisect.bisect_left(self._ends, start)
+        hi = bisect.bisect_right(self._starts, end)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def overlapping(self, start: float, end: float) -> List[Interval]:
+        lo = bisect.bisect_right(self._ends, start)
+        hi = bisect.bisect_left(self._starts, end)
+        return list(zip(self._starts[lo:hi], self._ends[lo:hi]))
+
+    def drop_range(self, start: float, end: float) -> None:
+        """Forget everything inside [start, end] (before re-querying it)."""
+        kept = [(s, e) for s, e in zip(self._starts, self._ends) if e <= start or s >= end]
+        self._starts = [s for s, _ in kept]
+        self._ends = [e for _, e in kept]
+
+    def drop_before(self, ts: float) -> None:
+        i = bisect.bisect_right(self._ends, ts)
+        del self._starts[:i]
+        del self._ends[:i]
+
+
+class AvailabilityWindow:
+    def __init__(self, calendar_id: str = "primary", window_days: Optional[float] = None,
+                 ttl_s: Optional[float] = None):
+        self.calendar_id = calendar_id
+        self.window_s = (window_days if window_days is not None else config.AVAILABILITY_WINDOW_DAYS) * 86400
+        self.ttl_s = ttl_s if ttl_s is not None else config.AVAILABILITY_TTL_S
+        self.busy = BusyIndex()
+        self.win_start = self.win_end = 0.0
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def _query(self, creds, start: float, end: float) -> List[Interval]:
+        llm_metrics.incr("freebusy_calls")
+        body = {"timeMin": _rfc3339(start), "timeMax": _rfc3339(end), "items": [{"id": self.calendar_id}]}
+        resp = calendar_client(creds).freebusy().query(body=body).execute()
+        cal = (resp.get("calendars") or {}).get(self.calendar_id) or {}
+        if cal.get("errors"):
+            raise RuntimeError(f"freebusy errors for {self.calendar_id}: {cal['errors']}")
+        return [(_ts(b["start"]), _ts(b["end"])) for b in cal.get("busy", [])]
+
+    def _load(self, creds, start: float, end: float) -> None:
+        intervals = self._query(creds, start, end)
+        self.busy.drop_range(start, end)
+        for s, e in intervals:
+            self.busy.add(s, e)
+
+    def _ensure(self, creds, until: float) -> None:
+        now = time.time()
+        if not self.fetched_at or now - self.fetched_at > self.ttl_s:
+            self.busy = BusyIndex()
+            end = max(now + self.window_s, until)
+            self._load(creds, now, end)
+            self.win_start, self.win_end, self.fetched_at = now, end, now
+            logger.info(f"[FREEBUSY] window loaded: {len(self.busy)} busy intervals until {_rfc3339(end)}")
+            return
+        self.busy.drop_before(now)
+        self.win_start = now
+        if until > self.win_end:
+            # Only the tail past the current window
+            end = max(until, now + self.window_s)
+            self._load(creds, self.win_end, end)
+            self.win_end = end
+
+    def conflicts(self, creds, start: datetime, end: datetime) -> Optional[List[Interval]]:
+        """Busy intervals overlapping [start, end); None if availability could not be fetched."""
+        s, e = start.timestamp(), end.timestamp()
+        with self._lock:
+            try:
+                self._ensure(creds, e)
+            except Exception as ex:
+                logger.warning(f"⚠️ freebusy query failed, skip availability check: {ex}")
+                return None
+            llm_metrics.incr("availability_checks")
+            return self.busy.overlapping(s, e)
+
+    def note_busy(self, start: datetime, end: datetime) -> None:
+        with self._lock:
+            self.busy.add(start.timestamp(), end.timestamp())
+
+
+_window = AvailabilityWindow()
+
+
+def conflicts(creds, start: datetime, end: datetime) -> Optional[List[Interval]]:
+    return _window.conflicts(creds, start, end)
+
+
+def note_event(evt: dict) -> None:
+    """Add an event this app just created, so later checks see it without a refresh."""
+    try:
+        start = datetime.fromisoformat(evt["start"]["dateTime"].replace("Z", "+00:00"))
+        end = datetime.fromisoformat(evt["end"]["dateTime"].replace("Z", "+00:00"))
+    except (KeyError, TypeError, ValueError):
+        return
+    _window.note_busy(start, end)
+
+
+def format_interval(interval: Interval, tz) -> str:
+    s, e = (datetime.fromtimestamp(t, tz=tz) for t in interval)
+    return f"{s:%Y-%m-%d %H:%M}–{e:%H:%M}" if s.date() == e.date() else f"{s:%Y-%m-%d %H:%M} – {e:%Y-%m-%d %H:%M}"
+
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-event calendar client setup, before vs after the shared client.
+
+Before, create_calendar_event called get_calendar_service() for every event:
+an OAuth refresh plus googleapiclient build() (discovery document read and
+parsed). Now it reuses google_clients.calendar_client(creds). Both paths are
+measured up to building the events().insert request; nothing is sent.
+
+    python benchmarks/bench_calendar_setup.py [--events 50] [--threads 4]
+    python benchmarks/bench_calendar_setup.py --refresh   # also time the old per-event OAuth refresh (needs GMAIL_* creds)
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.oauth2.credentials import Credentials  # noqa: E402
+from googleapiclient.discovery import build  # noqa: E402
+
+import google_clients  # noqa: E402
+
+EVENT = {
+    "summary": "bench",
+    "start": {"dateTime": "2025-11-07T14:00:00+08:00", "timeZone": "Asia/Shanghai"},
+    "end": {"dateTime": "2025-11-07T15:00:00+08:00", "timeZone": "Asia/Shanghai"},
+}
+
+
+def old_setup(creds, refresh: bool):
+    if refresh:
+        from gmail_utils import _refresh_credentials
+        creds = _refresh_credentials()
+    service = build("calendar", "v3", credentials=creds, cache_discovery=False)
+    return service.events().insert(calendarId="primary", body=EVENT, conferenceDataVersion=1)
+
+
+def new_setup(creds):
+    return google_clients.calendar_client(creds).events().insert(calendarId="primary", body=EVENT,
+                                                                 conferenceDataVersion=1)
+
+
+def run(fn, events: int, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: fn(), range(events)))
+    return (time.perf_counter() - start) / events * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=50)
+    ap.add_argument("--threads", type=int, default=4)
+    ap.add_argument("--refresh", action="store_true")
+    args = ap.parse_args()
+
+    creds = Credentials(token="bench-token")
+    google_clients.load_all()  # the one-time cost, paid at /warmup
+
+    old = run(lambda: old_setup(creds, args.refresh), args.events, args.threads)
+    new = run(lambda: new_setup(creds), args.events, args.threads)
+    print(f"events={args.events} threads={args.threads} refresh={args.refresh}")
+    print(f"per-event setup  before={old:.2f}ms  after={new:.3f}ms  ({old / max(new, 1e-6):.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark: LLM response decoding over recorded responses.
+
+Compares llm_json.decode_meeting_analysis (single scan + typed validation)
+with the regex parser that deepseek_client used before (re.search(r'\{.*\}')
+over the whole string, then json.loads).
+
+    python benchmarks/bench_llm_json.py [--rounds 2000] [--file benchmarks/recorded_responses.jsonl]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_json import decode_json_object, decode_meeting_analysis  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def legacy_parse(llm_response: str):
+    """The previous deepseek_client.validate_and_parse_response (the definition that won)."""
+    try:
+        m = re.search(r"\{.*\}", llm_response, re.DOTALL)
+        if m:
+            return json.loads(m.group())
+        return {"error": "No valid JSON found in response"}
+    except json.JSONDecodeError:
+        return {"error": "Invalid JSON format"}
+
+
+def new_parse(llm_response: str):
+    result, err = decode_meeting_analysis(llm_response)
+    return result if result is not None else {"error": err}
+
+
+def decode_only(llm_response: str):
+    obj, err = decode_json_object(llm_response)
+    return obj if obj is not None else {"error": err}
+
+
+def run(parser, records, rounds):
+    ok = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for rec in records:
+            parser(rec["content"])
+    elapsed = time.perf_counter() - start
+    for rec in records:
+        if "error" not in parser(rec["content"]):
+            ok += 1
+    return elapsed, ok
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=2000)
+    ap.add_argument("--file", default=os.path.join(HERE, "recorded_responses.jsonl"))
+    args = ap.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    print(f"{len(records)} recorded responses x {args.rounds} rounds")
+    print(f"{'parser':<16} {'us/resp':>10} {'decoded':>10}")
+    for name, parser in (("legacy", legacy_parse), ("decode only", decode_only), ("unified+typed", new_parse)):
+        elapsed, ok = run(parser, records, args.rounds)
+        per = elapsed / (args.rounds * len(records)) * 1e6
+        print(f"{name:<16} {per:>10.2f} {ok:>7}/{len(records)}")
+
+    print("\nper response (unified):")
+    for rec in records:
+        result, err = decode_meeting_analysis(rec["content"])
+        print(f"  {rec['id']:<24} {'ok' if result else 'FAIL: ' + err}")
+
+
+if __name__ == "__main__":
+    main()
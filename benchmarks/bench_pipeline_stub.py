@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark: analyze_meeting_schedule throughput against the local LLM stub.
+
+Starts llm_stub in-process, points deepseek_client at it (LLM_STUB_URL) and
+runs the pipeline concurrently. Latency and fault injection use the stub's
+LLM_STUB_* environment variables, e.g.
+
+    LLM_STUB_LATENCY=lognormal:800,0.6 LLM_STUB_429_RATE=0.05 LLM_STUB_MALFORMED_RATE=0.05 \
+        python benchmarks/bench_pipeline_stub.py --calls 200 --workers 8
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_stub  # noqa: E402
+
+THREADS = [
+    "The time is ok with me\n\nOn Mon, Nov 3, 2025 at 10:00 AM Alice <alice@example.com> wrote:\n"
+    "the time is 20:00 PM 2025/11/4",
+    "I am ok to talk at 11:00 AM 2025/11/5.\n\nOn Mon, Nov 3, 2025 at 10:00 AM Alice <alice@example.com> wrote:\n"
+    "10:00 AM 2025/11/5 or 3:00 PM 2025/11/6",
+    "The time is both work for me\n\nOn Mon, Nov 3, 2025 at 10:00 AM Alice <alice@example.com> wrote:\n"
+    "11:00 AM 2025/11/7 or 3:00 PM 2025/11/7",
+]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=100)
+    ap.add_argument("--workers", type=int, default=4)
+    args = ap.parse_args()
+
+    server, url = llm_stub.start_in_thread()
+    os.environ["LLM_STUB_URL"] = url
+    from deepseek_client import analyze_meeting_schedule  # reads LLM_STUB_URL at import
+
+    def one(i):
+        start = time.perf_counter()
+        result = analyze_meeting_schedule(THREADS[i % len(THREADS)], "2025/11/03")
+        return time.perf_counter() - start, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(one, range(args.calls)))
+    wall = time.perf_counter() - start
+    server.shutdown()
+
+    latencies = sorted(r[0] for r in results)
+    outcomes = Counter(r[1].get("status") for r in results)
+    reasons = Counter((r[1].get("reason") or "").split(":")[0] for r in results if r[1].get("status") == "error")
+    providers = Counter(r[1].get("llm_provider") for r in results)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+    print(f"calls={args.calls} workers={args.workers} wall={wall:.2f}s throughput={args.calls / wall:.1f}/s")
+    print(f"latency p50={pct(50):.0f}ms p95={pct(95):.0f}ms max={latencies[-1] * 1000:.0f}ms")
+    print(f"status: {dict(outcomes)}")
+    print(f"providers: {dict(providers)}")
+    if reasons:
+        print(f"error reasons: {dict(reasons)}")
+
+
+if __name__ == "__main__":
+    main()
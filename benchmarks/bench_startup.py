@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cold-start import cost of app_safe.
+
+Runs `python -X importtime -c "import app_safe"` in a fresh interpreter (the
+same work a Cloud Run instance does before it can take the first push) and
+reports the wall time plus the slowest top-level packages. With --eager the
+lazily loaded SDKs are imported up front as well, which is what every cold
+start paid before lazy_imports.
+
+    python benchmarks/bench_startup.py [--runs 5] [--top 15] [--eager]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules app_safe defers through lazy_imports
+LAZY_MODULES = ["google.generativeai", "dateparser", "dateparser.date", "bs4", "googleapiclient.discovery",
+                "googleapiclient.errors", "google.oauth2.credentials", "google.auth.transport.requests",
+                "pytz", "psutil"]
+
+_LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+
+
+def run_once(eager: bool):
+    code = "import app_safe"
+    if eager:
+        code = "".join(f"import {m}; " for m in LAZY_MODULES) + code
+    env = dict(os.environ, LAZY_PRELOAD="0", EMAIL_OUT_DIR=os.environ.get("EMAIL_OUT_DIR", tempfile.mkdtemp()))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=env,
+                          capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        sys.exit(f"import failed:\n{proc.stderr[-2000:]}")
+
+    per_package = defaultdict(int)  # top-level package -> summed self time (µs) of its modules
+    for m in _LINE_RE.finditer(proc.stderr):
+        self_us, _, name = m.groups()
+        per_package[name.split(".")[0]] += int(self_us)
+    return wall_ms, per_package
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--top", type=int, default=15)
+    ap.add_argument("--eager", action="store_true", help="also import the lazily loaded SDKs")
+    args = ap.parse_args()
+
+    walls, last = [], {}
+    for _ in range(args.runs):
+        wall, last = run_once(args.eager)
+        walls.append(wall)
+
+    print(f"mode={'eager' if args.eager else 'lazy'} runs={args.runs} "
+          f"wall median={statistics.median(walls):.0f}ms min={min(walls):.0f}ms")
+    print(f"{'package':<32} {'import ms':>14}")
+    for name, us in sorted(last.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"{name:<32} {us / 1000:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
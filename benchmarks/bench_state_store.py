@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark: processed-id bookkeeping, JSON blob vs processed_set vs SQLite (local files).
+
+For a history of N processed ids, times one "mark a new message processed"
+(JSON: load the set, add, sort and rewrite the whole file; processed_set:
+add to the ring and rewrite the fixed-size binary file; SQLite: one INSERT)
+and one membership check.
+
+    python benchmarks/bench_state_store.py [--sizes 1000 10000 100000] [--ops 200]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_bucket as config  # noqa: E402
+import processed_set  # noqa: E402
+import state_manager_bucket as sm  # noqa: E402
+import state_sqlite  # noqa: E402
+
+
+def per_op_us(fn, ops: int) -> float:
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - start) / ops * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--ops", type=int, default=200)
+    args = ap.parse_args()
+    logging.getLogger(config.LOGGER_NAME).setLevel(logging.WARNING)
+
+    print(f"{'ids':>8} {'json add':>12} {'pidset add':>12} {'sqlite add':>12} "
+          f"{'json check':>12} {'pidset check':>13} {'sqlite check':>13}   (µs per op)")
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            config.PROCESSED_FILE = os.path.join(tmp, "processed_ids.json")
+            config.FAILED_FILE = os.path.join(tmp, "failed_ids.json")
+            config.LAST_HISTORY_FILE = os.path.join(tmp, "last_history_id.json")
+            config.STATE_SQLITE_PATH = os.path.join(tmp, "state.db")
+            config.PROCESSED_SET_FILE = os.path.join(tmp, "processed_ids.bin")
+            sm.PROCESSED_FILE = config.PROCESSED_FILE
+            state_sqlite._conn = None
+            processed_set._set = None
+
+            ids = [f"msg{i:08d}" for i in range(n)]
+            config.STATE_BACKEND = "json"
+            sm.save_processed_ids(set(ids))
+            ops = max(1, min(args.ops, 2_000_000 // n))
+            json_add = per_op_us(lambda i: sm.save_processed_ids({f"new{i}"}), ops)
+            json_check = per_op_us(lambda i: ids[i % n] in sm.load_processed_ids(), ops)
+
+            sm.is_processed(ids[0])  # imports the JSON file into processed_ids.bin
+            pidset_add = per_op_us(lambda i: sm.mark_processed([f"pnew{i}"]), args.ops)
+            pidset_check = per_op_us(lambda i: sm.is_processed(ids[i % n]), args.ops)
+
+            config.STATE_BACKEND = "sqlite"  # imports the JSON file on first open
+            state_sqlite.connect()
+            sqlite_add = per_op_us(lambda i: sm.mark_processed([f"sqlnew{i}"]), args.ops)
+            sqlite_check = per_op_us(lambda i: sm.is_processed(ids[i % n]), args.ops)
+            state_sqlite._conn.close()
+
+        print(f"{n:>8} {json_add:>12.0f} {pidset_add:>12.0f} {sqlite_add:>12.0f} "
+              f"{json_check:>12.0f} {pidset_check:>13.1f} {sqlite_check:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
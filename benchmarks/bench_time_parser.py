@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark: time_parser.parse_human_time, cold vs memoized, per parsing pass.
+
+Compares the previous implementation (dateparser.parse on every call, up to
+twice per input) with the memoized one: texts naming a day are cached on
+(normalized text, base date, timezone), so every message of a day that says
+"tomorrow 3pm" parses once. Relative phrases ("in 2 hours", "5pm") are parsed
+per call. Absolute forms are answered by the regex fast path before the cache.
+
+    python benchmarks/bench_time_parser.py [--rounds 200]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+import dateparser
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time_parser  # noqa: E402
+
+# Inputs grouped by the pass that resolves them
+SAMPLES = {
+    "fast_path": ["2025-11-07 14:00", "10:00 AM 2025/11/5", "2025年11月4日下午3点", "2025/11/7 2:00 PM"],
+    "pass1_dateparser": ["tomorrow 3pm", "next tuesday 5 pm", "明天下午3点", "nov 12 10:30 am"],
+    "pass2_renormalized": ["fri. 4:30pm", "tues. @ 9am", "sat. 11am"],
+    "pass3_time_only": ["around 17:00 or so", "let's say 9 am-ish", "call at 8:15 then"],
+    "relative_uncached": ["in 2 hours", "5pm", "in 30 minutes"],
+}
+
+
+def legacy_parse(human_text, base_dt, tz_name):
+    """parse_human_time before memoization (first two passes; the third is cheap regex)."""
+    text1 = time_parser.normalize_time_text(human_text)
+    settings = {
+        "PREFER_DATES_FROM": "future",
+        "TIMEZONE": tz_name,
+        "RETURN_AS_TIMEZONE_AWARE": True,
+        "RELATIVE_BASE": base_dt,
+    }
+    dt = dateparser.parse(text1, settings=settings, languages=["en", "zh"])
+    if dt:
+        return dt
+    text2 = re.sub(r"\b(\d{1,2})(am|pm)\b", r"\1 \2", text1)
+    text2 = re.sub(r"\b(\d{1,2}):(\d{2})(am|pm)\b", r"\1:\2 \3", text2)
+    return dateparser.parse(text2, settings=settings, languages=["en", "zh"])
+
+
+def bench(fn, texts, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in texts:
+            fn(t)
+    return (time.perf_counter() - start) / (rounds * len(texts)) * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=200)
+    args = ap.parse_args()
+
+    tz_name = time_parser.DEFAULT_TZ
+    base = pytz.timezone(tz_name).localize(datetime(2025, 11, 3, 9, 30))
+
+    print(f"{'pass':<20} {'legacy':>12} {'cold':>12} {'cached':>12} {'cache hits':>12}   (µs per call)")
+    for name, texts in SAMPLES.items():
+        legacy = bench(lambda t: legacy_parse(t, base, tz_name), texts, max(1, args.rounds // 10))
+
+        # cold: a new base date per call, so the cache never hits
+        days = iter(range(10 ** 7))
+        cold = bench(lambda t: time_parser.parse_human_time(t, base + timedelta(days=next(days)), tz_name),
+                     texts, max(1, args.rounds // 10))
+
+        # cached: messages of one day, at different times of that day
+        time_parser._dateparse_day.cache_clear()
+        minutes = iter(range(10 ** 7))
+        cached = bench(lambda t: time_parser.parse_human_time(t, base + timedelta(minutes=next(minutes) % 600), tz_name),
+                       texts, args.rounds)
+        print(f"{name:<20} {legacy:>12.1f} {cold:>12.1f} {cached:>12.1f} {time_parser.parse_cache_info()['hits']:>12}")
+
+    print(f"fast path: {time_parser.fast_path_stats()}")
+
+    # Same answers as before
+    for texts in SAMPLES.values():
+        for t in texts:
+            old, new = legacy_parse(t, base, tz_name), time_parser.parse_human_time(t, base, tz_name)
+            if old and old != new:
+                print(f"MISMATCH {t!r}: legacy={old} new={new}")
+
+
+if __name__ == "__main__":
+    main()
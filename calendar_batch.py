@@ -0,0 +1,139 @@
+"""
+Calendar event inserts batched per webhook run.
+
+With CALENDAR_BATCH=1 the webhook hands one CalendarBatch to every
+process_single_message() call. Confirmed meetings are queued instead of being
+inserted one blocking HTTP call at a time, and flush() sends them as Calendar
+batch requests (up to BATCH_MAX inserts each, sendUpdates="all" per insert).
+
+flush() returns one result dict per queued message, keyed by msg_id:
+  - inserted        -> the caller's on_created(evt) result (status "success")
+  - 409 (eventId already exists) -> status "success", duplicate=True
+  - already created (event index / calendar mirror) -> answered in add(), never sent
+  - anything else   -> status "error" with a reason, so the webhook routes just
+                       that message to the retry store
+
+Queued events are not on the calendar (or in freebusy) until flush(), so the
+batch keeps their intervals: conflicts() lets the availability check see a
+slot that an earlier message of the same run already took.
+"""
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import availability
+import config_bucket as config
+import event_index
+from calendar_utils import (announce_calendar_event, event_insert_request, find_existing_event, get_meet_link,
+                            prepare_calendar_event)
+from google_clients import calendar_client
+from lazy_imports import lazy_module
+from logger_config import logger
+
+gapi_errors = lazy_module("googleapiclient.errors")
+
+# Calendar accepts at most 50 calls per batch request
+BATCH_MAX = min(int(config.CALENDAR_BATCH_MAX), 50)
+
+
+class CalendarBatch:
+    def __init__(self, creds):
+        self.creds = creds
+        self._pending: List[Dict[str, Any]] = []
+        self._done: Dict[str, dict] = {}  # already created, answered without an insert
+        self._queued: List[Tuple[float, float, str]] = []  # (start, end, key) of the pending inserts
+
+    def __len__(self):
+        return len(self._pending)
+
+    def conflicts(self, key: str, start, end) -> List[availability.Interval]:
+        """Queued events (other than key's own) overlapping [start, end)."""
+        s, e = start.timestamp(), end.timestamp()
+        return [(qs, qe) for qs, qe, qkey in self._queued if qkey != key and qs < e and qe > s]
+
+    def add(self, service_gmail, thread_id, subject, summary, start_time, attendees_emails, tz_name,
+            msg_id=None, on_created: Optional[Callable[[dict], dict]] = None) -> bool:
+        """Queue one event. False if the start time could not be parsed (the attendees were asked to confirm)."""
+        prepared = prepare_calendar_event(service_gmail, thread_id, subject, summary, start_time,
+                                          attendees_emails, tz_name, msg_id=msg_id)
+        if not prepared:
+            return False
+        event_body, dt_local = prepared
+        key = event_index.index_key(thread_id, dt_local.isoformat())
+        evt = find_existing_event(self.creds, key, event_body["id"], msg_id=msg_id)
+        if evt:
+            self._done[msg_id] = on_created(evt) if on_created else {
+                "status": "success", "msg_id": msg_id, "event_id": evt["id"]}
+            return True
+        start = dt_local.timestamp()
+        self._queued.append((start, start + availability.EVENT_DURATION.total_seconds(), key))
+        self._pending.append({
+            "msg_id": msg_id,
+            "key": key,
+            "event_body": event_body,
+            "on_created": on_created,
+            "announce": (service_gmail, thread_id, subject, summary, dt_local, attendees_emails),
+        })
+        return True
+
+    def flush(self) -> Dict[str, dict]:
+        """Send the queued inserts; {msg_id: result}. The queue is empty afterwards."""
+        pending, self._pending = self._pending, []
+        self._queued = []
+        results, self._done = self._done, {}
+        if not pending:
+            return results
+
+        start = time.perf_counter()
+        for i in range(0, len(pending), BATCH_MAX):
+            chunk = pending[i:i + BATCH_MAX]
+            try:
+                self._execute(chunk, results)
+            except Exception as e:
+                # The batch call itself failed (auth, network); none of the chunk's results arrived
+                logger.error(f"⚠️ Calendar batch request failed: {e}")
+                for item in chunk:
+                    results.setdefault(item["msg_id"], {"status": "error", "reason": f"calendar_batch: {e}",
+                                                        "msg_id": item["msg_id"]})
+
+        event_index.save_index()
+        ok = sum(1 for item in pending if results.get(item["msg_id"], {}).get("status") == "success")
+        logger.info(f"[CAL_BATCH] {len(pending)} events, {ok} ok, {len(pending) - ok} failed "
+                    f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return results
+
+    def _execute(self, chunk: List[Dict[str, Any]], results: Dict[str, dict]) -> None:
+        service_calendar = calendar_client(self.creds)
+
+        def callback(request_id, response, exception):
+            item = chunk[int(request_id)]
+            results[item["msg_id"]] = self._result(item, response, exception)
+
+        batch = service_calendar.new_batch_http_request(callback=callback)
+        for n, item in enumerate(chunk):
+            batch.add(event_insert_request(service_calendar, item["event_body"]), request_id=str(n))
+        batch.execute()
+
+    @staticmethod
+    def _result(item: Dict[str, Any], evt: Optional[dict], exception) -> dict:
+        msg_id = item["msg_id"]
+        event_id = item["event_body"]["id"]
+        if exception is not None:
+            status = getattr(getattr(exception, "resp", None), "status", None)
+            if isinstance(exception, gapi_errors.HttpError) and status == 409:
+                # 409 = The event existed.
+                logger.info(f"[IDEMPOTENT] Event already exists for eventId={event_id}, treat as success.")
+                event_index.record(item["key"], event_id, msg_id=msg_id, save=False)
+                return {"status": "success", "msg_id": msg_id, "event_id": event_id, "duplicate": True}
+            logger.error(f"⚠️ Calendar API error for message {msg_id}: {exception}")
+            return {"status": "error", "reason": f"calendar_batch: {status or ''} {exception}".strip(),
+                    "msg_id": msg_id}
+
+        event_index.record(item["key"], evt.get("id") or event_id, get_meet_link(evt), msg_id=msg_id, save=False)
+        try:
+            announce_calendar_event(evt, *item["announce"], msg_id=msg_id)
+            if item["on_created"]:
+                return item["on_created"](evt)
+        except Exception as e:
+            # The event exists; a failed follow-up mail must not send it back for another insert
+            logger.error(f"⚠️ Post-create step failed for message {msg_id}: {e}")
+        return {"status": "success", "msg_id": msg_id, "event_id": evt.get("id")}
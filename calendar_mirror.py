@@ -0,0 +1,229 @@
+"""
+Local mirror of the primary calendar, kept current with events.list sync tokens.
+
+The first sync lists every event (singleEvents, all pages) and stores the
+nextSyncToken. Later syncs send only that token and get back just the events
+changed since, deleted ones as status "cancelled". A 410 (token invalidated by
+Google) is the only case that triggers another full sync.
+
+The mirror is persisted through state_manager_bucket (CALENDAR_MIRROR_FILE,
+local or gs://), so a new instance starts from the stored token instead of a
+full listing:
+
+    {"sync_token": "...", "synced_at": "...", "events": {"<event id>": {slim event}}}
+
+In memory it is indexed by start time (sorted) and by attendee email, so
+get / overlapping / scheduled are local lookups. Syncs are throttled to one
+per CALENDAR_MIRROR_MIN_SYNC_S; events that ended more than
+CALENDAR_MIRROR_KEEP_DAYS ago are dropped.
+"""
+import bisect
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import config_bucket as config
+import llm_metrics
+from google_clients import calendar_client
+from lazy_imports import lazy_module
+from logger_config import logger
+from state_manager_bucket import StaleWriteError, ensure_str_path, read_json, write_json
+
+gapi_errors = lazy_module("googleapiclient.errors")
+
+LIST_FIELDS = ("nextPageToken,nextSyncToken,"
+               "items(id,status,summary,start,end,attendees(email),hangoutLink,iCalUID)")
+
+
+def _event_ts(when: Dict[str, str]) -> Optional[float]:
+    """start/end of an event ({"dateTime": ...} or all-day {"date": ...}) -> epoch seconds."""
+    value = (when or {}).get("dateTime") or (when or {}).get("date")
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def slim_event(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    start, end = _event_ts(item.get("start")), _event_ts(item.get("end"))
+    if start is None or end is None:
+        return None
+    return {
+        "id": item["id"],
+        "summary": item.get("summary", ""),
+        "start": start,
+        "end": end,
+        "attendees": sorted({(a.get("email") or "").lower() for a in item.get("attendees") or []} - {""}),
+        "hangoutLink": item.get("hangoutLink"),
+    }
+
+
+class CalendarMirror:
+    def __init__(self, calendar_id: str = "primary"):
+        self.calendar_id = calendar_id
+        self.sync_token: Optional[str] = None
+        self.events: Dict[str, Dict[str, Any]] = {}
+        self._by_start: List[Tuple[float, str]] = []
+        self._by_attendee: Dict[str, Set[str]] = {}
+        self._loaded = False
+        self._last_sync = 0.0
+        self._lock = threading.RLock()
+
+    # ---- index ----
+    def _put(self, evt: Dict[str, Any]) -> None:
+        self._drop(evt["id"])
+        self.events[evt["id"]] = evt
+        bisect.insort(self._by_start, (evt["start"], evt["id"]))
+        for email in evt["attendees"]:
+            self._by_attendee.setdefault(email, set()).add(evt["id"])
+
+    def _drop(self, event_id: str) -> None:
+        old = self.events.pop(event_id, None)
+        if old is None:
+            return
+        i = bisect.bisect_left(self._by_start, (old["start"], event_id))
+        if i < len(self._by_start) and self._by_start[i] == (old["start"], event_id):
+            del self._by_start[i]
+        for email in old["attendees"]:
+            ids = self._by_attendee.get(email)
+            if ids:
+                ids.discard(event_id)
+                if not ids:
+                    del self._by_attendee[email]
+
+    def _reset(self) -> None:
+        self.sync_token = None
+        self.events, self._by_start, self._by_attendee = {}, [], {}
+
+    def _prune(self) -> None:
+        cutoff = time.time() - config.CALENDAR_MIRROR_KEEP_DAYS * 86400
+        for event_id in [i for i, e in self.events.items() if e["end"] < cutoff]:
+            self._drop(event_id)
+
+    # ---- persistence ----
+    def _load(self) -> None:
+        path = ensure_str_path(config.CALENDAR_MIRROR_FILE)
+        try:
+            data = read_json(path)
+        except Exception as e:
+            logger.warning(f"Failed to read calendar mirror {path}: {e}")
+            data = None
+        if isinstance(data, dict) and data.get("sync_token"):
+            for evt in (data.get("events") or {}).values():
+                self._put(evt)
+            self.sync_token = data["sync_token"]
+            logger.info(f"[MIRROR] loaded {len(self.events)} events from {path}")
+        self._loaded = True
+
+    def _save(self) -> None:
+        path = ensure_str_path(config.CALENDAR_MIRROR_FILE)
+        payload = {
+            "sync_token": self.sync_token,
+            "synced_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            "events": self.events,
+        }
+        try:
+            write_json(path, payload)
+        except StaleWriteError:
+            # Another instance saved its mirror: load it (and its sync token) on the next sync
+            self._loaded = False
+            self._last_sync = 0.0
+            logger.info(f"[MIRROR] {path} changed by another instance, reloading on next sync")
+        except Exception as e:
+            logger.warning(f"Failed to save calendar mirror {path}: {e}")
+
+    # ---- sync ----
+    def _list(self, creds, **params) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        events_api = calendar_client(creds).events()
+        items, page_token = [], None
+        while True:
+            llm_metrics.incr("calendar_list_calls")
+            resp = events_api.list(calendarId=self.calendar_id, singleEvents=True, showDeleted=True,
+                                   maxResults=2500, pageToken=page_token, fields=LIST_FIELDS,
+                                   **params).execute()
+            items.extend(resp.get("items", []))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return items, resp.get("nextSyncToken")
+
+    def _apply(self, items: Iterable[Dict[str, Any]]) -> None:
+        for item in items:
+            evt = None if item.get("status") == "cancelled" else slim_event(item)
+            if evt is None:
+                self._drop(item.get("id"))
+            else:
+                self._put(evt)
+
+    def sync(self, creds, force: bool = False) -> None:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if not force and time.time() - self._last_sync < config.CALENDAR_MIRROR_MIN_SYNC_S:
+                return
+            start = time.perf_counter()
+            full = self.sync_token is None
+            if not full:
+                try:
+                    items, token = self._list(creds, syncToken=self.sync_token)
+                except gapi_errors.HttpError as e:
+                    if getattr(e.resp, "status", None) != 410:
+                        raise
+                    logger.warning("[MIRROR] sync token invalidated (410), full resync")
+                    self._reset()
+                    full = True
+            if full:
+                items, token = self._list(creds)
+            self._apply(items)
+            self._prune()
+            self.sync_token = token or self.sync_token
+            self._last_sync = time.time()
+            if items or full:
+                self._save()
+            llm_metrics.incr("calendar_full_syncs" if full else "calendar_incremental_syncs")
+            logger.info(f"[MIRROR] {'full' if full else 'incremental'} sync: {len(items)} changes, "
+                        f"{len(self.events)} events, {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # ---- lookups (local) ----
+    def get(self, event_id: str) -> Optional[Dict[str, Any]]:
+        return self.events.get(event_id)
+
+    def overlapping(self, start: float, end: float) -> List[Dict[str, Any]]:
+        """Events overlapping [start, end). Events are at most CALENDAR_MIRROR_MAX_EVENT_S long for the scan."""
+        lo = bisect.bisect_left(self._by_start, (start - config.CALENDAR_MIRROR_MAX_EVENT_S, ""))
+        hi = bisect.bisect_left(self._by_start, (end, ""))
+        found = (self.events[i] for _, i in self._by_start[lo:hi])
+        return [e for e in found if e["end"] > start]
+
+    def scheduled(self, start: float, attendees: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        """Events starting exactly at start; with attendees, only those sharing at least one of them."""
+        lo = bisect.bisect_left(self._by_start, (start, ""))
+        hi = bisect.bisect_right(self._by_start, (start, "\uffff"))
+        ids = {i for _, i in self._by_start[lo:hi]}
+        wanted = {a.lower() for a in attendees}
+        if wanted:
+            ids &= set().union(*(self._by_attendee.get(a, set()) for a in wanted))
+        return [self.events[i] for i in ids]
+
+    def with_attendee(self, email: str) -> List[Dict[str, Any]]:
+        return sorted((self.events[i] for i in self._by_attendee.get(email.lower(), ())), key=lambda e: e["start"])
+
+
+MIRROR = CalendarMirror()
+
+
+def as_event(evt: Dict[str, Any]) -> Dict[str, Any]:
+    """Event-shaped dict for a mirrored event, marked like an event_index answer."""
+    out = {"id": evt["id"], "from_index": True}
+    if evt.get("hangoutLink"):
+        out["hangoutLink"] = evt["hangoutLink"]
+    return out
+
+
+def synced(creds) -> Optional[CalendarMirror]:
+    """The mirror after a (throttled) sync; None if the sync failed."""
+    try:
+        MIRROR.sync(creds)
+    except Exception as e:
+        logger.warning(f"⚠️ Calendar mirror sync failed: {e}")
+        return None
+    return MIRROR
@@ -5,27 +5,161 @@
 #import logging
 import time,os
 from datetime import timedelta
-import dateparser
-import pytz
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 from logger_config import logger
-from gmail_utils import send_reply,get_calendar_service
+from gmail_utils import send_reply,get_credentials
+from google_clients import calendar_client
+import event_index
+import calendar_mirror
+import config_bucket as config
 import hashlib
-from googleapiclient.errors import HttpError
+from lazy_imports import lazy_module
+from time_parser import fast_parse_datetime
+
+dateparser = lazy_module("dateparser")
+pytz = lazy_module("pytz")
+gapi_errors = lazy_module("googleapiclient.errors")
 
 
 SEND_MEETING_REPLY = os.getenv("SEND_MEETING_REPLY", "0") == "1"
 
-from googleapiclient.discovery import build
 from datetime import timedelta
 import time
 import logging
-import dateparser, pytz
 
 logger = logging.getLogger("gmail_helper")
 SEND_MEETING_REPLY = os.getenv("SEND_MEETING_REPLY", "0") == "1"
 
+def prepare_calendar_event(service_gmail, thread_id, subject, summary, start_time,
+                           attendees_emails, tz_name, msg_id=None):
+    """
+    Parse the start time and build the event body.
+    Returns (event_body, dt_local), or None after asking the attendees to confirm
+    an unparsable time.
+    """
+    # "YYYY-MM-DD HH:MM" from the LLM almost always hits the regex fast path
+    dt = fast_parse_datetime(start_time) or dateparser.parse(
+        start_time, settings={"RETURN_AS_TIMEZONE_AWARE": False})
+    if not dt:
+        body = (
+            "We were unable to identify the meeting time.\n"
+            "Please confirm by replying with a time like "
+            "2025-10-22 15:00 or 3:00 PM next Wednesday. Thank you."
+        )
+        to_field = ",".join(attendees_emails)
+        send_reply(
+            service_gmail,
+            thread_id,
+            to_field,
+            f"Please confirm the meeting time – {subject}",
+            body,
+            msg_id=msg_id,
+            template="confirm_time",
+        )
+        return None
+
+    tz = pytz.timezone(tz_name)
+    dt_local = tz.localize(dt)
+    end_dt_local = dt_local + timedelta(hours=1)
+
+    raw_key = f"{thread_id}-{dt_local.isoformat()}".encode("utf-8")
+    event_id = hashlib.md5(raw_key).hexdigest()[:20]
+
+    event_body = {
+        "id": event_id,
+        "summary": summary,
+        "start": {"dateTime": dt_local.isoformat(), "timeZone": tz_name},
+        "end": {"dateTime": end_dt_local.isoformat(), "timeZone": tz_name},
+        "conferenceData": {
+            # Same requestId on a retry -> Calendar reuses the Meet space instead of creating another
+            "createRequest": {"requestId": f"meet-{event_id}"}
+        },
+        "attendees": [{"email": e} for e in attendees_emails],
+        "reminders": {
+            "useDefault": False,
+            "overrides": [
+                {"method": "email", "minutes": 30},
+                {"method": "popup", "minutes": 10},
+            ],
+        },
+    }
+    logger.info(
+        f"[CREATE_EVT] thread={thread_id}, msg={msg_id}, "
+        f"start={dt_local}, eventId={event_id}, attendees={attendees_emails}"
+    )
+    return event_body, dt_local
+
+
+def event_insert_request(service_calendar, event_body):
+    return service_calendar.events().insert(
+        calendarId="primary",
+        body=event_body,
+        conferenceDataVersion=1,
+        sendUpdates="all",
+    )
+
+
+def find_existing_event(creds, key, event_id, msg_id=None):
+    """
+    The event if it was already created, answered locally: the event index, then
+    (CALENDAR_MIRROR=1) the calendar mirror. None if it has to be inserted.
+    """
+    rec = event_index.lookup(key)
+    if rec:
+        logger.info(f"[IDEMPOTENT] eventId={rec.get('event_id')} already created for {key}, skip insert.")
+        return event_index.cached_event(rec)
+    if config.CALENDAR_MIRROR:
+        mirror = calendar_mirror.synced(creds or get_credentials())
+        mirrored = mirror.get(event_id) if mirror else None
+        if mirrored:
+            logger.info(f"[IDEMPOTENT] eventId={event_id} found in the calendar mirror, skip insert.")
+            event_index.record(key, event_id, mirrored.get("hangoutLink"), msg_id=msg_id)
+            return calendar_mirror.as_event(mirrored)
+    return None
+
+
+def fetch_existing_event(service_calendar, event_id):
+    """The already created event after a 409; None if it cannot be read."""
+    try:
+        return service_calendar.events().get(calendarId="primary", eventId=event_id).execute()
+    except Exception as e:
+        logger.warning(f"Failed to read existing event {event_id}: {e}")
+        return None
+
+
+def get_meet_link(evt) -> str:
+    return (
+        (evt or {}).get("hangoutLink")
+        or (evt or {}).get("conferenceData", {}).get("entryPoints", [{}])[0].get("uri")
+    )
+
+
+def announce_calendar_event(evt, service_gmail, thread_id, subject, summary, dt_local,
+                            attendees_emails, msg_id=None):
+    """Optional 'Meeting Created' reply once the event exists."""
+    meet_link = get_meet_link(evt)
+    if meet_link:
+        if SEND_MEETING_REPLY:
+            body = (
+                f"Meeting Created:\n"
+                f"Subject: {summary}\n"
+                f"Time: {dt_local.strftime('%Y-%m-%d %H:%M')}\n"
+                f"Meet Link: {meet_link}"
+            )
+            send_reply(
+                service_gmail,
+                thread_id,
+                ", ".join(attendees_emails),
+                f"Meeting Created – {subject}",
+                body,
+                msg_id=msg_id,
+                template="meeting_created",
+            )
+        else:
+            logger.info("🟢 Calendar invitation sent, skip extra reply.")
+    else:
+        logger.warning("Meeting created, but failed to get meeting link.")
+
+
 def create_calendar_event(
     creds,
     service_gmail,
@@ -40,104 +174,40 @@ def create_calendar_event(
 ):
     logger.info(f"[CREATE_EVT] thread={thread_id}, msg={msg_id}, start={start_time}")
     try:
-        # Extract credentials and calendar service
-        service_calendar,creds = get_calendar_service()
-        dt = dateparser.parse(start_time, settings={"RETURN_AS_TIMEZONE_AWARE": False})
-        if not dt:
-            body = (
-                "We were unable to identify the meeting time.\n"
-                "Please confirm by replying with a time like "
-                "2025-10-22 15:00 or 3:00 PM next Wednesday. Thank you."
-            )
-            to_field = ",".join(attendees_emails)
-            send_reply(
-                service_gmail,
-                thread_id,
-                to_field,
-                f"Please confirm the meeting time – {subject}",
-                body,
-                msg_id=msg_id,
-            )
+        # Shared calendar client on the webhook's credentials (no OAuth refresh / discovery build per event)
+        service_calendar = calendar_client(creds or get_credentials())
+        prepared = prepare_calendar_event(service_gmail, thread_id, subject, summary, start_time,
+                                          attendees_emails, tz_name, msg_id=msg_id)
+        if not prepared:
             return None
+        event_body, dt_local = prepared
+        event_id = event_body["id"]
 
-        tz = pytz.timezone(tz_name)
-        dt_local = tz.localize(dt)
-        end_dt_local = dt_local + timedelta(hours=1)
-
-        raw_key = f"{thread_id}-{dt_local.isoformat()}".encode("utf-8")
-        event_id = hashlib.md5(raw_key).hexdigest()[:20]
-
-        event_body = {
-            "id": event_id,
-            "summary": summary,
-            "start": {"dateTime": dt_local.isoformat(), "timeZone": tz_name},
-            "end": {"dateTime": end_dt_local.isoformat(), "timeZone": tz_name},
-            "conferenceData": {
-                "createRequest": {"requestId": f"meet-{int(time.time())}"}
-            },
-            "attendees": [{"email": e} for e in attendees_emails],
-            "reminders": {
-                "useDefault": False,
-                "overrides": [
-                    {"method": "email", "minutes": 30},
-                    {"method": "popup", "minutes": 10},
-                ],
-            },
-        }
-        logger.info(
-            f"[CREATE_EVT] thread={thread_id}, msg={msg_id}, "
-            f"start={dt_local}, eventId={event_id}, attendees={attendees_emails}"
-        )
+        # Created before (retry / redelivered push): answer from the index, no Calendar call
+        key = event_index.index_key(thread_id, dt_local.isoformat())
+        existing = find_existing_event(creds, key, event_id, msg_id=msg_id)
+        if existing:
+            return existing
 
         try:
-            evt = (
-                service_calendar.events()
-                .insert(
-                    calendarId="primary",
-                    body=event_body,
-                    conferenceDataVersion=1,
-                    sendUpdates="all",
-                    #eventId=event_id,
-                )
-                .execute()
-            )
-        except HttpError as e:
+            evt = event_insert_request(service_calendar, event_body).execute()
+        except gapi_errors.HttpError as e:
                 # 409 = The event existed. 
                 if e.resp.status == 409:
                     logger.info(
                     f"[IDEMPOTENT] Event already exists for eventId={event_id}, "
                     f"treat as success and skip duplicate."
                     )
-                    return None
+                    evt = fetch_existing_event(service_calendar, event_id) or {"id": event_id}
+                    event_index.record(key, event_id, get_meet_link(evt), msg_id=msg_id)
+                    evt["from_index"] = True
+                    return evt
                 logger.error(f"⚠️ Calendar API error: {e}")
                 raise
 
-        meet_link = (
-            evt.get("hangoutLink")
-            or evt.get("conferenceData", {}).get("entryPoints", [{}])[0].get("uri")
-        )
-
-        if meet_link:
-            if SEND_MEETING_REPLY:
-                body = (
-                    f"Meeting Created:\n"
-                    f"Subject: {summary}\n"
-                    f"Time: {dt_local.strftime('%Y-%m-%d %H:%M')}\n"
-                    f"Meet Link: {meet_link}"
-                )
-                send_reply(
-                    service_gmail,
-                    thread_id,
-                    ", ".join(attendees_emails),
-                    f"Meeting Created – {subject}",
-                    body,
-                    msg_id=msg_id,
-                )
-            else:
-                logger.info("🟢 Calendar invitation sent, skip extra reply.")
-        else:
-            logger.warning("Meeting created, but failed to get meeting link.")
-
+        event_index.record(key, evt.get("id") or event_id, get_meet_link(evt), msg_id=msg_id)
+        announce_calendar_event(evt, service_gmail, thread_id, subject, summary, dt_local,
+                                attendees_emails, msg_id=msg_id)
         return evt
 
     except Exception as e:
@@ -151,6 +221,7 @@ def create_calendar_event(
                     f"Failed to create calendar event – {subject}",
                     f"Detail: {e}",
                     msg_id=msg_id,
+                    template="create_failed",
                 )
             except Exception as mail_err:
                 logger.error(f"⚠️ Also failed to send failure notice email: {mail_err}")
@@ -165,7 +236,7 @@ def send_meeting_invite(service_gmail, thread_id, to, subject, meet_link, start_
             "Plase Please arrive on time. If you need to make any modifications, please reply to this email.\n\n-- AI meeting assistant"
             
         )
-        send_reply(service_gmail, thread_id, to, subject, body_text,msg_id=msg_id)
+        send_reply(service_gmail, thread_id, to, subject, body_text,msg_id=msg_id, template="invite")
         logger.info(f"📧 Sent invitation  {to}")
     except Exception as e:
         logger.error(f"❌ Failed to send meeting invite:{e}")
\ No newline at end of file
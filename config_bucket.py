@@ -12,6 +12,7 @@ Notes:
 """
 from __future__ import annotations
 import os,platform
+import tempfile
 from pathlib import Path
 IS_WINDOWS = platform.system() == "Windows"
 IS_LINUX = platform.system() == "Linux"
@@ -59,6 +60,40 @@ GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")  # or gemini-1.5-flas
 # DeepSeek (kept as fallback / optional)
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+
+# Local LLM stub server (llm_stub.py). When set, both providers are served by the stub.
+LLM_STUB_URL = os.getenv("LLM_STUB_URL")
+if LLM_STUB_URL:
+    GEMINI_API_KEY = GEMINI_API_KEY or "stub"
+    DEEPSEEK_API_KEY = DEEPSEEK_API_KEY or "stub"
+    DEEPSEEK_API_URL = LLM_STUB_URL.rstrip("/") + "/v1/chat/completions"
+
+# LLM routing (see llm_router.py)
+LLM_ROUTING = os.getenv("LLM_ROUTING", "failover").lower()  # single / failover / hedged
+LLM_BUDGET_MS_GEMINI = int(os.getenv("LLM_BUDGET_MS_GEMINI", "30000"))
+LLM_BUDGET_MS_DEEPSEEK = int(os.getenv("LLM_BUDGET_MS_DEEPSEEK", "20000"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_DEFAULT_MS = float(os.getenv("LLM_HEDGE_DEFAULT_MS", "8000"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "3"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "60"))
+# Stream completions and stop reading once the JSON object is closed
+LLM_STREAM = os.getenv("LLM_STREAM", "0") == "1"
+# Prompt size control (see token_budget.py)
+LLM_INPUT_TOKEN_BUDGET = int(os.getenv("LLM_INPUT_TOKEN_BUDGET", "8000"))
+# Extra output tokens on top of the schema estimate (gemini-2.5 thinking tokens count as output)
+LLM_OUTPUT_HEADROOM_TOKENS = int(os.getenv("LLM_OUTPUT_HEADROOM_TOKENS", "2048"))
+# Tiered analysis: small model + short prompt first, escalate to the full model when unsure
+LLM_TIERING = os.getenv("LLM_TIERING", "0") == "1"
+LLM_FAST_MODEL_GEMINI = os.getenv("LLM_FAST_MODEL_GEMINI", "gemini-2.5-flash-lite")
+LLM_FAST_MODEL_DEEPSEEK = os.getenv("LLM_FAST_MODEL_DEEPSEEK", "deepseek-chat")
+# Import the lazily loaded SDKs in a background thread after startup (see lazy_imports.py)
+LAZY_PRELOAD = os.getenv("LAZY_PRELOAD", "1") == "1"
+# Pinned Google API discovery documents (<api>.<version>.json); see google_clients.py
+DISCOVERY_DIR = Path(os.getenv("DISCOVERY_DIR", Path(__file__).resolve().parent / "discovery"))
+# Queue calendar inserts during a webhook run and send them as one batch request (see calendar_batch.py)
+CALENDAR_BATCH = os.getenv("CALENDAR_BATCH", "0") == "1"
+CALENDAR_BATCH_MAX = int(os.getenv("CALENDAR_BATCH_MAX", "50"))
 # Defaults — override with environment variables
 
 if IS_WINDOWS:
@@ -99,15 +134,73 @@ if APP_ENV == "gcs":
     LAST_HISTORY_FILE = f"gs://{STATE_BUCKET}/state/last_history_id.json"
     EMAIL_OUT_DIR = str(DEFAULT_DIR / "emails")
     FAILED_FILE = f"gs://{STATE_BUCKET}/state/failed_ids.json"
+    THREAD_STATE_DIR = f"gs://{STATE_BUCKET}/state/threads"
+    EVENT_INDEX_FILE = f"gs://{STATE_BUCKET}/state/event_index.json"
+    CALENDAR_MIRROR_FILE = f"gs://{STATE_BUCKET}/state/calendar_mirror.json"
+    OUTBOX_FILE = f"gs://{STATE_BUCKET}/state/outbox.json"
+    STATE_SQLITE_SNAPSHOT = f"gs://{STATE_BUCKET}/state/state.db"
+    PROCESSED_SET_FILE = f"gs://{STATE_BUCKET}/state/processed_ids.bin"
 else:
     # local / container 
     PROCESSED_FILE = DEFAULT_DIR / "processed_ids.json"
     LAST_HISTORY_FILE = DEFAULT_DIR / "last_history_id.json"
     EMAIL_OUT_DIR =  DEFAULT_DIR/ "emails"
     FAILED_FILE = Path(os.getenv("FAILED_FILE", str(DEFAULT_DIR / "failed_ids.json")))
+    THREAD_STATE_DIR = DEFAULT_DIR / "threads"
+    EVENT_INDEX_FILE = DEFAULT_DIR / "event_index.json"
+    CALENDAR_MIRROR_FILE = DEFAULT_DIR / "calendar_mirror.json"
+    OUTBOX_FILE = DEFAULT_DIR / "outbox.json"
+    STATE_SQLITE_SNAPSHOT = os.getenv("STATE_SQLITE_SNAPSHOT", "")
+    PROCESSED_SET_FILE = DEFAULT_DIR / "processed_ids.bin"
 
 LAST_STATE_FILE = LAST_HISTORY_FILE
 
+# Incremental per-thread analysis (thread_state.py): only the newest message goes to the LLM
+INCREMENTAL_ANALYSIS = os.getenv("INCREMENTAL_ANALYSIS", "0") == "1"
+THREAD_ANALYSIS_ENGINE = os.getenv("THREAD_ANALYSIS_ENGINE", "llm").lower()  # llm / rules
+# Created calendar events kept in the idempotency index (event_index.py); oldest dropped first
+EVENT_INDEX_MAX = int(os.getenv("EVENT_INDEX_MAX", "5000"))
+# Check the owner's freebusy before booking (availability.py): rolling window + refresh TTL
+AVAILABILITY_CHECK = os.getenv("AVAILABILITY_CHECK", "0") == "1"
+AVAILABILITY_WINDOW_DAYS = float(os.getenv("AVAILABILITY_WINDOW_DAYS", "14"))
+AVAILABILITY_TTL_S = float(os.getenv("AVAILABILITY_TTL_S", "300"))
+# Local mirror of the primary calendar kept with events.list sync tokens (calendar_mirror.py)
+CALENDAR_MIRROR = os.getenv("CALENDAR_MIRROR", "0") == "1"
+CALENDAR_MIRROR_MIN_SYNC_S = float(os.getenv("CALENDAR_MIRROR_MIN_SYNC_S", "30"))
+CALENDAR_MIRROR_KEEP_DAYS = float(os.getenv("CALENDAR_MIRROR_KEEP_DAYS", "30"))
+CALENDAR_MIRROR_MAX_EVENT_S = float(os.getenv("CALENDAR_MIRROR_MAX_EVENT_S", str(7 * 86400)))
+# Queue send_reply mails and deliver them from a background worker (outbox.py)
+MAIL_OUTBOX = os.getenv("MAIL_OUTBOX", "0") == "1"
+OUTBOX_RATE_PER_S = float(os.getenv("OUTBOX_RATE_PER_S", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_SENT_MAX = int(os.getenv("OUTBOX_SENT_MAX", "5000"))
+# Local journals of the webhook runs' pending state changes, one file per run next to this path (state_session.py)
+STATE_JOURNAL_FILE = Path(os.getenv("STATE_JOURNAL_FILE", str(Path(tempfile.gettempdir()) / "meeting_helper_state_journal.jsonl")))
+# A run journal left by another host is replayed once it is this old (same host: once its process is gone)
+STATE_JOURNAL_ORPHAN_S = float(os.getenv("STATE_JOURNAL_ORPHAN_S", "900"))
+# State store backend: json (blobs via state_manager_bucket) / sqlite (state_sqlite.py)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json").lower()
+STATE_SQLITE_PATH = Path(os.getenv("STATE_SQLITE_PATH", str((Path(tempfile.gettempdir()) if APP_ENV == "gcs" else DEFAULT_DIR) / "state.db")))
+STATE_SQLITE_WAL = os.getenv("STATE_SQLITE_WAL", "1") == "1"
+# Refuse to start on a local database that no longer matches STATE_SQLITE_SNAPSHOT (else log an error)
+STATE_SQLITE_STRICT = os.getenv("STATE_SQLITE_STRICT", "1") == "1"
+# Processed message ids on the json backend (processed_set.py): exact recent ids + Bloom filter for older ones
+PROCESSED_RETENTION_DAYS = float(os.getenv("PROCESSED_RETENTION_DAYS", "14"))
+PROCESSED_RING_MAX = int(os.getenv("PROCESSED_RING_MAX", "20000"))
+PROCESSED_BLOOM_CAPACITY = int(os.getenv("PROCESSED_BLOOM_CAPACITY", "100000"))
+PROCESSED_BLOOM_FP = float(os.getenv("PROCESSED_BLOOM_FP", "0.001"))
+# Failed messages (failure_journal.py): append-only local journal folded into FAILED_FILE
+FAILURE_JOURNAL_FILE = Path(os.getenv("FAILURE_JOURNAL_FILE", str((Path(tempfile.gettempdir()) if APP_ENV == "gcs" else DEFAULT_DIR) / "failed_ids.journal.jsonl")))
+FAILURE_COMPACT_RECORDS = int(os.getenv("FAILURE_COMPACT_RECORDS", "100"))
+FAILED_MAX = int(os.getenv("FAILED_MAX", "200"))
+DEAD_LETTER_MAX = int(os.getenv("DEAD_LETTER_MAX", "500"))
+# Retry scheduling of failed messages (retry_scheduler.py): exponential backoff with jitter, then dead-letter
+RETRY_BASE_DELAY_S = float(os.getenv("RETRY_BASE_DELAY_S", "60"))
+RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY_S", str(6 * 3600)))
+RETRY_JITTER = float(os.getenv("RETRY_JITTER", "0.2"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "6"))
+RETRY_BATCH_MAX = int(os.getenv("RETRY_BATCH_MAX", "20"))
+
 
 def reload() -> None:
     """Reload values from environment (call if you modify os.environ at runtime).
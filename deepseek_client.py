@@ -5,6 +5,15 @@ import logging
 import textwrap
 from typing import Optional, Dict, Any
 from datetime import datetime
+from llm_json import (
+    JsonObjectScanner,
+    MEETING_RESPONSE_SCHEMA,
+    coerce_meeting_analysis,
+    decode_json_object,
+    decode_meeting_analysis,
+)
+from token_budget import estimate_tokens, trim_thread, max_tokens_for_schema
+import llm_metrics
 
 logger = logging.getLogger("deepseek_client")
 
@@ -17,53 +26,28 @@ GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")  # or gemini-1.5-fl
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
-import json
+import config_bucket as config
+
+# Offline stand-in for both providers (llm_stub.py)
+LLM_STUB_URL = config.LLM_STUB_URL
+if LLM_STUB_URL:
+    GEMINI_API_KEY = GEMINI_API_KEY or "stub"
+    DEEPSEEK_API_KEY = DEEPSEEK_API_KEY or "stub"
+    DEEPSEEK_API_URL = config.DEEPSEEK_API_URL
+
 import re
 
-def validate_and_parse_response(llm_response: str) -> dict:
-    """Validate and prepare LLM response - improved version"""
-    try:
-        # Attempting first method: Attem to load json directly
-        return json.loads(llm_response)
-    except json.JSONDecodeError:
-        try:
-            # 
-            # Interpret the content if failed to extract json directly
-            start = llm_response.find('{')
-            end = llm_response.rfind('}')
-            
-            if start != -1 and end != -1 and end > start:
-                json_str = llm_response[start:end+1]
-                return json.loads(json_str)
-            else:
-                return None
-                
-        except json.JSONDecodeError as e:
-            return None
-
-# Other way to interpret Json
-def validate_and_parse_response_v2(llm_response: str) -> dict:
-    """更健壮的JSON解析版本"""
-    # Clean the response
-    cleaned_response = llm_response.strip()
-    
-    # Attemp to interpret in diffrent way
-    strategies = [
-        # Exctra directly
-        lambda: json.loads(cleaned_response),
-        # Exctra the outer layer
-        lambda: json.loads(re.search(r'\{[^{}]*\}', cleaned_response).group()),
-        # 
-        lambda: json.loads(re.search(r'\{.*\}', cleaned_response, re.DOTALL).group())
-    ]
-    
-    for strategy in strategies:
-        try:
-            return strategy()
-        except (json.JSONDecodeError, AttributeError):
-            continue
-    
-    return {"error": "Could not parse valid JSON from response"}
+# Expected size (tokens) of each output field's value; sizes max_tokens for the call
+MEETING_OUTPUT_FIELDS = {
+    "meeting_intent": 2,
+    "meeting_subject": 24,
+    "meeting_time": 8,
+    "attendees": 80,
+    "confidence": 2,
+    "clarify_needed": 2,
+    "clarify_reason": 60,
+    "reasoning": 120,
+}
 
 # ========== Prompt builder (unchanged, already optimized) ==========
 def build_schedule_prompt(email_body: str, baseline_date: str) -> str:
@@ -168,9 +152,73 @@ f"All responses must be in English. Return ONLY the JSON."
     return prompt
 
 
+def build_fast_prompt(email_body: str, baseline_date: str) -> str:
+    """
+    Short version of build_schedule_prompt for the fast model tier.
+    Covers the common cases only; anything unsure must come back with
+    confidence "low" or clarify_needed=true so the full prompt takes over.
+    """
+    prompt = (
+f"Extract the confirmed meeting from this email THREAD.\n\n"
+f"THREAD (latest message first; quoted history may appear later):\n"
+f"{email_body}\n\n"
+
+f"Work strictly from the participants' messages. Reference date {{baseline_date}} = {baseline_date}.\n"
+f"- Normalize times to 'YYYY-MM-DD HH:MM' (24h; '20:00 PM' → '20:00', '2025年11月4日' → '2025-11-04').\n"
+f"- CONFIRMED only if a different participant accepts a specific proposed datetime "
+f"('ok with me', 'works for me', 'sounds good', '可以', '没问题'); a bare acceptance binds to the latest proposal.\n"
+f"- 'both/either/any works' accepts all offered options → pick the earliest future one.\n"
+f"- A reply with a different time is a counter-proposal → not confirmed.\n"
+f"- If anything is ambiguous, conflicting or in the past: meeting_time='', clarify_needed=true, confidence='low'.\n\n"
+
+f"Return ONLY JSON: meeting_intent (bool), meeting_subject, meeting_time, attendees (emails), "
+f"confidence (high/medium/low), clarify_needed (bool), clarify_reason, reasoning (one sentence)."
+    )
+    return prompt
+
+
+def build_incremental_prompt(thread_state: str, new_message: str, sender: str, baseline_date: str) -> str:
+    """
+    Prompt for one NEW message of a thread whose earlier messages are already
+    summarized in `thread_state` (see thread_state.py). Size does not grow with
+    the thread length.
+    """
+    prompt = (
+f"You maintain the scheduling state of an email thread.\n"
+f"Use {{baseline_date}} = {baseline_date} as the reference for resolving relative dates.\n\n"
+
+f"CURRENT THREAD STATE (from earlier messages):\n"
+f"{thread_state}\n\n"
+
+f"NEW MESSAGE from {sender or 'unknown sender'}:\n"
+f"{new_message}\n\n"
+
+f"Update the state with the NEW MESSAGE using these rules:\n"
+f"- Normalize times to 'YYYY-MM-DD HH:MM' (24h); '20:00 PM' -> '20:00'; '2025年11月4日' -> '2025-11-04'.\n"
+f"- CONFIRMED if a participant other than the proposer accepts a proposed datetime, or two participants state the same datetime.\n"
+f"- A short acceptance without a datetime ('ok with me', '可以', 'works for me') binds to the LATEST proposal.\n"
+f"- Generic acceptance of several options ('both work', 'either is ok') confirms the EARLIEST FUTURE option.\n"
+f"- A different datetime than the proposals is a COUNTER-PROPOSAL and needs acceptance (clarify_needed=true).\n"
+f"- Several options with no pick, or only past candidate times -> clarify_needed=true.\n\n"
+
+f"Output (return ONLY valid JSON):\n"
+f"- meeting_intent: true/false\n"
+f"- meeting_subject: string (empty if unknown)\n"
+f"- meeting_time: confirmed 'YYYY-MM-DD HH:MM' or ''\n"
+f"- attendees: list of emails\n"
+f"- confidence: high/medium/low\n"
+f"- clarify_needed: true/false\n"
+f"- clarify_reason: string (empty if none)\n"
+f"- reasoning: brief explanation\n"
+f"- proposed_times: list of 'YYYY-MM-DD HH:MM' newly proposed in the NEW MESSAGE\n"
+f"- accepted_times: list of 'YYYY-MM-DD HH:MM' the NEW MESSAGE accepts\n\n"
+
+f"All responses must be in English. Return ONLY the JSON."
+    )
+    return prompt
+
 
 
-import google.generativeai as genai
 
 import os
 import json
@@ -178,8 +226,9 @@ from typing import Dict, Any
 import logging # Added logging import for completeness
 
 # Import all necessary libraries
-import google.generativeai as genai
-from google.api_core import exceptions as g_exceptions
+from lazy_imports import lazy_module
+# google.generativeai (grpc, protobuf) is the slowest import of the app; load it on the first Gemini call
+genai = lazy_module("google.generativeai")
 # Import config type for better readability and type hinting
 #from google.generativeai.types import GenerateContentConfig
 
@@ -191,98 +240,26 @@ from google.api_core import exceptions as g_exceptions
 # logger = logging.getLogger(__name__)
 
 from typing import Any, Optional, Tuple,Dict
-import google.generativeai as genai
-from google.api_core import exceptions as g_exceptions
 from typing import Dict, Any
 import os
 from logger_config import logger
 import os
 import json
 
-def parse_json_flex(s: Any) -> Tuple[Optional[dict], Optional[str]]:
-    """
-    Transfer json,string to Dict,return dict or None
-    """
-    # Return direclty if s is dict
-    if isinstance(s, dict):
-        return s, None
-
-    # 2) Transfer s to string
-    s = str(s).strip()
-    if not s:
-        return None, "empty input"
-
-    # 3) Remove the JSON code block fences
-    m = re.search(r"```json\s*([\s\S]*?)\s*```", s, re.IGNORECASE)
-    if m:
-        s = m.group(1).strip()
-
-    # 4) If the outer layer is enclosed in single quotes and the inner content is a JSON string (containing \n, etc.), 
-    #    first restore the inner string to its real form.
-    #    For example ：'{"a": 1, "b": "x"}'  ->  {"a": 1, "b": "x"}
-    if (s.startswith("'") and s.endswith("'")) or (s.startswith('"') and s.endswith('"')):
-        try:
-            # 
-            s_unquoted = ast.literal_eval(s)
-            # Transfer to Json form and read with json.loads
-            return json.loads(s_unquoted), None
-        except Exception as e:
-            #  Adding other ways in here if falied to extraction 
-            pass
-
-    # 5) Load Directly
-    try:
-        return json.loads(s), None
-    except json.JSONDecodeError:
-        # 6) Extract the largest JSON block from the first { to the last } and try again (prevents truncation/extra characters before or after).
-        start = s.find("{")
-        end = s.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            blob = s[start:end+1]
-            try:
-                return json.loads(blob), None
-            except Exception as e:
-                return None, f"json.loads failed after brace-trim: {e}"
-        return None, "no JSON object could be decoded"
-
-def extract_clean_json(ask_gemini_response: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    """
-    Clean the response from gemini LLM and return dict
-    """
-    
-     
-    # 2. Get the original content
-    raw_text = ask_gemini_response.get("content", "").strip()
-    
-    if not raw_text:
-        print("❌ Falied to extract JSON: content is null.")
-        return None
-    match = re.search(r"```json\s*([\s\S]*?)\s*```", raw_text, re.DOTALL)
-    
-    if match:
-        json_string = match.group(1).strip()
-    else:
-        json_string = raw_text
-
-    # 4. Attempt to extract with json format directly
-    try:
-        parsed_data = json.loads(json_string) 
-        print("✅ JSON extract success.")
-        return parsed_data
-    
-    except json.JSONDecodeError as e:
-        print(f"❌ Exctract Json Failed: Not an json format: {e}")
-        # 打印部分内容帮助调试
-        print(f"Part of the content: {json_string[:100]}...")
-        return None
-
-def ask_gemini(prompt: str, max_tokens: int = 2048) -> Dict[str, Any]:
+def ask_gemini(prompt: str, max_tokens: int = 2048, timeout: Optional[float] = None,
+               stream: bool = False, response_schema: Optional[dict] = None,
+               model: Optional[str] = None) -> Dict[str, Any]:
     """
     Call Google Gemini via the official google-generativeai SDK
     using GenerativeModel (compatible with genai >=0.4, no Client required).
+    `timeout` (seconds) is the latency budget given by llm_router.
+    With stream=True the completion is read chunk by chunk and the call returns
+    as soon as the top-level JSON object is closed (see _read_gemini_stream).
+    `response_schema` constrains the output to that JSON schema (structured output).
+    `model` overrides GEMINI_MODEL (the router passes the fast-tier model this way).
     
     Returns:
-        {"status": "success", "content": "<text>"} or {"status": "error", "reason": "..."}
+        {"status": "success", "content": "<text>", "usage": {...}} or {"status": "error", "reason": "..."}
     """
     # 0) Check API KEY
     api_key = GEMINI_API_KEY
@@ -290,14 +267,18 @@ def ask_gemini(prompt: str, max_tokens: int = 2048) -> Dict[str, Any]:
         return {"status": "error", "reason": "GEMINI_API_KEY not set"}
 
     # 1) Model option
-    model_name = GEMINI_MODEL or "gemini-2.5-flash"
+    model_name = model or GEMINI_MODEL or "gemini-2.5-flash"
 
     try:
         # 2) Confgi SDK
-        genai.configure(api_key=api_key)
+        if LLM_STUB_URL:
+            genai.configure(api_key=api_key, transport="rest",
+                            client_options={"api_endpoint": LLM_STUB_URL.rstrip("/")})
+        else:
+            genai.configure(api_key=api_key)
 
         # 3) Create Instance
-        model = genai.GenerativeModel(model_name)
+        gen_model = genai.GenerativeModel(model_name)
 
         # 4) Create paramenter 
         generation_config = {
@@ -306,9 +287,18 @@ def ask_gemini(prompt: str, max_tokens: int = 2048) -> Dict[str, Any]:
             "max_output_tokens": max_tokens,
             "response_mime_type": "application/json",
         }
+        if response_schema:
+            generation_config["response_schema"] = response_schema
 
         # 5) Call LLM 
-        response = model.generate_content(prompt, generation_config=generation_config)
+        request_options = {"timeout": timeout} if timeout else None
+        if stream:
+            response = gen_model.generate_content(prompt, generation_config=generation_config,
+                                                  request_options=request_options, stream=True)
+            return _read_gemini_stream(response, prompt, model_name)
+
+        response = gen_model.generate_content(prompt, generation_config=generation_config,
+                                              request_options=request_options)
         if response.candidates and response.candidates[0].content.parts:
             result = getattr(response.candidates[0].content.parts[0], "text", "").strip()
         else:
@@ -320,7 +310,8 @@ def ask_gemini(prompt: str, max_tokens: int = 2048) -> Dict[str, Any]:
             logger.debug(f"[Gemini raw] {response}")
             return {"status": "error", "reason": "gemini output error"}
         else:
-            return {"status": "success", "content": result}
+            return {"status": "success", "content": result,
+                    "usage": _gemini_usage(response, model_name, prompt, result)}
 
     except Exception as e:
         reason = str(e)
@@ -330,14 +321,86 @@ def ask_gemini(prompt: str, max_tokens: int = 2048) -> Dict[str, Any]:
             return {"status": "error", "reason": "gemini_permission_denied (Invalid API Key/Service Not Enabled)"}
         if "ResourceExhausted" in reason or "429" in reason:
             return {"status": "error", "reason": "gemini_quota_exceeded"}
+        if "DeadlineExceeded" in reason or "504" in reason:
+            return {"status": "error", "reason": "gemini_timeout"}
 
         return {"status": "error", "reason": f"gemini_call_failed: {reason}"}
 
 
-def ask_deepseek(prompt: str, max_tokens: int = 800) -> Optional[str]:
+def _gemini_usage(response, model_name: str, prompt: str, text: str) -> Dict[str, Any]:
+    """
+    Token usage from Gemini's usage_metadata. A stream cut before the last chunk
+    has no counts yet; then the tokens are estimated from the prompt and the text.
+    """
+    meta = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(meta, "prompt_token_count", 0) or 0
+    if prompt_tokens:
+        return {
+            "model": "stub" if LLM_STUB_URL else model_name,
+            "input_tokens": prompt_tokens,
+            "output_tokens": (getattr(meta, "candidates_token_count", 0) or 0)
+                             + (getattr(meta, "thoughts_token_count", 0) or 0),
+            "cached_tokens": getattr(meta, "cached_content_token_count", 0) or 0,
+        }
+    return {
+        "model": "stub" if LLM_STUB_URL else model_name,
+        "input_tokens": estimate_tokens(prompt),
+        "output_tokens": estimate_tokens(text),
+        "cached_tokens": 0,
+        "estimated": True,
+    }
+
+
+def _read_gemini_stream(response, prompt: str, model_name: str) -> Dict[str, Any]:
+    """
+    Consume a streamed Gemini response until the top-level JSON object is complete,
+    then cancel the rest of the stream.
+    """
+    scanner = JsonObjectScanner()
+    last = None
+    for chunk in response:
+        last = chunk
+        try:
+            text = chunk.text
+        except Exception:
+            # chunk without text parts (e.g. safety / finish metadata)
+            continue
+        if scanner.feed(text):
+            break
+
+    cut = scanner.done
+    if cut:
+        # Stop the server side generation (grpc stream); REST streams close when dropped.
+        it = getattr(response, "_iterator", None)
+        if hasattr(it, "cancel"):
+            try:
+                it.cancel()
+            except Exception:
+                pass
+
+    content = (scanner.result or scanner.text()).strip()
+    if not content:
+        return {"status": "error", "reason": "gemini output error"}
+    return {"status": "success", "content": content, "stream_cut": cut,
+            "usage": _gemini_usage(last, model_name, prompt, content)}
+
+
+def ask_deepseek(prompt: str, max_tokens: int = 800, timeout: Optional[float] = 20,
+                 stream: bool = False, response_schema: Optional[dict] = None,
+                 model: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Call DeepSeek chat-completions.
+    With stream=True the SSE stream is read until the top-level JSON object is
+    closed, and the connection is dropped right away.
+    DeepSeek has no schema support; a `response_schema` switches on JSON output mode.
+
+    Returns:
+        {"status": "success", "content": "<text>", "usage": {...}} or {"status": "error", "reason": "..."}
+        (same shape as ask_gemini, so the router can use both).
+    """
     if not DEEPSEEK_API_KEY:
         logger.error("DEEPSEEK_API_KEY not set in environment variables.")
-        return None
+        return {"status": "error", "reason": "DEEPSEEK_API_KEY not set"}
 
     headers = {
         "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
@@ -345,82 +408,105 @@ def ask_deepseek(prompt: str, max_tokens: int = 800) -> Optional[str]:
     }
 
     payload = {
-        "model": "deepseek-chat",
+        "model": model or "deepseek-chat",
         "messages": [
             {"role": "system", "content": "As a meeting assistant, your task is to: analyze the email for scheduling intent, identify potential dates/times, and validate their accuracy."},
             {"role": "user", "content": prompt},
         ],
         "temperature": 0.0,
         "max_tokens": max_tokens,
+        "stream": stream,
     }
+    if stream:
+        # usage arrives in the last chunk
+        payload["stream_options"] = {"include_usage": True}
+    if response_schema:
+        payload["response_format"] = {"type": "json_object"}
 
     try:
-        resp = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=20)
+        resp = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=timeout, stream=stream)
+        if resp.status_code == 429:
+            resp.close()
+            return {"status": "error", "reason": "deepseek_quota_exceeded (429)"}
         resp.raise_for_status()
+        if stream:
+            return _read_deepseek_stream(resp, prompt, payload["model"])
         data = resp.json()
         content = data["choices"][0]["message"]["content"].strip()
         logger.debug(f"[DeepSeek raw] {content}")
-        return content
+        if not content:
+            return {"status": "error", "reason": "deepseek output error"}
+        return {"status": "success", "content": content,
+                "usage": _deepseek_usage(data.get("usage"), prompt, content, payload["model"])}
+    except requests.Timeout:
+        logger.warning("[DeepSeek] timeout")
+        return {"status": "error", "reason": "deepseek_timeout"}
     except Exception as e:
         logger.exception(f"[DeepSeek] Failed: {e}")
-        return None
-
-# -------------------------
-# Parse the response from DeepSeek, preferentially extracting JSON from the text.
-# -------------------------
-
-import json
-import re
-import ast
-
-def parse_llm_json(llm_text: str) -> dict | None:
-    """
-    Safely parses an LLM-outputted JSON string into a Python dictionary.
-
-This function supports the following non-standard formats:
+        return {"status": "error", "reason": f"deepseek_call_failed: {e}"}
 
-Strings wrapped in Markdown ```json code fences.
 
-Extraneous whitespace and newlines.
-
-Single quotes instead of double quotes.
-
-Empty or non-JSON LLM output.
-
-Returns:
-A Python dictionary if parsing is successful, otherwise None.
-    """
-    if not llm_text:
-        return None
-
-    text = llm_text.strip()
+def _deepseek_usage(usage: Optional[dict], prompt: str, text: str, model: str) -> Dict[str, Any]:
+    """Token usage from the response's "usage" block, estimated when it is missing (stream cut)."""
+    model = "stub" if LLM_STUB_URL else model
+    if usage and usage.get("prompt_tokens"):
+        return {
+            "model": model,
+            "input_tokens": usage["prompt_tokens"],
+            "output_tokens": usage.get("completion_tokens", 0),
+            "cached_tokens": usage.get("prompt_cache_hit_tokens", 0),
+        }
+    return {"model": model, "input_tokens": estimate_tokens(prompt),
+            "output_tokens": estimate_tokens(text), "cached_tokens": 0, "estimated": True}
 
-    # Delete the  Markdown ```json 
-    text = re.sub(r"^```json\s*", "", text)
-    text = re.sub(r"```$", "", text)
-    text = text.strip()
 
-    if not text:
-        return None
-
-    # Attempt strict JSON parsing.
+def _read_deepseek_stream(resp, prompt: str, model: str) -> Dict[str, Any]:
+    """Read DeepSeek SSE chunks ("data: {...}") until the JSON object is complete."""
+    scanner = JsonObjectScanner()
+    usage = None
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        pass
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            usage = event.get("usage") or usage
+            choices = event.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content") or ""
+            if scanner.feed(delta):
+                break
+    finally:
+        # Closing the connection cancels the remaining generation
+        resp.close()
+
+    content = (scanner.result or scanner.text()).strip()
+    logger.debug(f"[DeepSeek stream] cut={scanner.done} {content}")
+    if not content:
+        return {"status": "error", "reason": "deepseek output error"}
+    return {"status": "success", "content": content, "stream_cut": scanner.done,
+            "usage": _deepseek_usage(usage, prompt, content, model)}
 
-    # Attempt to parse by first replacing single quotes with double quotes.
-    try:
-        fixed_text = text.replace("'", '"')
-        return json.loads(fixed_text)
-    except json.JSONDecodeError:
-        pass
 
-    # Attempt to parse using ast.literal_eval (for safely evaluating Python literals).
-    try:
-        return ast.literal_eval(text)
-    except (ValueError, SyntaxError):
-        return None
+# -------------------------
+# Provider router: failover / hedging / circuit breaker between Gemini and DeepSeek
+# -------------------------
+from llm_router import Provider, ProviderRouter
+
+LLM_ROUTER = ProviderRouter(
+    [
+        Provider("GEMINI", ask_gemini, config.LLM_BUDGET_MS_GEMINI, available=lambda: bool(GEMINI_API_KEY),
+                 models={"fast": config.LLM_FAST_MODEL_GEMINI}),
+        Provider("DEEPSEEK", ask_deepseek, config.LLM_BUDGET_MS_DEEPSEEK, available=lambda: bool(DEEPSEEK_API_KEY),
+                 models={"fast": config.LLM_FAST_MODEL_DEEPSEEK}),
+    ],
+    primary=LLM_PROVIDER,
+    mode=config.LLM_ROUTING,
+)
 
 import re
 import html
@@ -571,29 +657,79 @@ def post_process_analysis(result: dict, original_email: str, baseline_date: str
 
     return result
 
+def llm_cost(route: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-message cost field: tokens and USD of all LLM attempts behind one result."""
+    return {
+        "usd": round(route.get("cost_usd", 0.0), 6),
+        "input_tokens": route.get("input_tokens", 0),
+        "output_tokens": route.get("output_tokens", 0),
+        "llm_calls": len(route.get("attempts", [])),
+    }
+
+
 def analyze_meeting_schedule(email_body: str, baseline_date: str = "") -> dict:
     """
 End-to-End Meeting Time Analysis Pipeline
+    With LLM_TIERING=1 the fast model answers first (short prompt) and the full
+    model is only asked when that answer is unsure (see analyze_meeting_tiered).
     """
+    if config.LLM_TIERING:
+        return analyze_meeting_tiered(email_body, baseline_date)
+    return _analyze_schedule(email_body, baseline_date, build_schedule_prompt)
+
+
+def escalation_reason(result: dict) -> str:
+    """Why a fast-tier result needs the full model ("" = accept it)."""
+    if result.get("status") == "error":
+        return "parse_failed" if str(result.get("reason", "")).startswith("json_decode_failed") else "llm_error"
+    if result.get("confidence") == "low":
+        return "low_confidence"
+    if result.get("clarify_needed"):
+        return "clarify_needed"
+    return ""
+
+
+def analyze_meeting_tiered(email_body: str, baseline_date: str = "") -> dict:
+    """Fast model + short prompt first; escalate to the full model and prompt when unsure."""
+    fast = _analyze_schedule(email_body, baseline_date, build_fast_prompt, tier="fast")
+    reason = escalation_reason(fast)
+    llm_metrics.incr("tier_fast_calls")
+    if not reason:
+        fast["llm_tier"] = "fast"
+        return fast
+
+    llm_metrics.incr("tier_escalations")
+    llm_metrics.incr(f"tier_escalations_{reason}")
+    logger.info(f"[LLM_TIER] escalating to full model: {reason}")
+    result = _analyze_schedule(email_body, baseline_date, build_schedule_prompt)
+    result["llm_tier"] = "escalated"
+    result["escalation_reason"] = reason
+    # The message paid for both calls
+    fast_cost, cost = fast.get("cost") or {}, result.get("cost") or {}
+    result["cost"] = {k: fast_cost.get(k, 0) + cost.get(k, 0) for k in cost}
+    result["cost"]["usd"] = round(result["cost"].get("usd", 0.0), 6)
+    return result
+
+
+def _analyze_schedule(email_body: str, baseline_date: str, build_prompt, tier: Optional[str] = None) -> dict:
     try:
         if not baseline_date:
             baseline_date = datetime.now().strftime("%Y/%m/%d")
         # 1.Pre
         processed_email = safe_preprocess_email(email_body)
         #processed_email = preprocess_email_content(email_body)
-        print("The contant of email after preprocess:")
-        print(processed_email)
-        print("-" * 50)
+        logger.debug(f"[LLM] email after preprocess ({len(processed_email)} chars):\n{processed_email}")
         
-        # 2.Construct prompt and call DeepSeek
-        prompt = build_schedule_prompt(processed_email, baseline_date)
-        if LLM_PROVIDER == "GEMINI":
-            llm_response = ask_gemini(prompt,max_tokens=4096)
-        else:
-            llm_response = ask_deepseek(prompt,max_tokens=4096)
-        print("LLM Response:")
-        print(llm_response)
-        print("-" * 50)
+        # 2.Construct prompt and call the LLM (routed: failover / hedging)
+        #   Keep the thread within the input token budget and size max_tokens from the output schema
+        prompt_overhead = estimate_tokens(build_prompt("", baseline_date))
+        processed_email = trim_thread(processed_email, config.LLM_INPUT_TOKEN_BUDGET - prompt_overhead)
+        prompt = build_prompt(processed_email, baseline_date)
+        max_tokens = max_tokens_for_schema(MEETING_OUTPUT_FIELDS, headroom=config.LLM_OUTPUT_HEADROOM_TOKENS)
+        llm_response = LLM_ROUTER.ask(prompt, max_tokens=max_tokens, stream=config.LLM_STREAM,
+                                      response_schema=MEETING_RESPONSE_SCHEMA, tier=tier)
+        route = llm_response.get("route", {})
+        logger.debug(f"[LLM] response: {llm_response}")
         if llm_response["status"] == "error":
             return {
                 "status": "error",            # ✅ system error
@@ -603,12 +739,17 @@ End-to-End Meeting Time Analysis Pipeline
                 "confidence": "low",
                 "clarify_needed": True,
                 "clarify_reason": "LLM call failed",
-                "reasoning": llm_response["content"],  # reason for failure
+                "reasoning": llm_response.get("reason", ""),  # reason for failure
+                "reason": llm_response.get("reason", "llm_error"),
+                "llm_provider": route.get("provider"),
+                "llm_latency_ms": route.get("latency_ms"),
+                "cost": llm_cost(route),
             }
         
         # 3. Parse LLM response
-        result = validate_and_parse_response(llm_response["content"])
-        if result == None:
+        result, parse_error = decode_meeting_analysis(llm_response["content"])
+        if result is None:
+            logger.warning(f"[LLM] could not decode response: {parse_error}")
             return {
                     "status": "error",            # ✅ system error
                     "meeting_intent": None,       # 
@@ -617,12 +758,17 @@ End-to-End Meeting Time Analysis Pipeline
                     "confidence": "low",
                     "clarify_needed": True,
                     "clarify_reason": "LLM call failed",
-                    "reasoning": "Json format failed"  # reason for failure
+                    "reasoning": "Json format failed",  # reason for failure
+                    "reason": f"json_decode_failed: {parse_error}",
+                    "cost": llm_cost(route),
             }
         
         # 4. Post
         result = post_process_analysis(result, email_body, baseline_date)
-        result["status"] = "ok"        
+        result["status"] = "ok"
+        result["llm_provider"] = route.get("provider")
+        result["llm_latency_ms"] = route.get("latency_ms")
+        result["cost"] = llm_cost(route)
         return result
         
     except Exception as e:
@@ -637,6 +783,62 @@ End-to-End Meeting Time Analysis Pipeline
             "reasoning": "System error during processing."
         }
 
+# Incremental update: meeting schema + the state changes of the new message
+INCREMENTAL_RESPONSE_SCHEMA = {
+    **MEETING_RESPONSE_SCHEMA,
+    "properties": {
+        **MEETING_RESPONSE_SCHEMA["properties"],
+        "proposed_times": {"type": "array", "items": {"type": "string"}},
+        "accepted_times": {"type": "array", "items": {"type": "string"}},
+    },
+}
+
+
+def analyze_meeting_update(thread_state: str, new_message: str, sender: str, baseline_date: str = "") -> dict:
+    """
+    Analyze only the newest message of a thread against its stored state.
+    Same result fields as analyze_meeting_schedule, plus proposed_times / accepted_times.
+    """
+    if not baseline_date:
+        baseline_date = datetime.now().strftime("%Y/%m/%d")
+    error = {
+        "status": "error",
+        "meeting_intent": None,
+        "meeting_time": "",
+        "attendees": [],
+        "confidence": "low",
+        "clarify_needed": True,
+        "clarify_reason": "LLM call failed",
+    }
+    try:
+        new_message = trim_thread(safe_preprocess_email(new_message), config.LLM_INPUT_TOKEN_BUDGET // 2)
+        prompt = build_incremental_prompt(thread_state, new_message, sender, baseline_date)
+        fields = dict(MEETING_OUTPUT_FIELDS, proposed_times=30, accepted_times=30)
+        max_tokens = max_tokens_for_schema(fields, headroom=config.LLM_OUTPUT_HEADROOM_TOKENS)
+        llm_response = LLM_ROUTER.ask(prompt, max_tokens=max_tokens, stream=config.LLM_STREAM,
+                                      response_schema=INCREMENTAL_RESPONSE_SCHEMA)
+        route = llm_response.get("route", {})
+        if llm_response["status"] == "error":
+            return dict(error, reason=llm_response.get("reason", "llm_error"), llm_provider=route.get("provider"),
+                        cost=llm_cost(route))
+
+        obj, parse_error = decode_json_object(llm_response["content"])
+        result, parse_error = coerce_meeting_analysis(obj) if obj is not None else (None, parse_error)
+        if result is None:
+            logger.warning(f"[LLM] could not decode incremental response: {parse_error}")
+            return dict(error, reason=f"json_decode_failed: {parse_error}", cost=llm_cost(route))
+
+        result = post_process_analysis(result, new_message, baseline_date)
+        result["proposed_times"] = [str(t) for t in obj.get("proposed_times") or []]
+        result["accepted_times"] = [str(t) for t in obj.get("accepted_times") or []]
+        result["status"] = "ok"
+        result["llm_provider"] = route.get("provider")
+        result["llm_latency_ms"] = route.get("latency_ms")
+        result["cost"] = llm_cost(route)
+        return result
+    except Exception as e:
+        return dict(error, reason=f"LLM processing failed: {e}")
+
 # Sam
 if __name__ == "__main__":
     email_content = """Email content here..."""
@@ -645,19 +847,3 @@ if __name__ == "__main__":
     print("Final Result:")
     print(json.dumps(result, indent=2, ensure_ascii=False))
 
-
-import json
-import re
-
-def validate_and_parse_response(llm_response: str) -> dict:
-    """validate and prepare LLM response"""
-
-    try:
-        # Extract JSON object from the response text
-        json_match = re.search(r'\{.*\}', llm_response, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group())
-        else:
-            return {"error": "No valid JSON found in response"}
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON format"}
\ No newline at end of file
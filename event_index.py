@@ -0,0 +1,107 @@
+"""
+Idempotency index of the calendar events this app created.
+
+One record per (threadId, start time), kept in the state store
+(EVENT_INDEX_FILE, local or gs://):
+
+    {
+      "<thread_id>|<start iso>": {
+        "event_id": "...",           # same deterministic id sent in the insert body
+        "meet_link": "https://meet.google.com/...",
+        "msg_id": "...",
+        "created_at": "YYYY-MM-DD HH:MM:SS"
+      }
+    }
+
+create_calendar_event / CalendarBatch look the key up before any Calendar
+call, so a retry or a redelivered push is answered locally. The index is read
+once per process and read again on a miss (another instance may have created
+the event since).
+"""
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import config_bucket as config
+import llm_metrics
+from logger_config import logger
+from state_manager_bucket import ensure_str_path, read_json, update_json
+
+_index: Optional[Dict[str, Dict[str, Any]]] = None
+_lock = threading.Lock()
+
+
+def index_key(thread_id: str, start_iso: str) -> str:
+    return f"{thread_id}|{start_iso}"
+
+
+def _read() -> Dict[str, Dict[str, Any]]:
+    path = ensure_str_path(config.EVENT_INDEX_FILE)
+    try:
+        data = read_json(path)
+    except Exception as e:
+        logger.warning(f"Failed to read event index {path}: {e}")
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def lookup(key: str) -> Optional[Dict[str, Any]]:
+    """Stored record for key, or None if this app has not created that event."""
+    global _index
+    with _lock:
+        if _index is None:
+            _index = _read()
+        rec = _index.get(key)
+        if rec is None:
+            _index.update(_read())
+            rec = _index.get(key)
+    if rec is not None:
+        llm_metrics.incr("event_index_hits")
+    return rec
+
+
+def record(key: str, event_id: str, meet_link: Optional[str] = None, msg_id: Optional[str] = None,
+           save: bool = True) -> None:
+    global _index
+    with _lock:
+        if _index is None:
+            _index = _read()
+        _index[key] = {
+            "event_id": event_id,
+            "meet_link": meet_link,
+            "msg_id": msg_id,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+        }
+    if save:
+        save_index()
+
+
+def save_index() -> None:
+    """Write the index, merged with records other instances saved meanwhile."""
+    global _index
+    path = ensure_str_path(config.EVENT_INDEX_FILE)
+
+    def merge(stored):
+        merged = {**(stored if isinstance(stored, dict) else {}), **ours}
+        # Insertion order == creation order
+        return dict(list(merged.items())[-config.EVENT_INDEX_MAX:])
+
+    with _lock:
+        if _index is None:
+            return
+        ours = dict(_index)
+    try:
+        data = update_json(path, merge)
+    except Exception as e:
+        logger.warning(f"Failed to save event index {path}: {e}")
+        return
+    with _lock:
+        _index = {**data, **{k: v for k, v in _index.items() if k not in data}}
+
+
+def cached_event(rec: Dict[str, Any]) -> Dict[str, Any]:
+    """Event-shaped dict for a stored record (what events().insert would have returned)."""
+    evt = {"id": rec.get("event_id"), "from_index": True}
+    if rec.get("meet_link"):
+        evt["hangoutLink"] = rec["meet_link"]
+    return evt
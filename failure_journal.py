@@ -0,0 +1,241 @@
+"""
+Failed-message state as an append-only journal plus a compacted snapshot.
+
+record_failed_event used to read, parse, trim and rewrite the whole
+failed_ids.json for every failure, and the webhook wrote the same file as a
+list of ids in one place and a list of dicts in another. Now:
+
+  - record_failure() / clear() append one line to FAILURE_JOURNAL_FILE
+    (local JSONL, fsync'ed) -- O(1), no read:
+
+        {"op": "fail",  "msg_id": "...", "reason": "...", "ts": 1700000000.0,
+         "next_retry_at": 1700000060.0}
+        {"op": "dead",  "msg_id": "...", "reason": "...", "ts": 1700000000.0}
+        {"op": "clear", "msg_id": "...", "ts": 1700000000.0}
+
+  - compact() folds the journal into the snapshot (FAILED_FILE, local or gs://)
+    and truncates it. The snapshot is a list of records with one schema:
+
+        {"msg_id": "...", "reason": "...", "attempts": 2,
+         "failed_at": 1700000000.0, "next_retry_at": 1700000000.0,
+         "dead_at": null}
+
+    dead_at is set once the message is dead-lettered (retry_scheduler.py gave
+    up on it); those records are never due again. The most recent FAILED_MAX
+    retrying and DEAD_LETTER_MAX dead-lettered records are kept. maybe_compact() runs it once the journal
+    holds FAILURE_COMPACT_RECORDS lines, or after every run when the snapshot is
+    on GCS (the instance's disk does not outlive it).
+
+  - load() is snapshot + journal replay. Ops carry their timestamp and only
+    apply over older state, so replaying a journal that was already folded
+    (crash mid-compaction) or folding journals of two instances is harmless.
+
+Old failed_ids.json contents (list of ids, list of dicts, dict by id) are read
+as snapshots. With STATE_BACKEND=sqlite the same calls go to the failures table.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import config_bucket as config
+from logger_config import logger
+from state_manager_bucket import ensure_str_path, is_gcs_path, read_json, update_json
+
+_lock = threading.Lock()             # journal file appends / reads / rename
+_compact_lock = threading.Lock()     # one compaction at a time (held across the GCS fold)
+
+
+def _db():
+    if config.STATE_BACKEND != "sqlite":
+        return None
+    import state_sqlite
+    return state_sqlite
+
+
+def _journal_path() -> str:
+    return ensure_str_path(config.FAILURE_JOURNAL_FILE)
+
+
+def normalize(data: Any) -> Dict[str, Dict[str, Any]]:
+    """Snapshot (any historical failed_ids.json format) -> {msg_id: record}."""
+    if isinstance(data, dict):
+        items = [{"msg_id": k, **(v if isinstance(v, dict) else {})} for k, v in data.items()]
+    elif isinstance(data, list):
+        items = [i if isinstance(i, dict) else {"msg_id": i} for i in data]
+    else:
+        items = []
+    out = {}
+    for item in items:
+        msg_id = item.get("msg_id")
+        if not msg_id:
+            continue
+        failed_at = item.get("failed_at")
+        if not isinstance(failed_at, (int, float)):
+            failed_at = 0.0  # legacy entries: older than any journaled op
+        out[str(msg_id)] = {
+            "msg_id": str(msg_id),
+            "reason": item.get("reason"),
+            "attempts": int(item.get("attempts") or 1),
+            "failed_at": float(failed_at),
+            "next_retry_at": float(item.get("next_retry_at") or failed_at),
+            "dead_at": item.get("dead_at"),
+        }
+    return out
+
+
+def _apply(state: Dict[str, Dict[str, Any]], op: Dict[str, Any]) -> None:
+    msg_id, ts = str(op.get("msg_id")), float(op.get("ts") or 0)
+    rec = state.get(msg_id)
+    if op.get("op") == "clear":
+        if rec is not None and rec["failed_at"] <= ts:
+            del state[msg_id]
+    elif op.get("op") in ("fail", "dead"):
+        if rec is not None and rec["failed_at"] >= ts:
+            return  # already folded
+        state[msg_id] = {
+            "msg_id": msg_id,
+            "reason": op.get("reason"),
+            "attempts": (rec["attempts"] if rec else 0) + 1,
+            "failed_at": ts,
+            "next_retry_at": float(op.get("next_retry_at") or ts),
+            "dead_at": ts if op["op"] == "dead" else None,
+        }
+
+
+def _read_ops(path: str) -> List[Dict[str, Any]]:
+    ops = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    break  # torn last line
+    except FileNotFoundError:
+        pass
+    return ops
+
+
+def _append(op: Dict[str, Any]) -> None:
+    path = _journal_path()
+    with _lock:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# ---- public API ----
+def record_failure(msg_id: str, reason: str, next_retry_at: Optional[float] = None) -> None:
+    """Append a failure for msg_id (attempts are counted when folded)."""
+    now = time.time()
+    reason = str(reason)[:200]
+    db = _db()
+    if db:
+        prev = db.get_failure(msg_id)
+        db.record_failure(msg_id, reason, attempts=(prev["attempts"] + 1) if prev else 1,
+                          next_retry_at=next_retry_at or now)
+        return
+    op = {"op": "fail", "msg_id": str(msg_id), "reason": reason, "ts": now}
+    if next_retry_at is not None:
+        op["next_retry_at"] = next_retry_at
+    _append(op)
+
+
+def dead_letter(msg_id: str, reason: str) -> None:
+    """Final failure of msg_id: keep it for inspection, never retry it."""
+    reason = str(reason)[:200]
+    db = _db()
+    if db:
+        db.dead_letter(msg_id, reason)
+        return
+    _append({"op": "dead", "msg_id": str(msg_id), "reason": reason, "ts": time.time()})
+
+
+def clear(msg_id: str) -> None:
+    """msg_id was processed after all: drop its failure."""
+    db = _db()
+    if db:
+        db.clear_failure(msg_id)
+        return
+    _append({"op": "clear", "msg_id": str(msg_id), "ts": time.time()})
+
+
+def load() -> Dict[str, Dict[str, Any]]:
+    """Current failures {msg_id: record}: snapshot + pending journal ops (dead letters included)."""
+    db = _db()
+    if db:
+        return {f["msg_id"]: f for f in db.load_failures() + db.load_dead_letters()}
+    return load_json()
+
+
+def load_json() -> Dict[str, Dict[str, Any]]:
+    """load() for the json backend (also what state_sqlite imports on first open)."""
+    state = normalize(read_json(ensure_str_path(config.FAILED_FILE)))
+    path = _journal_path()
+    with _lock:
+        ops = _read_ops(path + ".compacting") + _read_ops(path)
+    for op in ops:
+        _apply(state, op)
+    return state
+
+
+def failures() -> List[Dict[str, Any]]:
+    """Failures still being retried, oldest retry time first."""
+    return sorted((r for r in load().values() if not r.get("dead_at")), key=lambda r: r["next_retry_at"])
+
+
+def dead_letters() -> List[Dict[str, Any]]:
+    return sorted((r for r in load().values() if r.get("dead_at")), key=lambda r: r["dead_at"])
+
+
+def compact() -> int:
+    """Fold the journal into the snapshot; returns the number of ops folded."""
+    if _db():
+        return 0
+    path = _journal_path()
+    pending = path + ".compacting"
+    with _compact_lock:
+        with _lock:
+            # New appends go to a fresh journal while this one is folded
+            if os.path.exists(path) and not os.path.exists(pending):
+                os.replace(path, pending)
+        ops = _read_ops(pending)
+        if not ops:
+            if os.path.exists(pending):
+                os.remove(pending)
+            return 0
+
+        def fold(stored):
+            state = normalize(stored)
+            for op in ops:
+                _apply(state, op)
+            by_age = sorted(state.values(), key=lambda r: r["failed_at"])
+            retrying = [r for r in by_age if not r.get("dead_at")][-config.FAILED_MAX:]
+            dead = [r for r in by_age if r.get("dead_at")][-config.DEAD_LETTER_MAX:]
+            return sorted(retrying, key=lambda r: r["next_retry_at"]) + dead
+
+        # Outside _lock: record_failure()/clear() keep appending during the upload
+        start = time.perf_counter()
+        snapshot = update_json(ensure_str_path(config.FAILED_FILE), fold)
+        os.remove(pending)
+    logger.info(f"[FAILED] compacted {len(ops)} journal ops -> {len(snapshot)} records "
+                f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return len(ops)
+
+
+def maybe_compact() -> None:
+    if _db():
+        return
+    path = _journal_path()
+    if not os.path.exists(path) and not os.path.exists(path + ".compacting"):
+        return
+    try:
+        if is_gcs_path(ensure_str_path(config.FAILED_FILE)) or os.path.exists(path + ".compacting") or \
+                len(_read_ops(path)) >= config.FAILURE_COMPACT_RECORDS:
+            compact()
+    except Exception as e:
+        logger.warning(f"⚠️ Failure journal compaction failed: {e}")
@@ -1,12 +1,17 @@
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from bs4 import BeautifulSoup
 import base64, json, os
 from logger_config import logger
+from lazy_imports import lazy_module
+from google_clients import build_service, calendar_client
+import threading
 from typing import Dict, Any, List, Optional
 from email.mime.text import MIMEText
 import config_bucket as config
-from googleapiclient.errors import HttpError
+
+# Heavy SDKs, imported on first use (see lazy_imports)
+bs4 = lazy_module("bs4")
+gapi_errors = lazy_module("googleapiclient.errors")
+google_credentials = lazy_module("google.oauth2.credentials")
+google_auth_requests = lazy_module("google.auth.transport.requests")
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
     "https://www.googleapis.com/auth/gmail.send"
@@ -36,7 +41,7 @@ def get_or_create_label(service, label_name: str) -> str:
         }
         created = service.users().labels().create(userId="me", body=body).execute()
         return created["id"]
-    except HttpError as e:
+    except gapi_errors.HttpError as e:
         logger.error(f"Failed to get/create label '{label_name}': {e}")
         raise
 
@@ -65,7 +70,7 @@ def mark_email_as_processed(service, msg_id: str,  label_name: Optional[str] = N
         logger.info(f"✅ Email {msg_id} labeled as {final_label}"
                     + (" and marked read." if also_mark_read else "."))
         return True
-    except HttpError as e:
+    except gapi_errors.HttpError as e:
         logger.warning(f"⚠️ Label email {msg_id} as {final_label} failed: {e}")
         return False
     except Exception as e:
@@ -110,8 +115,6 @@ def clean_to_header(to_value: str) -> str:
     return ", ".join(addrs)
 
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 import os
 import logging
 
@@ -129,9 +132,6 @@ SCOPES = [
 # coding: utf-8
 
 import os
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 
 # ================= CONFIG =================
 # 
@@ -155,11 +155,25 @@ SCOPES = [
 # CLIENT_SECRET = os.getenv("GMAIL_CLIENT_SECRET")
 # REFRESH_TOKEN = os.getenv("GMAIL_REFRESH_TOKEN")
 
+_creds = None
+_creds_lock = threading.Lock()
+
+
 def get_credentials():
     """
     Access secret manager with CLIENT_ID, CLIENT_SECRET 和 REFRESH_TOKEN,
     Will refresh Access Token automatically
+    The credentials are kept per process and only refreshed once the access token expires.
     """
+    global _creds
+    with _creds_lock:
+        if _creds is not None and _creds.valid:
+            return _creds
+        _creds = _refresh_credentials()
+        return _creds
+
+
+def _refresh_credentials():
     if not all([CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN]):
         # Falied to get mandate value
         raise ValueError(
@@ -168,7 +182,7 @@ def get_credentials():
         )
     
     # 1. Create credentials object with access token.
-    creds = Credentials(
+    creds = google_credentials.Credentials(
         token=None,  
         refresh_token=REFRESH_TOKEN,
         token_uri="https://oauth2.googleapis.com/token",
@@ -179,7 +193,7 @@ def get_credentials():
 
     # 2. Refresh Access Token
     try:
-        creds.refresh(Request())
+        creds.refresh(google_auth_requests.Request())
     except Exception as e:
         # Failed to Refresh Token
         raise Exception(f"❌ Refresh Token invalid, create credentials again:{e}")
@@ -194,7 +208,7 @@ def get_gmail_service():
     return Gmail service 和 credentials
     """
     creds = get_credentials()
-    service = build("gmail", "v1", credentials=creds, cache_discovery=False)
+    service = build_service("gmail", "v1", creds)
     logger = logging.getLogger("api_validator")
 
     try:
@@ -203,7 +217,7 @@ def get_gmail_service():
         logger.info(f"✅ Gmail Service Valid: {profile.get('emailAddress')}")
         return service,creds
     
-    except HttpError as e:
+    except gapi_errors.HttpError as e:
         if e.resp.status in (401, 403):
         # 401 Unauthorized or 403 Forbidden
             logger.error(f"❌ Gmail Service invalid:Access Token expired or invalid。HTTP code: {e.resp.status}")
@@ -220,9 +234,10 @@ def get_gmail_service():
 def get_calendar_service():
     """
     Return calendar service and credentials
+    (the shared per-thread client, see google_clients.calendar_client)
     """
     creds = get_credentials()
-    service = build("calendar", "v3", credentials=creds, cache_discovery=False)
+    service = calendar_client(creds)
     return service, creds
 
 
@@ -246,7 +261,7 @@ def extract_text_from_payload(payload: Dict[str, Any]) -> str:
             try:
                 raw = body.get("data", "")
                 html = base64.urlsafe_b64decode(raw).decode("utf-8", errors="ignore")
-                text = BeautifulSoup(html, "html.parser").get_text(separator="\n")
+                text = bs4.BeautifulSoup(html, "html.parser").get_text(separator="\n")
                 parts_text.append(text)
             except Exception as e:
                 logger.warning(f"[decode text/html] Failed: {e}")
@@ -270,32 +285,55 @@ def extract_text_from_payload(payload: Dict[str, Any]) -> str:
     combined = "\n\n".join(p.strip() for p in parts_text if p and p.strip())
     return combined.strip()
 
-def send_reply(service, thread_id, to, subject, body,msg_id=None):
+def build_reply(to, subject, body):
+    """(raw RFC 2822 message, cleaned To) or None when there is no one to send to."""
     msg = MIMEText(body, "plain", "utf-8")
     # 统一清洗 To
     to_clean = clean_to_header(to)
     if not to_clean:
         # give up if no valid recipient
         logger.warning("send_reply: Cancelled if receiver is null.")
-        return False
+        return None
     
     recipients = [e.strip() for e in to_clean.split(",") if e.strip()]
     recipients = [r for r in recipients if r.lower() != MY_EMAIL]
     if not recipients:
         logger.info("📭 Return if no recepients.")
-        return False
+        return None
     msg["To"] = to_clean
     msg["Subject"] = subject
     raw = base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")
+    return raw, to_clean
+
+
+def deliver_reply(service, thread_id, raw, to_clean) -> None:
+    """messages.send; raises on failure."""
+    body = {"raw": raw}
+    if thread_id:
+        body["threadId"] = thread_id
+    service.users().messages().send(userId="me", body=body).execute()
+    logger.info(f"📤 Replied {thread_id} -> {to_clean}")
+
+
+def send_reply(service, thread_id, to, subject, body,msg_id=None, template="reply"):
+    """
+    Reply on the thread. With MAIL_OUTBOX=1 the mail is queued in the outbox
+    (deduplicated by thread/template/content, sent by a background worker) and
+    True means "queued".
+    """
+    built = build_reply(to, subject, body)
+    if not built:
+        return False
+    raw, to_clean = built
+    if config.MAIL_OUTBOX:
+        import outbox
+        try:
+            return outbox.enqueue(thread_id, template, raw, to_clean, msg_id=msg_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Outbox unavailable ({e}), sending {template} mail directly")
     try:
         # === 发送回复 ===
-        service.users().messages().send(
-            userId="me",
-            body={"raw": raw, "threadId": thread_id}
-        ).execute()
-        logger.info(f"📤 Replied {thread_id} -> {to_clean}")
-
-        
+        deliver_reply(service, thread_id, raw, to_clean)
         return True
 
     except Exception as e:
@@ -404,14 +442,13 @@ def fetch_latest_messages(
     return results
 
 import time
-import googleapiclient.errors
 def with_backoff(fn, *args, **kwargs):
     
     delay = 1.0
     for i in range(6):
         try:
             return fn(*args, **kwargs).execute()
-        except googleapiclient.errors.HttpError as e:
+        except gapi_errors.HttpError as e:
             status = getattr(e, "status_code", None) or getattr(e.resp, "status", None)
             msg = str(e)
             if status in (403, 429, 500, 503) or "quotaExceeded" in msg:
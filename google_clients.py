@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Google API clients built from discovery documents parsed once per process.
+
+googleapiclient.discovery.build() locates, reads and json-parses the discovery
+document on every call (the calendar document alone is large). Here each
+document is loaded once and clients are built with build_from_document, with
+no network access:
+
+  1) DISCOVERY_DIR/<api>.<version>.json   (pinned copies, e.g. exported into the image)
+  2) the static document bundled with google-api-python-client (pinned in requirements.txt)
+
+shared_service() / calendar_client() hand out one long-lived client per thread
+(httplib2 connections are not thread-safe) on top of the caller's credentials;
+AuthorizedHttp refreshes the token when it expires.
+
+    python google_clients.py --export      # write the bundled documents to DISCOVERY_DIR
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Any, Dict
+
+import config_bucket as config
+from lazy_imports import lazy_module
+from logger_config import logger
+
+gapi_discovery = lazy_module("googleapiclient.discovery")
+gapi_discovery_cache = lazy_module("googleapiclient.discovery_cache")
+google_auth_httplib2 = lazy_module("google_auth_httplib2")
+httplib2 = lazy_module("httplib2")
+
+# The API versions this app talks to
+APIS = (("gmail", "v1"), ("calendar", "v3"))
+
+_docs: Dict[tuple, Dict[str, Any]] = {}
+_docs_lock = threading.Lock()
+_local = threading.local()
+
+# Socket timeout (s) of the shared clients' HTTP connections
+HTTP_TIMEOUT_S = float(os.getenv("GOOGLE_HTTP_TIMEOUT_S", "30"))
+
+
+def _read_discovery_doc(api: str, version: str) -> str:
+    path = os.path.join(config.DISCOVERY_DIR, f"{api}.{version}.json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    doc = gapi_discovery_cache.get_static_doc(api, version)
+    if doc is None:
+        raise FileNotFoundError(f"No discovery document for {api} {version} in {config.DISCOVERY_DIR} "
+                                f"or in google-api-python-client")
+    return doc
+
+
+def load_discovery_doc(api: str, version: str) -> Dict[str, Any]:
+    """Parsed discovery document, loaded on first use and kept for the process lifetime."""
+    key = (api, version)
+    doc = _docs.get(key)
+    if doc is None:
+        with _docs_lock:
+            doc = _docs.get(key)
+            if doc is None:
+                start = time.perf_counter()
+                doc = json.loads(_read_discovery_doc(api, version))
+                _docs[key] = doc
+                logger.info(f"[DISCOVERY] {api} {version} loaded in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return doc
+
+
+def load_all() -> None:
+    for api, version in APIS:
+        load_discovery_doc(api, version)
+
+
+def build_service(api: str, version: str, credentials) -> Any:
+    """Same as build(api, version, credentials=...) but from the already parsed document."""
+    return gapi_discovery.build_from_document(load_discovery_doc(api, version), credentials=credentials)
+
+
+def shared_service(api: str, version: str, credentials) -> Any:
+    """
+    Client for this thread, built once and reused for later calls with the same
+    credentials object (a new credentials object gets a new client).
+    """
+    services = getattr(_local, "services", None)
+    if services is None:
+        services = _local.services = {}
+    cached = services.get((api, version))
+    if cached is not None and cached[0] is credentials:
+        return cached[1]
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT_S))
+    service = gapi_discovery.build_from_document(load_discovery_doc(api, version), http=http)
+    services[(api, version)] = (credentials, service)
+    return service
+
+
+def calendar_client(credentials) -> Any:
+    return shared_service("calendar", "v3", credentials)
+
+
+def export_discovery_docs(directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    for api, version in APIS:
+        doc = gapi_discovery_cache.get_static_doc(api, version)
+        if doc is None:
+            logger.warning(f"[DISCOVERY] no bundled document for {api} {version}")
+            continue
+        path = os.path.join(directory, f"{api}.{version}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(doc)
+        logger.info(f"[DISCOVERY] wrote {path}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Google API discovery documents")
+    ap.add_argument("--export", action="store_true", help="write the bundled documents to DISCOVERY_DIR")
+    ap.add_argument("--dir", default=str(config.DISCOVERY_DIR))
+    args = ap.parse_args()
+    if args.export:
+        export_discovery_docs(args.dir)
+    else:
+        load_all()
@@ -0,0 +1,82 @@
+"""
+Deferred imports for the heavy third-party modules.
+
+Cloud Run cold starts pay for every import done while app_safe loads, before
+the first push can be handled. Modules declared with lazy_module() are only
+imported on first attribute access:
+
+    dateparser = lazy_module("dateparser")
+    ...
+    dateparser.parse(text)          # real import happens here, once
+
+The time each lazy module took to load is kept (import_timings()) and logged.
+preload() imports them in a background thread right after startup, so the
+first request usually finds them loaded without having waited for them.
+"""
+import importlib
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from logger_config import logger
+
+_registry: Dict[str, "LazyModule"] = {}
+_timings: Dict[str, float] = {}
+_lock = threading.RLock()
+
+
+class LazyModule:
+    """Stand-in for a module; imports it on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    ms = (time.perf_counter() - start) * 1000
+                    _timings[self._name] = round(ms, 1)
+                    logger.info(f"[LAZY_IMPORT] {self._name} loaded in {ms:.0f} ms")
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_module(name: str) -> LazyModule:
+    with _lock:
+        if name not in _registry:
+            _registry[name] = LazyModule(name)
+        return _registry[name]
+
+
+def preload(names: Optional[Iterable[str]] = None, background: bool = True) -> Optional[threading.Thread]:
+    """Import the given (default: all declared) lazy modules, in a daemon thread by default."""
+    def run():
+        for name in list(names or _registry):
+            try:
+                lazy_module(name)._load()
+            except Exception as e:
+                logger.warning(f"[LAZY_IMPORT] preload of {name} failed: {e}")
+
+    if not background:
+        run()
+        return None
+    t = threading.Thread(target=run, name="lazy-preload", daemon=True)
+    t.start()
+    return t
+
+
+def import_timings() -> Dict[str, float]:
+    """{module: load time in ms} for the lazy modules loaded so far."""
+    with _lock:
+        return dict(_timings)
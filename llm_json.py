@@ -0,0 +1,220 @@
+"""
+JSON helpers for LLM output.
+
+JsonObjectScanner finds the first top-level JSON object in text that arrives
+in chunks (streamed completions). It keeps only a little state between
+chunks (depth, inside-string, escape), so every character is looked at once.
+
+decode_meeting_analysis() is the one decoder for the meeting-analysis
+response: one raw_decode pass from the first '{' (stops at the end of the
+object, trailing text is never read), then field validation into a
+MeetingAnalysis dict. MEETING_RESPONSE_SCHEMA is
+sent to providers that support schema-constrained output, in which case the
+scan finds the object at offset 0.
+"""
+import json
+import re
+from typing import Any, List, Optional, Tuple, TypedDict
+
+
+class MeetingAnalysis(TypedDict):
+    meeting_intent: bool
+    meeting_subject: str
+    meeting_time: str          # "YYYY-MM-DD HH:MM" or ""
+    attendees: List[str]
+    confidence: str            # high / medium / low
+    clarify_needed: bool
+    clarify_reason: str
+    reasoning: str
+
+
+# Response schema (OpenAPI subset) for Gemini response_schema
+MEETING_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "meeting_intent": {"type": "boolean"},
+        "meeting_subject": {"type": "string"},
+        "meeting_time": {"type": "string"},
+        "attendees": {"type": "array", "items": {"type": "string"}},
+        "confidence": {"type": "string", "enum": ["high", "medium", "low"]},
+        "clarify_needed": {"type": "boolean"},
+        "clarify_reason": {"type": "string"},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["meeting_intent", "meeting_time", "confidence", "clarify_needed"],
+}
+
+_STRUCTURAL_RE = re.compile(r'[{}"\\]')
+_DECODER = json.JSONDecoder()
+_CONFIDENCE = ("high", "medium", "low")
+_MEETING_TIME_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})[ T](\d{1,2}):(\d{2})")
+
+
+class JsonObjectScanner:
+    """
+    Feed text chunks; feed() returns the complete top-level object text
+    as soon as its closing brace arrives, otherwise None.
+
+        scanner = JsonObjectScanner()
+        for chunk in stream:
+            obj_text = scanner.feed(chunk)
+            if obj_text:
+                break   # stop reading (and paying for) the rest of the stream
+    """
+
+    def __init__(self):
+        self._buf = []
+        self._start = -1      # offset of the opening '{' in the joined text
+        self._offset = 0      # offset of the current chunk in the joined text
+        self._depth = 0
+        self._in_string = False
+        self._skip = -1       # offset of a character escaped by a backslash
+        self.result: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None
+
+    def text(self) -> str:
+        return "".join(self._buf)
+
+    def feed(self, chunk: str) -> Optional[str]:
+        if self.result is not None or not chunk:
+            return self.result
+        self._buf.append(chunk)
+        base = self._offset
+        self._offset += len(chunk)
+
+        # Only structural characters matter; the regex skips everything else in C.
+        for m in _STRUCTURAL_RE.finditer(chunk):
+            pos = base + m.start()
+            if pos == self._skip:
+                continue
+            ch = m.group()
+            if self._start < 0:
+                if ch == "{":
+                    self._start = pos
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if ch == "\\":
+                    self._skip = pos + 1
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.result = self.text()[self._start:pos + 1]
+                    return self.result
+        return None
+
+
+def find_json_object(text: str) -> Optional[str]:
+    """First balanced top-level {...} in text (single scan), or None."""
+    scanner = JsonObjectScanner()
+    return scanner.feed(text)
+
+
+def decode_json_object(raw: Any) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Decode the first JSON object in an LLM response.
+    Handles code fences, leading/trailing prose and strings inside the object.
+    Returns (dict, None) or (None, error).
+    """
+    if isinstance(raw, dict):
+        return raw, None
+    text = str(raw or "")
+    if not text.strip():
+        return None, "empty input"
+
+    # raw_decode parses one value starting at the first '{' and stops at its end,
+    # so leading prose, code fences and trailing text cost nothing extra.
+    start = text.find("{")
+    if start < 0:
+        return None, "no JSON object found"
+    error = None
+    while start >= 0:
+        try:
+            obj, _ = _DECODER.raw_decode(text, start)
+        except json.JSONDecodeError as e:
+            error = e
+            start = text.find("{", start + 1)
+            if error.pos > start >= 0:
+                # the next '{' is inside the object that just failed, so it cannot be the start
+                start = text.find("{", error.pos)
+            continue
+        if isinstance(obj, dict):
+            return obj, None
+        start = text.find("{", start + 1)
+    return None, f"invalid JSON: {error}"
+
+
+def _as_bool(v: Any) -> Optional[bool]:
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.strip().lower() in ("true", "false", "yes", "no"):
+        return v.strip().lower() in ("true", "yes")
+    if v is None:
+        return None
+    if isinstance(v, (int, float)):
+        return bool(v)
+    return None
+
+
+def _as_str(v: Any) -> str:
+    return "" if v is None else str(v).strip()
+
+
+def coerce_meeting_analysis(obj: dict) -> Tuple[Optional[MeetingAnalysis], Optional[str]]:
+    """Validate/normalize the decoded fields. Unknown keys are dropped."""
+    if not isinstance(obj, dict):
+        return None, f"expected object, got {type(obj).__name__}"
+
+    intent = _as_bool(obj.get("meeting_intent"))
+    if intent is None:
+        return None, "meeting_intent missing or not a boolean"
+
+    clarify = _as_bool(obj.get("clarify_needed"))
+    if clarify is None:
+        clarify = False
+
+    meeting_time = _as_str(obj.get("meeting_time"))
+    m = _MEETING_TIME_RE.match(meeting_time)
+    if m:
+        y, mo, d, h, mi = m.groups()
+        meeting_time = f"{y}-{int(mo):02d}-{int(d):02d} {int(h):02d}:{mi}"
+
+    attendees = obj.get("attendees") or []
+    if isinstance(attendees, str):
+        attendees = [a for a in re.split(r"[,;\s]+", attendees) if a]
+    if not isinstance(attendees, list):
+        attendees = []
+
+    confidence = _as_str(obj.get("confidence")).lower()
+    if confidence not in _CONFIDENCE:
+        confidence = "low"
+
+    result: MeetingAnalysis = {
+        "meeting_intent": intent,
+        "meeting_subject": _as_str(obj.get("meeting_subject")),
+        "meeting_time": meeting_time,
+        "attendees": [_as_str(a) for a in attendees if _as_str(a)],
+        "confidence": confidence,
+        "clarify_needed": clarify,
+        "clarify_reason": _as_str(obj.get("clarify_reason")),
+        "reasoning": _as_str(obj.get("reasoning")),
+    }
+    return result, None
+
+
+def decode_meeting_analysis(raw: Any) -> Tuple[Optional[MeetingAnalysis], Optional[str]]:
+    """Single-pass decode + validation of a meeting-analysis response."""
+    obj, err = decode_json_object(raw)
+    if err:
+        return None, err
+    return coerce_meeting_analysis(obj)
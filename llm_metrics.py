@@ -0,0 +1,160 @@
+"""
+Per-call LLM cost and latency accounting.
+
+Every provider call (see llm_router) is recorded with provider, model,
+input/output/cached tokens, wall time and estimated cost. Records are kept
+in per-process counters:
+  - totals since process start, per provider/model
+  - a rolling window (LLM_METRICS_WINDOW_S, default 15 min) for recent rates
+snapshot() is exposed by app_safe at /metrics/llm.
+
+Prices are USD per 1M tokens and can be overridden with LLM_PRICING, e.g.
+  LLM_PRICING='{"gemini-2.5-flash": {"input": 0.30, "output": 2.50, "cached": 0.075}}'
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, Optional
+
+from logger_config import logger
+
+
+DEFAULT_PRICING = {
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50, "cached": 0.075},
+    "gemini-2.5-flash-lite": {"input": 0.10, "output": 0.40, "cached": 0.025},
+    "gemini-2.5-pro": {"input": 1.25, "output": 10.00, "cached": 0.31},
+    "gemini-1.5-pro": {"input": 1.25, "output": 5.00, "cached": 0.31},
+    "gemini-1.5-flash": {"input": 0.075, "output": 0.30, "cached": 0.02},
+    "deepseek-chat": {"input": 0.27, "output": 1.10, "cached": 0.07},
+    "stub": {"input": 0.0, "output": 0.0, "cached": 0.0},
+}
+
+WINDOW_S = float(os.getenv("LLM_METRICS_WINDOW_S", "900"))
+
+
+def _load_pricing() -> Dict[str, Dict[str, float]]:
+    pricing = dict(DEFAULT_PRICING)
+    raw = os.getenv("LLM_PRICING")
+    if raw:
+        try:
+            pricing.update(json.loads(raw))
+        except Exception as e:
+            logger.warning(f"Invalid LLM_PRICING, using defaults: {e}")
+    return pricing
+
+
+PRICING = _load_pricing()
+
+
+def estimate_cost(model: Optional[str], input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
+    """USD cost of one call; models without a price cost 0."""
+    price = PRICING.get(model or "")
+    if price is None:
+        return 0.0
+    uncached = max(input_tokens - cached_tokens, 0)
+    return (uncached * price.get("input", 0.0)
+            + cached_tokens * price.get("cached", price.get("input", 0.0))
+            + output_tokens * price.get("output", 0.0)) / 1_000_000
+
+
+class LLMMetrics:
+    def __init__(self, window_s: float = WINDOW_S):
+        self.window_s = window_s
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._counters = defaultdict(int)
+
+    def record_call(self, provider: str, model: Optional[str], status: str, latency_ms: float,
+                    input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0,
+                    cache_hit: bool = False) -> Dict[str, Any]:
+        cost = estimate_cost(model, input_tokens, output_tokens, cached_tokens)
+        rec = {
+            "ts": time.time(),
+            "provider": provider,
+            "model": model,
+            "status": status,
+            "latency_ms": round(latency_ms, 1),
+            "input_tokens": int(input_tokens),
+            "output_tokens": int(output_tokens),
+            "cached_tokens": int(cached_tokens),
+            "cache_hit": bool(cache_hit or cached_tokens > 0),
+            "cost_usd": cost,
+        }
+        key = f"{provider}/{model}"
+        with self._lock:
+            self._recent.append(rec)
+            self._trim(rec["ts"])
+            t = self._totals[key]
+            t["calls"] += 1
+            t["errors"] += status != "success"
+            t["input_tokens"] += rec["input_tokens"]
+            t["output_tokens"] += rec["output_tokens"]
+            t["cached_tokens"] += rec["cached_tokens"]
+            t["cache_hits"] += rec["cache_hit"]
+            t["latency_ms"] += rec["latency_ms"]
+            t["cost_usd"] += cost
+        return rec
+
+    def incr(self, name: str, n: int = 1) -> None:
+        """Named process counters (e.g. local cache hits, escalations)."""
+        with self._lock:
+            self._counters[name] += n
+
+    def _trim(self, now: float) -> None:
+        while self._recent and now - self._recent[0]["ts"] > self.window_s:
+            self._recent.popleft()
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            recent = list(self._recent)
+            totals = {k: dict(v) for k, v in self._totals.items()}
+            counters = dict(self._counters)
+
+        for t in totals.values():
+            for k in ("calls", "errors", "input_tokens", "output_tokens", "cached_tokens", "cache_hits"):
+                t[k] = int(t[k])
+            t["avg_latency_ms"] = round(t["latency_ms"] / t["calls"], 1) if t["calls"] else 0.0
+            t["cost_usd"] = round(t["cost_usd"], 6)
+
+        lat = sorted(r["latency_ms"] for r in recent)
+
+        def pct(p):
+            return lat[min(len(lat) - 1, int(p / 100 * len(lat)))] if lat else None
+
+        return {
+            "uptime_s": round(now - self.started_at, 1),
+            "totals": totals,
+            "counters": counters,
+            "window": {
+                "seconds": self.window_s,
+                "calls": len(recent),
+                "errors": sum(r["status"] != "success" for r in recent),
+                "input_tokens": sum(r["input_tokens"] for r in recent),
+                "output_tokens": sum(r["output_tokens"] for r in recent),
+                "cache_hits": sum(r["cache_hit"] for r in recent),
+                "cost_usd": round(sum(r["cost_usd"] for r in recent), 6),
+                "p50_latency_ms": pct(50),
+                "p95_latency_ms": pct(95),
+            },
+        }
+
+
+METRICS = LLMMetrics()
+
+
+def record_call(*args, **kwargs) -> Dict[str, Any]:
+    return METRICS.record_call(*args, **kwargs)
+
+
+def incr(name: str, n: int = 1) -> None:
+    METRICS.incr(name, n)
+
+
+def snapshot() -> Dict[str, Any]:
+    return METRICS.snapshot()
@@ -0,0 +1,338 @@
+"""
+LLM provider router.
+
+Instead of sending every call to the single backend named by LLM_PROVIDER,
+the router picks a provider per call:
+
+- Every provider gets a latency budget (ms). The budget is handed to the
+  provider as its request timeout.
+- Hedging: if the primary provider is still running after its observed p95
+  latency, a second request goes to the next healthy provider. The first
+  successful answer wins.
+- Failover: when a provider errors or runs out of its budget, the next one is
+  tried with a budget of its own.
+- Circuit breaker: a provider that keeps returning 429 / quota errors or
+  timeouts is skipped until its cooldown has passed, then gets one trial call.
+
+Each call runs on its own daemon thread: a call abandoned after its budget
+(providers get the budget as their timeout, so it ends soon after) never
+holds up the calls that follow. An attempt is settled once, by its result or
+by its timeout, whichever comes first; only that one counts for the breaker.
+
+A call can ask for a model tier (tier="fast"); each provider maps the tier to
+one of its models (Provider.models) and gets it as model=...
+
+Providers are plain callables: fn(prompt, max_tokens=..., timeout=...) that
+return {"status": "success", "content": ...} or {"status": "error", "reason": ...}.
+The router returns the winning response with a "route" record attached
+(provider, latency_ms, hedged, attempts, tokens and cost of all attempts).
+Every provider call is also recorded in llm_metrics.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Optional
+
+import config_bucket as config
+import llm_metrics
+from logger_config import logger
+
+
+# Reasons that count against the circuit breaker (rate limit / quota / timeout)
+_BREAKER_MARKERS = ("429", "quota", "resourceexhausted", "timeout", "timed out", "deadline")
+
+
+def is_breaker_failure(reason: str) -> bool:
+    reason = (reason or "").lower()
+    return any(m in reason for m in _BREAKER_MARKERS)
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive 429/timeout failures.
+    open -> half-open after `cooldown_s`; one trial call decides close/open again.
+    """
+
+    def __init__(self, threshold: int, cooldown_s: float):
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False  # half-open trial call in flight
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown_s:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Could a call go through now (does not take the half-open trial)."""
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self._trial)
+
+    def acquire(self) -> bool:
+        """Permission for one call; in half-open only the first caller gets the trial."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()  # a failed trial re-opens at once
+            self._trial = False
+
+
+class ProviderStats:
+    """Recent latency samples of one provider, used for the hedge threshold."""
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency_ms: float) -> None:
+        with self._lock:
+            self.samples.append(latency_ms)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            data = sorted(self.samples)
+        if not data:
+            return None
+        idx = min(len(data) - 1, int(round(pct / 100.0 * (len(data) - 1))))
+        return data[idx]
+
+
+class _Attempt:
+    """One provider call within ask(); settle() returns True exactly once."""
+
+    def __init__(self, provider: "Provider"):
+        self.provider = provider
+        self.deadline = time.perf_counter() + provider.budget_ms / 1000.0
+        self._settled = False
+        self._lock = threading.Lock()
+
+    def settle(self) -> bool:
+        with self._lock:
+            if self._settled:
+                return False
+            self._settled = True
+            return True
+
+
+class Provider:
+    def __init__(self, name: str, call: Callable[..., Dict[str, Any]], budget_ms: int,
+                 available: Callable[[], bool] = lambda: True, models: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.call = call
+        self.budget_ms = budget_ms
+        self.available = available
+        self.models = models or {}
+        self.breaker = CircuitBreaker(config.LLM_BREAKER_THRESHOLD, config.LLM_BREAKER_COOLDOWN_S)
+        self.stats = ProviderStats()
+
+
+class ProviderRouter:
+    def __init__(self, providers: List[Provider], primary: str, mode: str = "failover"):
+        self.providers = {p.name: p for p in providers}
+        self.primary = primary
+        self.mode = mode
+
+    # -------------------------
+    # Provider selection
+    # -------------------------
+    def candidates(self) -> List[Provider]:
+        """Primary first, then the others; skip unavailable and breaker-open providers."""
+        names = [self.primary] + [n for n in self.providers if n != self.primary]
+        if self.mode == "single":
+            names = names[:1]
+        out = []
+        for name in names:
+            p = self.providers.get(name)
+            if not p or not p.available():
+                continue
+            if not p.breaker.allow():
+                logger.warning(f"[LLM_ROUTE] circuit open for {name}, routing away")
+                continue
+            out.append(p)
+        return out
+
+    def hedge_delay_ms(self, p: Provider) -> float:
+        observed = p.stats.percentile(config.LLM_HEDGE_PERCENTILE)
+        if observed is None or len(p.stats.samples) < config.LLM_HEDGE_MIN_SAMPLES:
+            return config.LLM_HEDGE_DEFAULT_MS
+        return min(observed, p.budget_ms)
+
+    # -------------------------
+    # Calls
+    # -------------------------
+    def _invoke(self, p: Provider, prompt: str, max_tokens: int, tier: Optional[str] = None,
+                attempt: Optional[_Attempt] = None, **kwargs) -> Dict[str, Any]:
+        if tier and p.models.get(tier):
+            kwargs["model"] = p.models[tier]
+        start = time.perf_counter()
+        try:
+            resp = p.call(prompt, max_tokens=max_tokens, timeout=p.budget_ms / 1000.0, **kwargs)
+        except Exception as e:
+            resp = {"status": "error", "reason": f"{p.name.lower()}_call_failed: {e}"}
+        if not isinstance(resp, dict):
+            resp = {"status": "error", "reason": f"{p.name.lower()}_invalid_response"}
+        latency_ms = (time.perf_counter() - start) * 1000
+        usage = resp.get("usage") or {}
+        rec = llm_metrics.record_call(
+            p.name, usage.get("model"), resp.get("status"), latency_ms,
+            input_tokens=usage.get("input_tokens", 0),
+            output_tokens=usage.get("output_tokens", 0),
+            cached_tokens=usage.get("cached_tokens", 0),
+        )
+        resp["_provider"] = p.name
+        resp["_latency_ms"] = latency_ms
+        resp["_cost"] = rec
+
+        if resp.get("status") == "success":
+            p.stats.add(latency_ms)
+        if attempt is not None and not attempt.settle():
+            return resp  # already counted as a timeout by ask()
+        if resp.get("status") == "success":
+            p.breaker.record_success()
+        elif is_breaker_failure(resp.get("reason", "")):
+            p.breaker.record_failure()
+        return resp
+
+    def ask(self, prompt: str, max_tokens: int = 2048, **kwargs) -> Dict[str, Any]:
+        """Route one LLM call. Always returns a response dict with a "route" record."""
+        candidates = self.candidates()
+        if not candidates:
+            return {"status": "error", "reason": "no_llm_provider_available",
+                    "route": {"provider": None, "latency_ms": 0, "hedged": False, "attempts": [],
+                              "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0}}
+
+        start = time.perf_counter()
+        attempts: List[Dict[str, Any]] = []
+        hedged = False
+        winner = None
+        pending: Dict[Future, _Attempt] = {}
+        queue = list(candidates)
+
+        def launch(p: Provider) -> None:
+            attempt = _Attempt(p)
+            fut: Future = Future()
+
+            def run():
+                fut.set_result(self._invoke(p, prompt, max_tokens, attempt=attempt, **kwargs))
+
+            pending[fut] = attempt
+            threading.Thread(target=run, name=f"llm-{p.name.lower()}", daemon=True).start()
+
+        def launch_next() -> Optional[Provider]:
+            """Start the next provider whose breaker lets a call through."""
+            while queue:
+                p = queue.pop(0)
+                if p.breaker.acquire():
+                    launch(p)
+                    return p
+            return None
+
+        primary = launch_next()
+        if primary is None:
+            attempts.append({"provider": None, "status": "error", "reason": "no_llm_provider_available"})
+        hedge_at = start + (self.hedge_delay_ms(primary) / 1000.0 if primary else 0)
+
+        while pending:
+            now = time.perf_counter()
+            can_hedge = self.mode == "hedged" and not hedged and queue
+            next_deadline = min(a.deadline for a in pending.values())
+            wait_until = min(hedge_at, next_deadline) if can_hedge else next_deadline
+            done, _ = wait(list(pending), timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+
+            if not done:
+                now = time.perf_counter()
+                if can_hedge and now >= hedge_at:
+                    # Primary is slower than its p95 -> hedge on the next provider
+                    hedged = True
+                    p = launch_next()
+                    if p is not None:
+                        logger.info(f"[LLM_ROUTE] hedging {primary.name} -> {p.name}")
+                    continue
+                # Budget exhausted: the thread is left to finish on its own (its result is ignored)
+                for fut, attempt in list(pending.items()):
+                    if attempt.deadline <= now and attempt.settle():
+                        pending.pop(fut)
+                        attempts.append({"provider": attempt.provider.name, "status": "timeout",
+                                         "reason": "llm_timeout"})
+                        attempt.provider.breaker.record_failure()
+                    # settle() == False: it completed just now, collected by the next wait()
+            else:
+                for fut in done:
+                    attempt = pending.pop(fut)
+                    resp = fut.result()
+                    rec = resp.pop("_cost")
+                    attempts.append({"provider": attempt.provider.name, "status": resp.get("status"),
+                                     "latency_ms": round(resp["_latency_ms"], 1),
+                                     "reason": resp.get("reason", ""),
+                                     "model": rec["model"],
+                                     "input_tokens": rec["input_tokens"],
+                                     "output_tokens": rec["output_tokens"],
+                                     "cost_usd": rec["cost_usd"]})
+                    if resp.get("status") == "success" and winner is None:
+                        winner = resp
+                if winner is not None:
+                    break
+
+            # Nothing succeeded yet and nothing in flight -> fail over to the next provider
+            if not pending and queue and self.mode != "single":
+                p = launch_next()
+                if p is not None:
+                    logger.warning(f"[LLM_ROUTE] {attempts[-1]['provider']} failed "
+                                   f"({attempts[-1].get('reason')}), failing over to {p.name}")
+
+        total_ms = (time.perf_counter() - start) * 1000
+        if winner is None:
+            last_reason = next((a.get("reason") for a in reversed(attempts) if a.get("reason")), "llm_timeout")
+            winner = {"status": "error", "reason": last_reason or "llm_timeout"}
+            provider = attempts[-1]["provider"] if attempts else None
+        else:
+            provider = winner.pop("_provider")
+            winner.pop("_latency_ms", None)
+
+        winner["route"] = {
+            "provider": provider,
+            "latency_ms": round(total_ms, 1),
+            "hedged": hedged,
+            "attempts": attempts,
+            "input_tokens": sum(a.get("input_tokens", 0) for a in attempts),
+            "output_tokens": sum(a.get("output_tokens", 0) for a in attempts),
+            "cost_usd": sum(a.get("cost_usd", 0.0) for a in attempts),
+        }
+        logger.info(f"[LLM_ROUTE] provider={provider} status={winner.get('status')} "
+                    f"latency={total_ms:.0f}ms hedged={hedged} attempts={len(attempts)}")
+        return winner
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Breaker state and latency percentiles per provider."""
+        return {
+            name: {
+                "breaker": p.breaker.state,
+                "samples": len(p.stats.samples),
+                "p50_ms": p.stats.percentile(50),
+                "p95_ms": p.stats.percentile(95),
+            }
+            for name, p in self.providers.items()
+        }
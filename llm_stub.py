@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Local LLM stub server (no network, no quota).
+
+Stands in for both backends used by deepseek_client:
+  - DeepSeek  POST /v1/chat/completions                     (JSON or SSE stream)
+  - Gemini    POST /v1beta/models/<model>:generateContent    (REST transport)
+              POST /v1beta/models/<model>:streamGenerateContent?alt=sse
+
+Point the app at it with LLM_STUB_URL=http://127.0.0.1:8090 (see config_bucket).
+
+Answers come from, in order:
+  1) canned responses in LLM_STUB_RESPONSES_DIR (*.json: {"match": "<substring of the prompt>", "response": {...}})
+  2) the local rule engine (meeting_rules.analyze_thread_rules) run on the prompt's THREAD
+
+Failure / latency profile (environment):
+  LLM_STUB_LATENCY         fixed:<ms> | uniform:<lo_ms>,<hi_ms> | lognormal:<median_ms>,<sigma>  (default fixed:0)
+  LLM_STUB_429_RATE        fraction of calls answered with 429               (default 0)
+  LLM_STUB_5XX_RATE        fraction of calls answered with 500/503           (default 0)
+  LLM_STUB_MALFORMED_RATE  fraction of calls with broken JSON in the answer  (default 0)
+  LLM_STUB_SEED            random seed for reproducible runs
+
+    python llm_stub.py --port 8090
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from flask import Flask, Response, jsonify, request
+
+from logger_config import logger
+from meeting_rules import analyze_thread_rules
+from token_budget import estimate_tokens
+
+
+_THREAD_RE = re.compile(r"THREAD \(latest message first[^\n]*\n(.*?)\n\nWork strictly", re.DOTALL)
+_BASELINE_RE = re.compile(r"\{baseline_date\} = (\d{4}/\d{2}/\d{2})")
+
+
+class StubProfile:
+    """Latency distribution and fault injection rates."""
+
+    def __init__(self, latency: str = "fixed:0", rate_429: float = 0.0, rate_5xx: float = 0.0,
+                 rate_malformed: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_malformed = rate_malformed
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "StubProfile":
+        seed = os.getenv("LLM_STUB_SEED")
+        return cls(
+            latency=os.getenv("LLM_STUB_LATENCY", "fixed:0"),
+            rate_429=float(os.getenv("LLM_STUB_429_RATE", "0")),
+            rate_5xx=float(os.getenv("LLM_STUB_5XX_RATE", "0")),
+            rate_malformed=float(os.getenv("LLM_STUB_MALFORMED_RATE", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def sample_latency_s(self) -> float:
+        kind, _, args = self.latency.partition(":")
+        vals = [float(v) for v in args.split(",") if v.strip()] or [0.0]
+        with self._lock:
+            if kind == "uniform":
+                ms = self._rng.uniform(vals[0], vals[1] if len(vals) > 1 else vals[0])
+            elif kind == "lognormal":
+                sigma = vals[1] if len(vals) > 1 else 0.5
+                ms = self._rng.lognormvariate(math.log(max(vals[0], 1e-3)), sigma)
+            else:
+                ms = vals[0]
+        return max(ms, 0.0) / 1000.0
+
+    def fault(self) -> Optional[int]:
+        """HTTP status to inject for this call, or None."""
+        r = self.random()
+        if r < self.rate_429:
+            return 429
+        if r < self.rate_429 + self.rate_5xx:
+            return 503 if self.random() < 0.5 else 500
+        return None
+
+
+def load_canned(directory: Optional[str]) -> list:
+    canned = []
+    if not directory:
+        return canned
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        try:
+            with open(path, encoding="utf-8") as f:
+                item = json.load(f)
+            if "match" in item and "response" in item:
+                canned.append(item)
+        except Exception as e:
+            logger.warning(f"[LLM_STUB] skip canned response {path}: {e}")
+    return canned
+
+
+def answer_prompt(prompt: str, canned: list) -> Dict[str, Any]:
+    for item in canned:
+        if item["match"] in prompt:
+            return item["response"]
+    m = _THREAD_RE.search(prompt)
+    thread = m.group(1) if m else prompt
+    b = _BASELINE_RE.search(prompt)
+    return analyze_thread_rules(thread, b.group(1) if b else "")
+
+
+def malform(text: str, rng: float) -> str:
+    """Broken JSON in one of the shapes seen from real models."""
+    if rng < 0.34:
+        return text[: max(1, len(text) // 2)]                       # truncated
+    if rng < 0.67:
+        return text.replace('"', "'")                             # single quotes
+    return "Sure! Here is the analysis:\n```json\n" + text + "\n```\nLet me know."   # prose + fence
+
+
+def create_app(profile: Optional[StubProfile] = None, canned_dir: Optional[str] = None) -> Flask:
+    profile = profile or StubProfile.from_env()
+    canned = load_canned(canned_dir if canned_dir is not None else os.getenv("LLM_STUB_RESPONSES_DIR"))
+    app = Flask("llm_stub")
+    stats = {"calls": 0, "faults": 0, "malformed": 0}
+    stats_lock = threading.Lock()
+
+    def prepare(prompt: str):
+        """Common path: count, sleep, inject faults, build the answer text."""
+        with stats_lock:
+            stats["calls"] += 1
+        time.sleep(profile.sample_latency_s())
+        status = profile.fault()
+        if status:
+            with stats_lock:
+                stats["faults"] += 1
+            return status, None
+        text = json.dumps(answer_prompt(prompt, canned), ensure_ascii=False)
+        if profile.random() < profile.rate_malformed:
+            with stats_lock:
+                stats["malformed"] += 1
+            text = malform(text, profile.random())
+        return None, text
+
+    def chunks(text: str, size: int = 24):
+        for i in range(0, len(text), size):
+            yield text[i:i + size]
+
+    # ---- DeepSeek / OpenAI-style chat completions ----
+    @app.post("/v1/chat/completions")
+    def chat_completions():
+        body = request.get_json(force=True, silent=True) or {}
+        prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        status, text = prepare(prompt)
+        if status:
+            return jsonify({"error": {"message": f"stub injected {status}", "code": status}}), status
+        usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if body.get("stream"):
+            def sse():
+                for piece in chunks(text):
+                    yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": piece}}]}) + "\n\n"
+                yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                                             "usage": usage}) + "\n\n"
+                yield "data: [DONE]\n\n"
+            return Response(sse(), mimetype="text/event-stream")
+
+        return jsonify({
+            "id": "stub", "object": "chat.completion", "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    # ---- Gemini REST ----
+    def gemini_payload(text: str, prompt: str) -> Dict[str, Any]:
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"},
+                            "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": estimate_tokens(prompt),
+                              "candidatesTokenCount": estimate_tokens(text),
+                              "totalTokenCount": estimate_tokens(prompt) + estimate_tokens(text)},
+        }
+
+    @app.post("/v1beta/models/<path:model_action>")
+    def gemini(model_action: str):
+        body = request.get_json(force=True, silent=True) or {}
+        prompt = "\n".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+        status, text = prepare(prompt)
+        if status:
+            names = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+            return jsonify({"error": {"code": status, "message": f"stub injected {status}",
+                                      "status": names.get(status, "UNKNOWN")}}), status
+
+        if model_action.endswith(":streamGenerateContent"):
+            def sse():
+                for piece in chunks(text):
+                    yield "data: " + json.dumps(gemini_payload(piece, prompt), ensure_ascii=False) + "\r\n\r\n"
+            return Response(sse(), mimetype="text/event-stream")
+        return jsonify(gemini_payload(text, prompt))
+
+    @app.get("/stats")
+    def get_stats():
+        with stats_lock:
+            return jsonify(dict(stats))
+
+    @app.get("/healthz")
+    def healthz():
+        return "ok", 200
+
+    return app
+
+
+def start_in_thread(port: int = 0, profile: Optional[StubProfile] = None, canned_dir: Optional[str] = None):
+    """Run the stub in a daemon thread (for benchmarks/harnesses). Returns (server, base_url)."""
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", port, create_app(profile, canned_dir), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local LLM stub server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=int(os.getenv("LLM_STUB_PORT", "8090")))
+    args = ap.parse_args()
+    logger.info(f"LLM stub listening on {args.host}:{args.port}")
+    create_app().run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,166 @@
+"""
+Local rule engine for meeting confirmation.
+
+A deterministic, regex-only version of the confirmation logic described in
+deepseek_client.build_schedule_prompt (proposal + acceptance, generic
+acceptance of several options, counter-proposals). It is not a replacement
+for the LLM; it is used where no network/quota should be spent:
+the LLM stub server (llm_stub.py) and offline runs of the pipeline.
+"""
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from token_budget import split_turns, split_turn_header
+
+
+_DATE_RE = re.compile(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?")
+_TIME_RE = re.compile(
+    r"(上午|下午|晚上)?\s*(\d{1,2})(?:\s*[:：]\s*(\d{2})|\s*(点)(?:\s*(半)|\s*(\d{1,2})\s*分)?)?\s*(am|pm)?(?![\d:])",
+    re.IGNORECASE,
+)
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+# Distance (characters) between a date and its time in the same expression
+_PAIR_WINDOW = 30
+
+_ACCEPT_RE = re.compile(
+    r"\b(?:ok|okay|works? for me|sounds good|confirmed?|agreed?|fine (?:with|for) me|good to talk|"
+    r"yes,? let'?s meet|see you then|i am good)\b"
+    r"|可以|没问题|^\s*行[。！!~～]?\s*$|行啊|行吧|可行|好的|时间可以|就这个时间|那就这么定了",
+    re.IGNORECASE | re.MULTILINE,   # bare 行 only as the whole line (not 进行/银行/行程/旅行)
+)
+_GENERIC_ACCEPT_RE = re.compile(
+    r"\b(?:both|either|any)\b(?:\s+\w+){0,3}?\s+(?:work|works|ok|okay|fine|good)\b"
+    r"|\b(?:ok|okay|fine)\s+(?:with|to|for)\s+(?:both|either|any)\b"
+    r"|都可以|哪个都行",
+    re.IGNORECASE,
+)
+_DECLINE_RE = re.compile(r"\b(?:not available|can't make|cannot make|doesn't work|does not work)\b|不行|不可行|没空",
+                         re.IGNORECASE)
+
+
+def _to_24h(hour: int, ampm: str, cjk_period: str) -> int:
+    ampm = (ampm or "").lower()
+    if ampm == "pm" and hour < 12:
+        return hour + 12
+    if ampm == "am" and hour == 12:
+        return 0
+    if cjk_period in ("下午", "晚上") and hour < 12:
+        return hour + 12
+    return hour
+
+
+def extract_times(text: str) -> List[str]:
+    """Date+time expressions in text as 'YYYY-MM-DD HH:MM', in order of appearance."""
+    out: List[str] = []
+    for d in _DATE_RE.finditer(text or ""):
+        try:
+            date = datetime(int(d.group(1)), int(d.group(2)), int(d.group(3)))
+        except ValueError:
+            continue
+        # Look for the time right before or after the date (date digits masked out)
+        lo = max(0, d.start() - _PAIR_WINDOW)
+        hi = min(len(text), d.end() + _PAIR_WINDOW)
+        window = text[lo:d.start()] + " " * (d.end() - d.start()) + text[d.end():hi]
+        best = None
+        for t in _TIME_RE.finditer(window):
+            period, hour, minute, dian, half, cjk_min, ampm = t.groups()
+            if not (minute or dian or ampm):
+                continue
+            hour = _to_24h(int(hour), ampm, period or "")
+            minute = int(minute or cjk_min or (30 if half else 0))
+            if not (0 <= hour <= 23 and 0 <= minute <= 59):
+                continue
+            dist = abs((lo + t.start()) - d.start())
+            if best is None or dist < best[0]:
+                best = (dist, hour, minute)
+        if best:
+            out.append(f"{date:%Y-%m-%d} {best[1]:02d}:{best[2]:02d}")
+    return list(dict.fromkeys(out))
+
+
+def extract_emails(text: str) -> List[str]:
+    return list(dict.fromkeys(e.lower() for e in _EMAIL_RE.findall(text or "")))
+
+
+def turn_facts(turn: str) -> Dict[str, Any]:
+    """Sender (from the quote header, if any), times, and acceptance cues of one turn."""
+    header, body = split_turn_header(turn)
+    emails = extract_emails(header)
+    sender = emails[0] if emails else None
+    return {
+        "sender": sender,
+        "times": extract_times(body),
+        "accept": bool(_ACCEPT_RE.search(body)) and not _DECLINE_RE.search(body),
+        "generic": bool(_GENERIC_ACCEPT_RE.search(body)),
+    }
+
+
+def _future(times: List[str], baseline_date: str) -> List[str]:
+    base = (baseline_date or "").replace("/", "-")
+    return sorted(t for t in times if t[:10] >= base[:10])
+
+
+def decide(newest: Dict[str, Any], proposal: Optional[Dict[str, Any]], baseline_date: str) -> Dict[str, Any]:
+    """
+    Apply the confirmation rules to the newest turn and the latest earlier proposal.
+    Returns meeting_time / clarify_needed / clarify_reason / reasoning / confidence.
+    """
+    offered = _future(proposal["times"], baseline_date) if proposal else []
+
+    if newest["times"]:
+        same = [t for t in _future(newest["times"], baseline_date) if t in offered]
+        if same:
+            return {"meeting_time": same[0], "clarify_needed": False, "confidence": "high",
+                    "clarify_reason": "", "reasoning": "Two participants stated the same date+time."}
+        if offered:
+            return {"meeting_time": "", "clarify_needed": True, "confidence": "medium",
+                    "clarify_reason": "Counter-proposal without acceptance.",
+                    "reasoning": "Latest reply proposes a different time than the offered options."}
+        return {"meeting_time": "", "clarify_needed": True, "confidence": "medium",
+                "clarify_reason": "Proposed time has not been accepted yet.",
+                "reasoning": "Only one participant stated a time."}
+
+    if offered:
+        if newest["generic"] and len(offered) > 1:
+            return {"meeting_time": offered[0], "clarify_needed": False, "confidence": "high",
+                    "clarify_reason": "",
+                    "reasoning": "Generic acceptance of multiple options; earliest future option selected."}
+        if newest["accept"] and len(offered) == 1:
+            return {"meeting_time": offered[0], "clarify_needed": False, "confidence": "high",
+                    "clarify_reason": "", "reasoning": "Short acceptance bound to the latest proposal."}
+        if newest["accept"]:
+            return {"meeting_time": "", "clarify_needed": True, "confidence": "low",
+                    "clarify_reason": "Multiple times proposed; acceptance does not pick one.",
+                    "reasoning": "Acceptance is ambiguous between several options."}
+        return {"meeting_time": "", "clarify_needed": True, "confidence": "medium",
+                "clarify_reason": "Proposed time(s) have not been accepted.",
+                "reasoning": "No acceptance after the latest proposal."}
+
+    if proposal and proposal["times"]:
+        return {"meeting_time": "", "clarify_needed": True, "confidence": "medium",
+                "clarify_reason": "All candidate times are in the past.",
+                "reasoning": "Proposed times are earlier than the baseline date."}
+    return {"meeting_time": "", "clarify_needed": True, "confidence": "low",
+            "clarify_reason": "No date and time found in the thread.", "reasoning": "No time expression."}
+
+
+def analyze_thread_rules(thread: str, baseline_date: str = "", subject: str = "") -> Dict[str, Any]:
+    """Rule-based meeting analysis of a whole thread (latest message first). Same fields as the LLM."""
+    if not baseline_date:
+        baseline_date = datetime.now().strftime("%Y/%m/%d")
+    facts = [turn_facts(t) for t in split_turns(thread or "")]
+    if not facts:
+        facts = [turn_facts("")]
+    newest = facts[0]
+    proposal = next((f for f in facts[1:] if f["times"]), None)
+
+    result = decide(newest, proposal, baseline_date)
+    any_times = bool(newest["times"] or proposal)
+    result.update({
+        "meeting_intent": any_times,
+        "meeting_subject": subject,
+        "attendees": extract_emails(thread),
+    })
+    return result
@@ -3,15 +3,19 @@ import logging
 import os
 from datetime import datetime
 from deepseek_client import analyze_meeting_schedule
+from thread_state import analyze_thread_incremental
 from gmail_utils import clean_email_address,extract_text_from_payload,send_reply
 from logger_config import logger
 from time_parser import parse_human_time,get_sender_timezone
-from calendar_utils import create_calendar_event,send_meeting_invite
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from calendar_utils import create_calendar_event,send_meeting_invite,get_meet_link
 from update_mail_history import record_failed_event,ensure_failed_file_exists
 import config_bucket as config
+import availability
+import calendar_mirror
+import event_index
+from lazy_imports import lazy_module
 
+pytz = lazy_module("pytz")
 
 TOKEN_FILE = config.TOKEN_FILE
 TOKEN_JSON_ENV = os.getenv("GMAIL_TOKEN_JSON") or os.getenv("TOKEN_JSON")  
@@ -69,7 +73,29 @@ Reason from System Alert: {html.escape(safe_reason)}</p>
 
     return reply_text, reply_html
 
-def process_single_message(msg: dict, service, my_email,creds):
+def _event_created(evt: dict, service, thread_id, msg_id, event_summary, free_time, attendees) -> dict:
+    """Invite (optional) and success result once the calendar event exists."""
+    availability.note_event(evt)
+    meet_link = get_meet_link(evt)
+    # from_index: created by an earlier attempt, which already sent the invite
+    if meet_link and SEND_MEETING_INVITE and not evt.get("from_index"):
+        # Send meeting invite
+        to_for_invite = ", ".join(attendees)
+        send_meeting_invite(service, thread_id, to_for_invite,
+                            f"Meeting Confirmation: {event_summary}", meet_link, free_time, msg_id=msg_id)
+    logger.info(f"✅ Successfully created event for message {msg_id}")
+    return {
+        "status": "success",
+        "msg_id": msg_id,
+        "event_id": evt.get("id"),
+        "summary": event_summary,
+        "meeting_time": free_time,
+        "attendees": attendees,
+        "meet_link": meet_link,
+    }
+
+
+def process_single_message(msg: dict, service, my_email,creds, calendar_batch=None):
     """Process a single Gmail message: analyze, clarify, create calendar event"""
     msg_id = msg.get("id")
     thread_id = msg.get("threadId")
@@ -110,7 +136,12 @@ def process_single_message(msg: dict, service, my_email,creds):
             baseline_date = sent_dt.strftime("%Y/%m/%d")
 
         # ---- 4) Call LLM ----
-        result = analyze_meeting_schedule(body, baseline_date)
+        if config.INCREMENTAL_ANALYSIS and thread_id:
+            # Only the newest message is analyzed against the stored thread state
+            result = analyze_thread_incremental(thread_id, msg_id, body, clean_email_address(sender),
+                                                baseline_date, subject=subject)
+        else:
+            result = analyze_meeting_schedule(body, baseline_date)
         if not result:
             logger.error("Failed to call LLM. Skipping.")
             return {"status": "error", "reason": "llm_failed", "msg_id": msg_id}
@@ -160,7 +191,7 @@ def process_single_message(msg: dict, service, my_email,creds):
             reply_text, reply_html = _compose_clarify_reply(subject, body, reason)
 
             # Send clarification email
-            send_reply(service, thread_id, all_to, reply_subject, reply_text, msg_id=msg_id)
+            send_reply(service, thread_id, all_to, reply_subject, reply_text, msg_id=msg_id, template="clarify")
             logger.info("Clarification email sent, skip follow-up processing")
             return {"status": "Clarify", "reason": clarify_reason or "need_clarification", "msg_id": msg_id}
 
@@ -183,7 +214,7 @@ def process_single_message(msg: dict, service, my_email,creds):
             reply_text, reply_html = _compose_clarify_reply(subject, body, f"invalid or unparsable time. {fmt_hint}")
             # Send clarification email
             to_addr = clean_email_address(sender) or sender
-            send_reply(service, thread_id, to_addr, reply_subject, reply_text, msg_id=msg_id)
+            send_reply(service, thread_id, to_addr, reply_subject, reply_text, msg_id=msg_id, template="invalid_time")
             logger.info("Clarification email (invalid time) sent, skip follow-up processing")
             return {"status": "Clarify", "reason": "invalid_time", "msg_id": msg_id}
 
@@ -207,47 +238,70 @@ def process_single_message(msg: dict, service, my_email,creds):
 
         attendees = sorted(participants) or ([sender_clean.lower()] if sender_clean else [])
 
-        # ---- 8) Initialize Calendar Service ----
-        try:
-            calendar_service = build("calendar", "v3", credentials=creds, cache_discovery=False)
-        except Exception as e:
-            logger.error(f"Failed to initialize Google Calendar service: {e}")
-            return {"status": "error", "reason": "calendar_service_init_failed", "msg_id": msg_id}
-
-        # ---- 9) Create Calendar Event ----
         tz_name = get_sender_timezone(headers, DEFAULT_TZ)
         event_summary = subject or "meeting"
 
-        evt = create_calendar_event(
-            creds=creds,
+        # Same wall time + zone the event will be created with (calendar_utils.prepare_calendar_event)
+        tz = pytz.timezone(tz_name)
+        start_local = tz.localize(dt_obj.replace(tzinfo=None))
+
+        # ---- 7b) Already on the calendar? (local mirror, see calendar_mirror.py) ----
+        if config.CALENDAR_MIRROR:
+            mirror = calendar_mirror.synced(creds)
+            existing = mirror.scheduled(start_local.timestamp(), attendees) if mirror else []
+            if existing:
+                logger.info(f"[MIRROR] event {existing[0]['id']} already scheduled at {free_time} "
+                            f"with {attendees}, skip creating another")
+                return _event_created(calendar_mirror.as_event(existing[0]), service, thread_id, msg_id,
+                                      event_summary, free_time, attendees)
+
+        # ---- 7c) Owner availability (cached freebusy window, see availability.py) ----
+        if config.AVAILABILITY_CHECK:
+            # An event this thread already booked at that time is not a conflict (redelivery / retry)
+            key = event_index.index_key(thread_id, start_local.isoformat())
+            if not event_index.lookup(key):
+                end_local = start_local + availability.EVENT_DURATION
+                busy = availability.conflicts(creds, start_local, end_local)
+                if calendar_batch is not None:
+                    # Slots taken by earlier messages of this run (queued, not inserted yet)
+                    busy = sorted((busy or []) + calendar_batch.conflicts(key, start_local, end_local))
+                if busy:
+                    slots = ", ".join(availability.format_interval(b, tz) for b in busy)
+                    logger.info(f"[FREEBUSY] {free_time} conflicts with {slots}, asking for another time")
+                    reply_subject = f"Please propose another time — {subject}" if subject else "Please propose another time"
+                    reply_text, reply_html = _compose_clarify_reply(
+                        subject, body, f"the calendar is already busy at {free_time} ({slots}). "
+                                       f"Please reply with another time that works.")
+                    to_addr = clean_email_address(sender) or sender
+                    send_reply(service, thread_id, to_addr, reply_subject, reply_text, msg_id=msg_id, template="calendar_conflict")
+                    return {"status": "Clarify", "reason": "calendar_conflict", "msg_id": msg_id}
+
+        # ---- 8) Create Calendar Event (shared calendar client on `creds`, see google_clients) ----
+
+        event_kwargs = dict(
             service_gmail=service,
             thread_id=thread_id,
-            sender=sender,
             subject=subject,
             summary=event_summary,
             start_time=free_time,   # "YYYY-MM-DD HH:MM"
             attendees_emails=attendees,
             tz_name=tz_name,
-            msg_id=msg_id
+            msg_id=msg_id,
         )
 
+        if calendar_batch is not None:
+            # Batch mode: the insert is sent with the rest of the webhook run in CalendarBatch.flush()
+            def on_created(evt):
+                return _event_created(evt, service, thread_id, msg_id, event_summary, free_time, attendees)
+
+            if calendar_batch.add(on_created=on_created, **event_kwargs):
+                return {"status": "queued", "msg_id": msg_id}
+            return {"status": "error", "reason": "create_event_failed", "msg_id": msg_id}
+
+        evt = create_calendar_event(creds=creds, sender=sender, **event_kwargs)
+
         if evt:
-            meet_link = evt.get("hangoutLink") or evt.get("conferenceData", {}).get("entryPoints", [{}])[0].get("uri")
-            if meet_link and SEND_MEETING_INVITE:
-                # Send meeting invite
-                to_for_invite = ", ".join(attendees)
-                send_meeting_invite(service, thread_id, to_for_invite,
-                                    f"Meeting Confirmation: {event_summary}", meet_link, free_time, msg_id=msg_id)
-            logger.info(f"✅ Successfully created event for message {msg_id}")
-            return {
-                "status": "success",
-                "msg_id": msg_id,
-                "event_id": evt.get("id"),
-                "summary": event_summary,
-                "meeting_time": free_time,
-                "attendees": attendees,
-                "meet_link": meet_link,
-            }
+            return _event_created(evt, service, thread_id, msg_id, event_summary, free_time, attendees)
 
         logger.warning("Failed to create calendar event.")
         return {"status": "error", "reason": "create_event_failed", "msg_id": msg_id}
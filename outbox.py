@@ -0,0 +1,269 @@
+"""
+Persistent outbox for send_reply.
+
+With MAIL_OUTBOX=1, send_reply() only builds the message and queues it here
+in memory; message processing waits on neither messages.send nor the state
+store. The webhook calls flush() once at the end of the run, which stores
+everything the run queued in one write. A daemon worker delivers the stored
+queue with its own Gmail client (the caller's is not thread-safe), at most
+OUTBOX_RATE_PER_S mails per second, retrying a failed send with backoff up to
+OUTBOX_MAX_ATTEMPTS times. The response does not wait for delivery: on Cloud
+Run with CPU throttled outside requests the worker continues when the
+instance next gets CPU, or use --no-cpu-throttling.
+
+Each mail is keyed by (threadId, template, content hash). A key that is
+already queued or was sent before is dropped, so a redelivered push does not
+send the same clarification twice.
+
+Queue and sent keys are persisted in the state store (OUTBOX_FILE, local or
+gs://):
+
+    {"pending": [{"key", "thread_id", "template", "raw", "to", "msg_id", "attempts", "next_at",
+                  "claimed_until"}],
+     "sent": {"<key>": "YYYY-MM-DD HH:MM:SS", ...}}     # newest OUTBOX_SENT_MAX kept
+
+Every change (flush, claim, sent, retry) is a read-modify-write of that
+document merged by key (update_json), done outside the queue lock. Instances
+therefore see each other's mails and sent keys, and a worker claims a mail
+(claimed_until) before sending it so two instances do not both deliver it.
+Only stored mails are sent, so a mail is never delivered without being on
+record. Mails stored but not yet sent when an instance stops are delivered by
+the next instance's worker; a failed flush() is retried by the worker.
+"""
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import config_bucket as config
+import llm_metrics
+from logger_config import logger
+from state_manager_bucket import ensure_str_path, read_json, update_json
+
+CLAIM_S = 60.0  # a claimed mail is left alone by other workers this long
+
+_lock = threading.Condition()
+_pending: List[Dict[str, Any]] = []
+_sent: Dict[str, str] = {}
+_unsaved: Dict[str, Dict[str, Any]] = {}  # queued by this process, not stored yet (flush)
+_retry_flush = False  # a flush failed; the worker retries it
+_loaded = False
+_inflight: Optional[str] = None  # key being delivered by this process
+_worker: Optional[threading.Thread] = None
+
+
+def outbox_key(thread_id: Optional[str], template: str, raw: str) -> str:
+    content = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return f"{thread_id or '-'}|{template}|{content}"
+
+
+def _doc(data: Any) -> Dict[str, Any]:
+    """Stored outbox -> {"pending": {key: item}, "sent": {key: ts}}."""
+    data = data if isinstance(data, dict) else {}
+    return {"pending": {i["key"]: i for i in data.get("pending") or [] if isinstance(i, dict) and i.get("key")},
+            "sent": dict(data.get("sent") or {})}
+
+
+def _show(data: Any) -> None:
+    """Take the stored outbox as this process's view (caller holds _lock)."""
+    global _pending, _sent, _loaded
+    doc = _doc(data)
+    _pending = list(doc["pending"].values())
+    _sent = doc["sent"]
+    _loaded = True
+
+
+def _load() -> None:
+    path = ensure_str_path(config.OUTBOX_FILE)
+    try:
+        data = read_json(path)
+    except Exception as e:
+        logger.warning(f"Failed to read outbox {path}: {e}")
+        data = None
+    with _lock:
+        _show(data)
+        if _pending:
+            logger.info(f"[OUTBOX] {len(_pending)} queued mails loaded from {path}")
+
+
+def _update(change: Callable[[Dict[str, Any]], None]) -> None:
+    """Apply change(doc) to the stored outbox (merged by key with other instances' changes)."""
+    def merge(stored):
+        doc = _doc(stored)
+        change(doc)
+        sent = doc["sent"]
+        if len(sent) > config.OUTBOX_SENT_MAX:
+            sent = dict(sorted(sent.items(), key=lambda kv: kv[1])[-config.OUTBOX_SENT_MAX:])
+        return {"pending": list(doc["pending"].values()), "sent": sent}
+
+    data = update_json(ensure_str_path(config.OUTBOX_FILE), merge)
+    with _lock:
+        _show(data)
+        _lock.notify_all()
+
+
+def enqueue(thread_id: Optional[str], template: str, raw: str, to: str, msg_id: Optional[str] = None) -> bool:
+    """Queue one mail in memory (stored by flush()); False if the same mail is already queued or was sent."""
+    key = outbox_key(thread_id, template, raw)
+    with _lock:
+        duplicate = key in _sent or key in _unsaved or any(item["key"] == key for item in _pending)
+        if not duplicate:
+            _unsaved[key] = {"key": key, "thread_id": thread_id, "template": template, "raw": raw,
+                             "to": to, "msg_id": msg_id, "attempts": 0, "next_at": 0.0, "claimed_until": 0.0}
+    if duplicate:
+        llm_metrics.incr("outbox_deduped")
+        logger.info(f"[OUTBOX] duplicate {template} mail for thread {thread_id} dropped")
+        return False
+    llm_metrics.incr("outbox_enqueued")
+    return True
+
+
+def flush() -> int:
+    """Store the mails queued since the last flush (one write) and wake the worker; returns how many."""
+    global _retry_flush
+    with _lock:
+        items = dict(_unsaved)
+    if not items:
+        return 0
+    dropped = 0
+
+    def add(doc):
+        nonlocal dropped
+        dropped = 0
+        for key, item in items.items():
+            if key in doc["sent"] or key in doc["pending"]:
+                dropped += 1  # queued or sent by another instance meanwhile
+            else:
+                doc["pending"][key] = item
+
+    try:
+        _update(add)
+    except Exception:
+        with _lock:
+            _retry_flush = True
+            _lock.notify_all()
+        start_worker()
+        raise
+    with _lock:
+        for key in items:
+            _unsaved.pop(key, None)
+        _retry_flush = False
+    if dropped:
+        llm_metrics.incr("outbox_deduped", dropped)
+    logger.info(f"[OUTBOX] stored {len(items) - dropped} queued mails")
+    start_worker()
+    return len(items) - dropped
+
+
+def _next_due() -> Optional[Dict[str, Any]]:
+    now = time.time()
+    return next((item for item in _pending
+                 if item["next_at"] <= now and item.get("claimed_until", 0.0) <= now), None)
+
+
+def _gmail():
+    from gmail_utils import get_credentials
+    from google_clients import shared_service
+    return shared_service("gmail", "v1", get_credentials())
+
+
+def _deliver(item: Dict[str, Any]) -> bool:
+    from gmail_utils import deliver_reply
+    try:
+        deliver_reply(_gmail(), item["thread_id"], item["raw"], item["to"])
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to send {item['template']} mail for thread {item['thread_id']} "
+                     f"(attempt {item['attempts'] + 1}): {e}")
+        return False
+
+
+def _claim(key: str) -> Optional[Dict[str, Any]]:
+    """Mark key as being sent by this worker; None if it is gone or another worker holds it."""
+    claimed = None
+
+    def claim(doc):
+        nonlocal claimed
+        item = doc["pending"].get(key)
+        now = time.time()
+        if item is None or key in doc["sent"] or item.get("claimed_until", 0.0) > now:
+            claimed = None
+            return
+        item["claimed_until"] = now + CLAIM_S
+        claimed = dict(item)
+
+    _update(claim)
+    return claimed
+
+
+def _finish(key: str, ok: bool) -> None:
+    def finish(doc):
+        item = doc["pending"].get(key)
+        if ok:
+            doc["pending"].pop(key, None)
+            doc["sent"][key] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            return
+        if item is None:
+            return
+        item["attempts"] += 1
+        item["claimed_until"] = 0.0
+        if item["attempts"] >= config.OUTBOX_MAX_ATTEMPTS:
+            doc["pending"].pop(key)
+            logger.error(f"❌ Giving up on {item['template']} mail for thread {item['thread_id']} "
+                         f"after {item['attempts']} attempts")
+        else:
+            item["next_at"] = time.time() + min(300.0, 2.0 ** item["attempts"])
+
+    _update(finish)
+    llm_metrics.incr("outbox_sent" if ok else "outbox_send_failed")
+
+
+def _run() -> None:
+    global _inflight
+    interval = 1.0 / config.OUTBOX_RATE_PER_S
+    if not _loaded:
+        _load()
+    while True:
+        if _retry_flush:
+            try:
+                flush()  # the run's own flush failed
+            except Exception as e:
+                logger.warning(f"⚠️ Outbox flush failed: {e}")
+                time.sleep(30.0)
+        with _lock:
+            item = _next_due()
+            while item is None and not _retry_flush:
+                now = time.time()
+                wait = min((max(i["next_at"], i.get("claimed_until", 0.0)) for i in _pending), default=None)
+                _lock.wait(timeout=None if wait is None else max(0.05, wait - now))
+                item = _next_due()
+            if item is None:
+                continue
+            _inflight = item["key"]
+        try:
+            claimed = _claim(item["key"])
+            if claimed is not None:
+                _finish(claimed["key"], _deliver(claimed))
+        except Exception as e:
+            logger.warning(f"⚠️ Outbox state update failed: {e}")
+            time.sleep(min(30.0, 10 * interval))
+        finally:
+            with _lock:
+                _inflight = None
+                _lock.notify_all()
+        time.sleep(interval)  # rate limit (messages.send = 100 quota units)
+
+
+def start_worker() -> None:
+    global _worker
+    with _lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run, name="mail-outbox", daemon=True)
+        _worker.start()
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {"pending": len(_pending), "unsaved": len(_unsaved), "sent_keys": len(_sent),
+                "worker_alive": bool(_worker and _worker.is_alive())}
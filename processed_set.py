@@ -0,0 +1,251 @@
+"""
+Bounded set of processed message IDs.
+
+processed_ids.json kept every ID ever seen, as a Python set in memory and as a
+sorted list on every save. This keeps memory and payload flat instead:
+
+  - ring: the recent IDs exactly, keyed by Gmail internalDate (ms). IDs older
+    than PROCESSED_RETENTION_DAYS (relative to the newest internalDate seen),
+    or beyond PROCESSED_RING_MAX entries, move into the Bloom filter.
+  - Bloom filter for the older IDs, sized for PROCESSED_BLOOM_CAPACITY IDs at a
+    PROCESSED_BLOOM_FP false-positive rate. When it is full it becomes the
+    "previous" filter and a fresh one starts; the one before is dropped. Two
+    filters of fixed size, whatever the age of the deployment.
+
+A false positive means a message is taken as already processed. The rate is
+up to about twice PROCESSED_BLOOM_FP while both filters are live (0.2% with
+the defaults), and only unseen IDs can hit it; the webhook fetches by date, so
+it rarely asks about anything outside the exact ring anyway.
+
+refresh() (once per webhook run, a metadata check) re-reads the stored set
+when another instance has changed it.
+
+Stored as one compact binary blob (PROCESSED_SET_FILE, local or gs://),
+little-endian:
+
+    b"PIDS" u8 version
+    u32 ring_count, ring_count x (u64 internal_date_ms, u8 id_len, id bytes)
+    u8 filter_count, filter_count x (u32 m_bits, u8 k, u32 items, m_bits/8 bytes)
+"""
+import hashlib
+import heapq
+import math
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import config_bucket as config
+from logger_config import logger
+from state_manager_bucket import (StaleWriteError, ensure_str_path, read_bytes, read_json, seen_generation,
+                                  stored_generation, write_bytes)
+
+MAGIC = b"PIDS"
+VERSION = 1
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float, m_bits: Optional[int] = None, k: Optional[int] = None,
+                 bits: Optional[bytearray] = None, items: int = 0):
+        self.capacity = capacity
+        self.m = m_bits or max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.k = k or max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.m + 7) // 8)
+        self.items = items
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return ((h1 + i * h2) % self.m for i in range(self.k))
+
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.items += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    @property
+    def full(self) -> bool:
+        return self.items >= self.capacity
+
+
+class ProcessedSet:
+    def __init__(self, retention_days: Optional[float] = None, ring_max: Optional[int] = None,
+                 capacity: Optional[int] = None, fp_rate: Optional[float] = None):
+        self.retention_ms = int((retention_days if retention_days is not None
+                                 else config.PROCESSED_RETENTION_DAYS) * 86400 * 1000)
+        self.ring_max = ring_max or config.PROCESSED_RING_MAX
+        self.capacity = capacity or config.PROCESSED_BLOOM_CAPACITY
+        self.fp_rate = fp_rate or config.PROCESSED_BLOOM_FP
+        self.ring: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []  # (internal_date_ms, id), oldest first
+        self.newest_ms = 0
+        self.filters: List[BloomFilter] = [self._new_filter()]  # [current, previous]
+
+    def _new_filter(self) -> BloomFilter:
+        return BloomFilter(self.capacity, self.fp_rate)
+
+    def __contains__(self, msg_id: str) -> bool:
+        return msg_id in self.ring or any(msg_id in f for f in self.filters)
+
+    def __len__(self):
+        return len(self.ring) + sum(f.items for f in self.filters)
+
+    def add(self, msg_id: str, internal_date_ms: Optional[int] = None) -> None:
+        msg_id = str(msg_id)
+        if internal_date_ms is None:
+            self._to_filter(msg_id)  # age unknown (e.g. imported history)
+            return
+        internal_date_ms = int(internal_date_ms)
+        if msg_id in self.ring:
+            return
+        self.ring[msg_id] = internal_date_ms
+        heapq.heappush(self._heap, (internal_date_ms, msg_id))
+        self.newest_ms = max(self.newest_ms, internal_date_ms)
+        self._evict()
+
+    def _evict(self) -> None:
+        cutoff = self.newest_ms - self.retention_ms
+        while self._heap and (self._heap[0][0] < cutoff or len(self.ring) > self.ring_max):
+            _, msg_id = heapq.heappop(self._heap)
+            if self.ring.pop(msg_id, None) is not None:
+                self._to_filter(msg_id)
+
+    def _to_filter(self, msg_id: str) -> None:
+        if msg_id in self.filters[0]:
+            return
+        if self.filters[0].full:
+            self.filters = [self._new_filter(), self.filters[0]]  # rotate; the oldest filter is dropped
+        self.filters[0].add(msg_id)
+
+    # ---- binary format ----
+    def to_bytes(self) -> bytes:
+        parts = [MAGIC, struct.pack("<BI", VERSION, len(self.ring))]
+        for msg_id, ts in sorted(self.ring.items(), key=lambda kv: kv[1]):
+            raw = msg_id.encode("utf-8")
+            parts.append(struct.pack("<QB", ts, len(raw)) + raw)
+        parts.append(struct.pack("<B", len(self.filters)))
+        for f in self.filters:
+            parts.append(struct.pack("<IBI", f.m, f.k, f.items))
+            parts.append(bytes(f.bits))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ProcessedSet":
+        if data[:4] != MAGIC:
+            raise ValueError("not a processed-id set")
+        version, ring_count = struct.unpack_from("<BI", data, 4)
+        if version != VERSION:
+            raise ValueError(f"unsupported processed-id set version {version}")
+        pset = cls()
+        off = 9
+        for _ in range(ring_count):
+            ts, n = struct.unpack_from("<QB", data, off)
+            off += 9
+            msg_id = data[off:off + n].decode("utf-8")
+            off += n
+            pset.ring[msg_id] = ts
+            pset.newest_ms = max(pset.newest_ms, ts)
+        pset._heap = [(ts, i) for i, ts in pset.ring.items()]
+        heapq.heapify(pset._heap)
+        (count,) = struct.unpack_from("<B", data, off)
+        off += 1
+        filters = []
+        for _ in range(count):
+            m, k, items = struct.unpack_from("<IBI", data, off)
+            off += 9
+            size = (m + 7) // 8
+            filters.append(BloomFilter(pset.capacity, pset.fp_rate, m_bits=m, k=k,
+                                       bits=bytearray(data[off:off + size]), items=items))
+            off += size
+        pset.filters = filters or [pset._new_filter()]
+        return pset
+
+    def stats(self) -> Dict[str, int]:
+        return {"ring": len(self.ring), "filtered": sum(f.items for f in self.filters),
+                "bytes": len(self.ring) * 26 + sum(len(f.bits) for f in self.filters)}
+
+
+# ---- process-wide set, persisted in the state store ----
+_set: Optional[ProcessedSet] = None
+_added: List[Tuple[str, Optional[int]]] = []  # added since the last load/save (re-applied on a concurrent write)
+_generation: Optional[int] = None  # stored generation _set was loaded from / last saved as
+_lock = threading.Lock()
+
+
+def _load() -> ProcessedSet:
+    global _generation
+    path = ensure_str_path(config.PROCESSED_SET_FILE)
+    data = read_bytes(path)
+    _generation = seen_generation(path)
+    if data:
+        return ProcessedSet.from_bytes(data)
+    pset = ProcessedSet()
+    # First run: bring over the legacy JSON list (ages unknown -> Bloom filter)
+    try:
+        legacy = read_json(ensure_str_path(config.PROCESSED_FILE)) or []
+        if isinstance(legacy, dict):
+            legacy = legacy.get("ids", [])
+        for msg_id in legacy:
+            pset.add(str(msg_id))
+        if legacy:
+            logger.info(f"[PROCESSED] imported {len(legacy)} ids from {config.PROCESSED_FILE}")
+    except Exception as e:
+        logger.warning(f"Failed to import legacy processed ids: {e}")
+    return pset
+
+
+def _get() -> ProcessedSet:
+    global _set
+    if _set is None:
+        _set = _load()
+    return _set
+
+
+def refresh() -> None:
+    """Reload the set if the stored one changed since it was loaded or saved here."""
+    global _set
+    with _lock:
+        if _set is None:
+            return  # loaded on first use
+        path = ensure_str_path(config.PROCESSED_SET_FILE)
+        if stored_generation(path) == _generation:
+            return
+        _set = _load()
+        for msg_id, ts in _added:  # not saved yet
+            _set.add(msg_id, ts)
+        logger.info(f"[PROCESSED] {path} changed by another instance, reloaded")
+
+
+def contains(msg_id: str) -> bool:
+    with _lock:
+        return str(msg_id) in _get()
+
+
+def add_many(items: Iterable[Tuple[str, Optional[int]]]) -> None:
+    """Add (msg_id, internalDate ms or None) pairs and persist once."""
+    global _set, _generation
+    with _lock:
+        pset = _get()
+        for msg_id, ts in items:
+            pset.add(msg_id, ts)
+            _added.append((str(msg_id), ts))
+        path = ensure_str_path(config.PROCESSED_SET_FILE)
+        for _ in range(5):
+            try:
+                write_bytes(path, _set.to_bytes())
+                _generation = seen_generation(path)
+                _added.clear()
+                return
+            except StaleWriteError:
+                # Another instance saved meanwhile: take its set and re-apply ours
+                _set = _load()
+                for msg_id, ts in _added:
+                    _set.add(msg_id, ts)
+        logger.warning(f"Failed to save processed ids to {path}: too many concurrent updates")
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return _get().stats()
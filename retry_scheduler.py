@@ -0,0 +1,80 @@
+"""
+Due-time retries for failed messages.
+
+The webhook used to re-fetch and reprocess every failed message on every push,
+whether it failed seconds or days ago, so a message that can never succeed kept
+spending LLM calls forever. Now each failure gets a next_retry_at
+(failure_journal.py record / failures table):
+
+    delay = min(RETRY_BASE_DELAY_S * 2 ** (attempts - 1), RETRY_MAX_DELAY_S) * jitter
+    jitter = uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+and a run only takes the RETRY_BATCH_MAX earliest failures that are due
+(heap over the loaded records; an index range scan on the SQLite backend).
+After RETRY_MAX_ATTEMPTS attempts the message is dead-lettered: kept for
+inspection, never retried.
+
+    for rec in retry_scheduler.due():
+        ...
+        retry_scheduler.failed(rec["msg_id"], reason, rec["attempts"])  # or succeeded(msg_id)
+"""
+import heapq
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+import config_bucket as config
+import failure_journal
+import llm_metrics
+from logger_config import logger
+
+
+def backoff_s(attempts: int) -> float:
+    """Delay before retry number `attempts` (1 = first retry after the first failure)."""
+    delay = min(config.RETRY_BASE_DELAY_S * 2 ** max(attempts - 1, 0), config.RETRY_MAX_DELAY_S)
+    return delay * random.uniform(1 - config.RETRY_JITTER, 1 + config.RETRY_JITTER)
+
+
+def due(now: Optional[float] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Failures whose retry time has come, earliest first (at most `limit`)."""
+    now = time.time() if now is None else now
+    limit = limit or config.RETRY_BATCH_MAX
+    if config.STATE_BACKEND == "sqlite":
+        import state_sqlite
+        return state_sqlite.due_failures(now, limit)
+    records = failure_journal.load().values()
+    return heapq.nsmallest(limit, (r for r in records if not r.get("dead_at") and r["next_retry_at"] <= now),
+                           key=lambda r: r["next_retry_at"])
+
+
+def failed(msg_id: str, reason: str, attempts: int = 0) -> str:
+    """
+    Record another failure of msg_id (`attempts` = failures recorded before this one).
+    Returns "retry" (scheduled with backoff) or "dead" (dead-lettered).
+    """
+    attempts += 1
+    if attempts >= config.RETRY_MAX_ATTEMPTS:
+        failure_journal.dead_letter(msg_id, reason)
+        llm_metrics.incr("retry_dead_letters")
+        logger.error(f"☠️ msg_id={msg_id} dead-lettered after {attempts} attempts: {str(reason)[:80]}")
+        return "dead"
+    delay = backoff_s(attempts)
+    failure_journal.record_failure(msg_id, reason, next_retry_at=time.time() + delay)
+    logger.info(f"[RETRY] msg_id={msg_id} attempt {attempts}/{config.RETRY_MAX_ATTEMPTS}, next in {delay:.0f}s")
+    return "retry"
+
+
+def succeeded(msg_id: str) -> None:
+    failure_journal.clear(msg_id)
+
+
+def stats(now: Optional[float] = None) -> Dict[str, Any]:
+    now = time.time() if now is None else now
+    records = list(failure_journal.load().values())
+    retrying = [r for r in records if not r.get("dead_at")]
+    return {
+        "retrying": len(retrying),
+        "due": sum(1 for r in retrying if r["next_retry_at"] <= now),
+        "next_due_in_s": round(max(min((r["next_retry_at"] for r in retrying), default=now) - now, 0), 1),
+        "dead_letters": len(records) - len(retrying),
+    }
@@ -1,11 +1,11 @@
-from typing import Dict, Any, Set, Optional
+from typing import Callable, Dict, Any, Set, Optional
 import logging
 import json
 import os
 import sys
 from pathlib import Path
+import threading
 import time
-from gmail_utils import send_reply
 import config_bucket as config
 
 logger = logging.getLogger(config.LOGGER_NAME)
@@ -19,10 +19,24 @@ LAST_HISTORY_FILE = config.LAST_HISTORY_FILE
 # Try to import GCS client (optional)
 try:
     from google.cloud import storage
+    from google.api_core import exceptions as gcs_exceptions
     _HAS_GCS = True
 except Exception:
     _HAS_GCS = False
 
+# Connections kept open to storage.googleapis.com by the shared client
+GCS_POOL_SIZE = int(os.getenv("GCS_POOL_SIZE", "10"))
+
+_gcs_client = None
+_gcs_lock = threading.Lock()
+# Last generation this process read or wrote per gs:// path (0 = object did not exist)
+_generations: Dict[str, int] = {}
+_update_locks: Dict[str, threading.Lock] = {}
+
+
+class StaleWriteError(RuntimeError):
+    """The object changed in GCS since this process last read it; re-read before writing."""
+
 
 # ========== Helper Functions ==========
 
@@ -49,12 +63,28 @@ def split_gcs_path(path: str) -> (str, str):
 
 
 def get_gcs_client() -> "storage.Client":
+    """One storage.Client per process, on a pooled HTTP session."""
+    global _gcs_client
     if not _HAS_GCS:
         raise RuntimeError(
             "google-cloud-storage is not installed, "
             "but a gs:// path was configured."
         )
-    return storage.Client()
+    if _gcs_client is None:
+        with _gcs_lock:
+            if _gcs_client is None:
+                import google.auth
+                import requests
+                from google.auth.transport.requests import AuthorizedSession
+
+                credentials, project = google.auth.default(
+                    scopes=["https://www.googleapis.com/auth/devstorage.read_write"])
+                session = AuthorizedSession(credentials)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=GCS_POOL_SIZE,
+                                                        pool_maxsize=GCS_POOL_SIZE)
+                session.mount("https://", adapter)
+                _gcs_client = storage.Client(project=project, credentials=credentials, _http=session)
+    return _gcs_client
 
 
 def read_json(path: str) -> Optional[Any]:
@@ -65,10 +95,13 @@ def read_json(path: str) -> Optional[Any]:
         bucket = client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
 
-        if not blob.exists():
+        # One request: a missing object comes back as NotFound (no exists() round trip)
+        try:
+            content = blob.download_as_text(encoding="utf-8").strip()
+        except gcs_exceptions.NotFound:
+            _generations[path] = 0
             return None
-
-        content = blob.download_as_text(encoding="utf-8").strip()
+        _generations[path] = blob.generation
         if not content:
             return None
         return json.loads(content)
@@ -82,26 +115,135 @@ def read_json(path: str) -> Optional[Any]:
         return json.loads(content)
 
 
-def write_json(path: str, data: Any) -> None:
-    """Write JSON to local or GCS path."""
-    serialized = json.dumps(data, ensure_ascii=False, indent=2)
+_LAST_SEEN = object()
+
+
+def _expected_generation(path: str, generation: Any) -> Optional[int]:
+    """if_generation_match for a write: explicit value, else the last one this process saw."""
+    if generation is not _LAST_SEEN:
+        return generation
+    if path not in _generations:
+        raise StaleWriteError(f"{path} was not read by this process; read it before writing")
+    return _generations[path]
 
+
+def write_json(path: str, data: Any, generation: Any = _LAST_SEEN) -> None:
+    """
+    Write JSON to local or GCS path.
+
+    On GCS the write is conditional on the generation this process last read or
+    wrote (if_generation_match; 0 = must not exist yet), so a concurrent update
+    by another instance is not overwritten: StaleWriteError is raised instead,
+    and keeps being raised until the caller reads the object again. Writing a
+    path this process never read raises too. Pass generation=None explicitly
+    for a plain overwrite (last writer wins).
+    """
     if is_gcs_path(path):
+        # Compact on GCS: nobody reads these by eye and they are re-uploaded every run
+        serialized = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
         client = get_gcs_client()
         bucket_name, blob_name = split_gcs_path(path)
         bucket = client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
-        blob.upload_from_string(serialized, content_type="application/json")
+        generation = _expected_generation(path, generation)
+        try:
+            blob.upload_from_string(serialized, content_type="application/json",
+                                    if_generation_match=generation)
+        except gcs_exceptions.PreconditionFailed:
+            # _generations keeps the stale value: later writes fail the same way until a re-read
+            raise StaleWriteError(f"{path} changed since generation {generation}")
+        _generations[path] = blob.generation
     else:
+        serialized = json.dumps(data, ensure_ascii=False, indent=2)
         p = Path(path)
         p.parent.mkdir(parents=True, exist_ok=True)
         p.write_text(serialized, encoding="utf-8")
 
 
+def read_bytes(path: str) -> Optional[bytes]:
+    """Read a binary state file from local or GCS path; None if missing."""
+    if is_gcs_path(path):
+        bucket_name, blob_name = split_gcs_path(path)
+        blob = get_gcs_client().bucket(bucket_name).blob(blob_name)
+        try:
+            data = blob.download_as_bytes()
+        except gcs_exceptions.NotFound:
+            _generations[path] = 0
+            return None
+        _generations[path] = blob.generation
+        return data
+    p = Path(path)
+    return p.read_bytes() if p.is_file() else None
+
+
+def write_bytes(path: str, data: bytes, generation: Any = _LAST_SEEN) -> None:
+    """Write a binary state file; same generation check as write_json."""
+    if is_gcs_path(path):
+        bucket_name, blob_name = split_gcs_path(path)
+        blob = get_gcs_client().bucket(bucket_name).blob(blob_name)
+        generation = _expected_generation(path, generation)
+        try:
+            blob.upload_from_string(data, content_type="application/octet-stream",
+                                    if_generation_match=generation)
+        except gcs_exceptions.PreconditionFailed:
+            raise StaleWriteError(f"{path} changed since generation {generation}")
+        _generations[path] = blob.generation
+    else:
+        p = Path(path)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(p.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, p)
+
+
+def stored_generation(path: str) -> int:
+    """Generation of the stored object now (metadata only; local: mtime in ns); 0 if it does not exist."""
+    if is_gcs_path(path):
+        bucket_name, blob_name = split_gcs_path(path)
+        blob = get_gcs_client().bucket(bucket_name).blob(blob_name)
+        try:
+            blob.reload()
+        except gcs_exceptions.NotFound:
+            return 0
+        return blob.generation
+    p = Path(path)
+    return p.stat().st_mtime_ns if p.is_file() else 0
+
+
+def seen_generation(path: str) -> Optional[int]:
+    """Generation this process last read or wrote (local: the file's current one)."""
+    if is_gcs_path(path):
+        return _generations.get(path)
+    return stored_generation(path)
+
+
+def _update_lock(path: str) -> threading.Lock:
+    with _gcs_lock:
+        return _update_locks.setdefault(path, threading.Lock())
+
+
+def update_json(path: str, update: Callable[[Optional[Any]], Any], attempts: int = 5) -> Any:
+    """
+    Read-modify-write: write update(current) conditionally on the generation just
+    read, re-reading and retrying if another instance wrote in between. Updates
+    of one path within the process run one at a time (the generation read is
+    the process-wide last-seen one).
+    """
+    with _update_lock(path):
+        for attempt in range(attempts):
+            data = update(read_json(path))
+            try:
+                write_json(path, data)
+                return data
+            except StaleWriteError:
+                logger.info(f"[STATE] {path} changed concurrently, retrying ({attempt + 1}/{attempts})")
+    raise StaleWriteError(f"{path}: gave up after {attempts} concurrent updates")
+
+
 def ensure_file_exists(path: str) -> None:
     """Ensure a file or GCS blob exists (initialized as empty JSON)."""
     try:
-        write_json(path, {})
+        write_json(path, {}, generation=None)
     except Exception as e:
         logger.error(f"❌ Failed to initialize state file at {path}: {e}")
         sys.exit(1)
@@ -109,8 +251,20 @@ def ensure_file_exists(path: str) -> None:
 
 # ========== Business Functions ==========
 
+def _sqlite():
+    """The SQLite backend module when STATE_BACKEND=sqlite, else None."""
+    if config.STATE_BACKEND != "sqlite":
+        return None
+    import state_sqlite
+    return state_sqlite
+
+
 def load_last_state() -> Dict[str, str]:
     """Load last_history_id + last_processed_date."""
+    db = _sqlite()
+    if db:
+        data = db.get_checkpoint("history")
+        return data if isinstance(data, dict) and data.get("last_history_id") else {}
     path = ensure_str_path(LAST_HISTORY_FILE)
     logger.debug(f"Read last_history_id from: {path}")
 
@@ -144,8 +298,11 @@ def save_last_state(history_id: str, last_date: str) -> None:
         "last_history_id": history_id,
         "last_processed_date": last_date,
     }
+    if _sqlite():
+        _sqlite().set_checkpoint("history", payload)
+        return
     try:
-        write_json(path, payload)
+        write_json(path, payload, generation=None)  # latest state wins
         logger.info(f"✅ Saved last_state to {path}")
     except Exception as e:
         logger.warning(f"Failed to save last_state.json to {path}: {e}")
@@ -153,6 +310,8 @@ def save_last_state(history_id: str, last_date: str) -> None:
 
 def load_processed_ids() -> Set[str]:
     """Load processed message IDs."""
+    if _sqlite():
+        return _sqlite().load_processed_ids()
     path = ensure_str_path(PROCESSED_FILE)
     logger.debug(f"Load processed_ids from: {path}")
 
@@ -176,16 +335,68 @@ def load_processed_ids() -> Set[str]:
 
 
 def save_processed_ids(ids: Set[str]) -> None:
-    """Save processed message IDs."""
+    """Save processed message IDs (merged with IDs another instance saved meanwhile)."""
+    if _sqlite():
+        _sqlite().add_processed(ids)  # INSERT OR IGNORE: only new ids cost anything
+        return
     path = ensure_str_path(PROCESSED_FILE)
-    payload = sorted(map(str, ids))
+
+    def merge(current):
+        stored = current if isinstance(current, list) else (current or {}).get("ids", []) if isinstance(current, dict) else []
+        return sorted(set(map(str, stored)) | set(map(str, ids)))
 
     try:
-        write_json(path, payload)
+        payload = update_json(path, merge)
         logger.info(f"✅ Saved processed_ids to {path} (count={len(payload)})")
     except Exception as e:
         logger.warning(f"Failed to save processed_ids.json to {path}: {e}")
 
+def latest_history_state(service: Any) -> Optional[Dict[str, str]]:
+    """{"last_history_id", "updated_at"} for the mailbox now, or None if Gmail did not return a historyId."""
+    profile = service.users().getProfile(userId="me").execute()
+    latest_hid = profile.get("historyId")
+    if not latest_hid:
+        return None
+    return {
+        "last_history_id": latest_hid,
+        "updated_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+    }
+
+
+def is_processed(msg_id: str) -> bool:
+    """Membership check (an indexed lookup on the SQLite backend, processed_set.py on json)."""
+    if _sqlite():
+        return _sqlite().is_processed(msg_id)
+    import processed_set
+    return processed_set.contains(msg_id)
+
+
+def refresh_processed_ids() -> None:
+    """Pick up ids other instances recorded since this process loaded them (once per run)."""
+    try:
+        if _sqlite():
+            _sqlite().refresh()  # merges the whole snapshot: failures and checkpoints too
+            return
+        import processed_set
+        processed_set.refresh()
+    except Exception as e:
+        logger.warning(f"Failed to refresh processed ids: {e}")
+
+
+def mark_processed(msg_ids, internal_dates: Optional[Dict[str, Any]] = None) -> None:
+    """Record msg_ids as processed; internal_dates (msg_id -> Gmail internalDate ms) ages them out of the exact ring."""
+    msg_ids = [str(i) for i in msg_ids]
+    if not msg_ids:
+        return
+    if _sqlite():
+        _sqlite().add_processed(msg_ids)
+        return
+    import processed_set
+    now_ms = int(time.time() * 1000)
+    dates = internal_dates or {}
+    processed_set.add_many((i, int(dates.get(i) or now_ms)) for i in msg_ids)
+
+
 def update_last_history_file(service: Any) -> None:
     """
     Update LAST_HISTORY_FILE with latest Gmail historyId.
@@ -194,94 +405,22 @@ def update_last_history_file(service: Any) -> None:
     - 仅在成功获取到 historyId 时更新
     """
     try:
-        profile = service.users().getProfile(userId="me").execute()
-        latest_hid = profile.get("historyId")
+        data = latest_history_state(service)
 
-        if not latest_hid:
+        if not data:
             logger.warning("Failed to get latest historyId, skip update.")
             return
 
-        data = {
-            "last_history_id": latest_hid,
-            "updated_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
-        }
-
         path = ensure_str_path(LAST_HISTORY_FILE)
-        write_json(path, data)
+        if _sqlite():
+            path = "checkpoints.history"
+            _sqlite().set_checkpoint("history", data)
+        else:
+            write_json(path, data, generation=None)  # latest historyId wins
 
         logger.info(
-            f"✅ Updated last_history_id at {path}, current latest historyId = {latest_hid}"
+            f"✅ Updated last_history_id at {path}, current latest historyId = {data['last_history_id']}"
         )
 
     except Exception as e:
         logger.error(f"❌ Failed to update last_history_id.json: {e}")
-
-    
-def ensure_failed_file_exists(service_gmail):
-    """
-    Ensure FAILED_FILE exists (local or GCS) and is a valid dict.
-
-    """
-    path = ensure_str_path(config.FAILED_FILE)
-
-    # 1. Attemp to read
-    try:
-        data = read_json(path)
-    except Exception as e:
-        logger.error(f"❌ Failed to read FAILED_FILE at {path}: {e}")
-        subject = "⚠️ Alert: failed_ids.json read failed"
-        body = (
-            f"The system failed to read the required file {path}.\n"
-            f"Error: {e}\n\n"
-            "Please check storage permission or GCS configuration."
-        )
-        try:
-            send_reply(service_gmail, None, MY_EMAIL, subject, body)
-        except Exception as mail_err:
-            logger.error(f"⚠️ Failed to send alert email: {mail_err}")
-        return "Error"
-
-    # 2. Return Null Dict if failed to get the file or the file is empty
-    if data is None:
-        try:
-            write_json(path, {})
-            logger.warning(f"⚠️ {path} was missing or empty. Created a new empty file.")
-            return {}
-        except Exception as e:
-            logger.error(f"❌ Failed to create empty FAILED_FILE at {path}: {e}")
-            subject = "⚠️ Alert: failed_ids.json creation failed"
-            body = (
-                f"The system failed to create the required file {path}.\n"
-                f"Error: {e}\n\n"
-                "This may indicate a permission or storage issue."
-            )
-            try:
-                send_reply(service_gmail, None, MY_EMAIL, subject, body)
-            except Exception as mail_err:
-                logger.error(f"⚠️ Failed to send alert email: {mail_err}")
-            return "Error"
-
-    # 3. Reset the file to Null if the format is wrong
-    if not isinstance(data, dict):
-        logger.warning(
-            f"⚠️ Invalid format in {path}, expected dict but got {type(data)}. Resetting file."
-        )
-        try:
-            write_json(path, {})
-            return {}
-        except Exception as e:
-            logger.error(f"❌ Failed to reset FAILED_FILE at {path}: {e}")
-            subject = "⚠️ Alert: failed_ids.json reset failed"
-            body = (
-                f"The system failed to reset the invalid file {path}.\n"
-                f"Error: {e}\n\n"
-                "Please check storage or deployment configuration."
-            )
-            try:
-                send_reply(service_gmail, None, MY_EMAIL, subject, body)
-            except Exception as mail_err:
-                logger.error(f"⚠️ Failed to send alert email: {mail_err}")
-            return "Error"
-
-    # 4. Return data
-    return data
@@ -0,0 +1,201 @@
+"""
+Write-behind state for one webhook run.
+
+A run used to read last_history_id.json twice and to write it separately as
+it went. StateSession reads every state document once at the start, the run
+changes the in-memory copies, and flush() writes only the documents that
+changed, together, at the end (latest writer wins):
+
+    session = StateSession()
+    session.load()
+    state = session.get("history")
+    ...
+    session.set("history", new_state)
+    session.flush()
+
+Crash safety: every set() is appended (and fsync'ed) to a JSONL journal on
+local disk, one per run (STATE_JOURNAL_FILE with a host/pid/uuid suffix, so
+concurrent requests do not share a file; point it at a persistent volume to
+survive the instance itself going away). A successful flush removes it. If
+the worker is killed mid-run (gunicorn timeout, OOM), its journal is left
+behind; load() picks up journals whose process is gone (or, from another
+host, that are older than STATE_JOURNAL_ORPHAN_S), replays them oldest first
+and flushes them with its own changes. A replayed history older than the one
+just loaded (lower history id, else earlier updated_at) is skipped: a later
+run already moved past it. Failures are not a session document:
+failure_journal.py appends each one as it happens, so they are on disk before
+the history is advanced past their messages.
+"""
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import config_bucket as config
+from logger_config import logger
+from state_manager_bucket import ensure_str_path, read_json, write_json
+
+_active: set = set()  # journals of the sessions running in this process
+_active_lock = threading.Lock()
+
+
+# name -> path
+def _documents() -> Dict[str, str]:
+    return {
+        "history": ensure_str_path(config.LAST_HISTORY_FILE),
+    }
+
+
+def _journal_base() -> tuple:
+    return os.path.splitext(ensure_str_path(config.STATE_JOURNAL_FILE))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _orphaned(path: str) -> bool:
+    """Journal of a run that is not going to flush it any more."""
+    root, ext = _journal_base()
+    with _active_lock:
+        if path in _active:
+            return False
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return False
+    if path == root + ext:
+        return True  # single journal of an older version
+    parts = path[len(root) + 1:len(path) - len(ext)].rsplit(".", 2)  # host, pid, uuid
+    if len(parts) == 3 and parts[0] == socket.gethostname() and parts[1].isdigit():
+        pid = int(parts[1])
+        return pid == os.getpid() or not _alive(pid)  # ours but no longer active: that run failed to flush
+    return age >= config.STATE_JOURNAL_ORPHAN_S
+
+
+def _older(replayed: Any, current: Any) -> bool:
+    """Replayed document behind the current one (history id, else updated_at); unknown counts as newer."""
+    if not isinstance(replayed, dict) or not isinstance(current, dict):
+        return False
+    a, b = replayed.get("last_history_id"), current.get("last_history_id")
+    if str(a or "").isdigit() and str(b or "").isdigit():
+        return int(a) < int(b)
+    a, b = replayed.get("updated_at"), current.get("updated_at")
+    if isinstance(a, str) and isinstance(b, str):
+        return a < b  # "YYYY-MM-DD HH:MM:SS" sorts chronologically
+    return False
+
+
+class StateSession:
+    def __init__(self, documents: Optional[Dict[str, str]] = None):
+        self.documents = documents or _documents()
+        self._data: Dict[str, Any] = {}
+        self._dirty: set = set()
+        root, ext = _journal_base()
+        self.journal_path = f"{root}.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:12]}{ext}"
+        # STATE_BACKEND=sqlite: documents are tables / checkpoints in state_sqlite (one transaction each)
+        self._db = None
+        if config.STATE_BACKEND == "sqlite":
+            import state_sqlite
+            self._db = state_sqlite
+
+    # ---- load / recovery ----
+    def load(self) -> "StateSession":
+        with _active_lock:
+            _active.add(self.journal_path)
+        for name, path in self.documents.items():
+            data = self._db.read_doc(name) if self._db else read_json(path)
+            self._data[name] = json.loads(json.dumps(data))  # working copy
+        self._replay_orphans()
+        return self
+
+    def _orphans(self) -> List[str]:
+        root, ext = _journal_base()
+        paths = set(glob.glob(glob.escape(root) + ".*" + ext)) | {root + ext}
+        orphans = [p for p in paths if os.path.exists(p) and _orphaned(p)]
+        return sorted(orphans, key=os.path.getmtime)
+
+    def _replay_orphans(self) -> None:
+        replayed = stale = 0
+        for path in self._orphans():
+            claimed = f"{self.journal_path}.replaying"
+            try:
+                os.replace(path, claimed)  # only one session takes it
+            except FileNotFoundError:
+                continue
+            with open(claimed, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break  # torn last line
+                    if rec.get("name") not in self.documents:
+                        continue
+                    if _older(rec["data"], self._data.get(rec["name"])):
+                        stale += 1  # a later run already got further
+                        continue
+                    self.set(rec["name"], rec["data"])  # re-journaled under this run
+                    replayed += 1
+            os.remove(claimed)
+        if replayed or stale:
+            logger.warning(f"[STATE] replayed {replayed} journaled changes from interrupted runs, "
+                           f"skipped {stale} older than the stored state")
+
+    # ---- access ----
+    def get(self, name: str, default: Any = None) -> Any:
+        data = self._data.get(name)
+        return default if data is None else data
+
+    def set(self, name: str, data: Any) -> None:
+        if name not in self.documents:
+            raise KeyError(f"unknown state document {name!r}")
+        self._data[name] = data
+        self._dirty.add(name)
+        self._journal(name, data)
+
+    def _journal(self, name: str, data: Any) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"name": name, "data": data}, ensure_ascii=False, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.warning(f"Failed to journal state change {self.journal_path}: {e}")
+
+    # ---- flush ----
+    def flush(self) -> None:
+        """Write the changed documents (no-op if nothing changed) and drop this run's journal."""
+        try:
+            if self._dirty:
+                start = time.perf_counter()
+                for name in sorted(self._dirty):
+                    self._write(name)
+                logger.info(f"[STATE] flushed {sorted(self._dirty)} in "
+                            f"{(time.perf_counter() - start) * 1000:.0f} ms")
+                self._dirty.clear()
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+        finally:
+            # Unflushed changes stay journaled; the next run (of any process) replays them
+            with _active_lock:
+                _active.discard(self.journal_path)
+
+    def _write(self, name: str) -> None:
+        data = self._data[name]
+        if self._db:
+            self._db.write_doc(name, data)
+            return
+        write_json(self.documents[name], data, generation=None)
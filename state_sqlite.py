@@ -0,0 +1,483 @@
+"""
+SQLite state backend (STATE_BACKEND=sqlite).
+
+The JSON blobs are rewritten in full on every change (processed_ids.json is
+even re-sorted each time). Here each kind of state is an indexed table, so a
+membership check or an update touches one B-tree entry:
+
+    processed(msg_id PRIMARY KEY, processed_at)
+    failures(msg_id PRIMARY KEY, reason, attempts, next_retry_at, updated_at)   + index on next_retry_at
+    dead_letters(msg_id PRIMARY KEY, reason, attempts, dead_at)                 failures given up on
+    checkpoints(name PRIMARY KEY, value JSON, updated_at)                        e.g. "history"
+
+The database lives at STATE_SQLITE_PATH. Local deployments run it in WAL mode
+(STATE_SQLITE_WAL=1). On Cloud Run the file is on the instance's disk and is
+copied to STATE_SQLITE_SNAPSHOT (gs://...) at the end of every webhook run
+that wrote something (maybe_snapshot()) and on SIGTERM; a new instance starts
+from the latest snapshot.
+
+Snapshots are whole files, so two instances writing at once would clobber
+each other. An upload is therefore conditional on the generation this
+instance restored or last uploaded (<path>.generation). When another instance
+has uploaded since, the newer snapshot is pulled and merged into the local
+database (_merge_snapshot: processed ids and dead letters are unions, failures
+and checkpoints keep the most recently updated row, failures of messages
+processed or dead-lettered elsewhere are dropped) and the upload is retried.
+refresh() does the same pull at the start of a run, so reads see what other
+instances wrote. A local database that is behind the snapshot at startup is
+refused (STATE_SQLITE_STRICT=1) or merged the same way.
+
+On first open an empty database imports the existing JSON state files.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import config_bucket as config
+from logger_config import logger
+from state_manager_bucket import (StaleWriteError, ensure_str_path, get_gcs_client, is_gcs_path, read_json,
+                                  split_gcs_path)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    msg_id TEXT PRIMARY KEY,
+    processed_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS failures (
+    msg_id TEXT PRIMARY KEY,
+    reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    next_retry_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS failures_next_retry ON failures (next_retry_at);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    msg_id TEXT PRIMARY KEY,
+    reason TEXT,
+    attempts INTEGER NOT NULL,
+    dead_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.RLock()
+_dirty = False  # committed changes not in the snapshot yet
+_snapshot_generation: Optional[int] = None  # snapshot generation the local file matches (0 = none yet)
+
+
+def _snapshot_blob():
+    """(blob, gs:// path) of STATE_SQLITE_SNAPSHOT, or (None, "") without a GCS snapshot."""
+    target = ensure_str_path(config.STATE_SQLITE_SNAPSHOT or "")
+    if not target or not is_gcs_path(target):
+        return None, ""
+    bucket_name, blob_name = split_gcs_path(target)
+    return get_gcs_client().bucket(bucket_name).blob(blob_name), target
+
+
+def _record_generation(path: str, generation: int) -> None:
+    global _snapshot_generation
+    _snapshot_generation = generation
+    with open(path + ".generation", "w", encoding="utf-8") as f:
+        f.write(str(generation))
+
+
+def _restore_snapshot(path: str) -> None:
+    from google.api_core import exceptions as gcs_exceptions
+    blob, target = _snapshot_blob()
+    if blob is None:
+        return
+    if os.path.exists(path):
+        _check_local(path, blob, target)
+        return
+    try:
+        blob.download_to_filename(path)
+    except gcs_exceptions.NotFound:
+        # First run: start empty; the first snapshot must not overwrite anything
+        if os.path.exists(path):
+            os.remove(path)
+        _record_generation(path, 0)
+        logger.warning(f"[STATE_DB] no snapshot at {target} yet, starting empty")
+        return
+    except Exception:
+        # Starting empty here would later overwrite the real state: refuse instead
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    _record_generation(path, blob.generation)
+    logger.info(f"[STATE_DB] restored {path} from {target} (generation {blob.generation})")
+
+
+def _check_local(path: str, blob, target: str) -> None:
+    """An existing local database must be the one the current snapshot was made from."""
+    global _snapshot_generation
+    from google.api_core import exceptions as gcs_exceptions
+    try:
+        with open(path + ".generation", encoding="utf-8") as f:
+            local = int(f.read().strip() or -1)
+    except (OSError, ValueError):
+        local = -1
+    try:
+        blob.reload()
+        remote = blob.generation
+    except gcs_exceptions.NotFound:
+        remote = 0
+    if local == remote:
+        _record_generation(path, remote)
+        return
+    msg = (f"[STATE_DB] {path} was synced with snapshot generation {local}, but {target} is at "
+           f"generation {remote}: another instance has written state since")
+    if config.STATE_SQLITE_STRICT:
+        raise RuntimeError(msg + " (remove the local file to start from the snapshot, or set STATE_SQLITE_STRICT=0)")
+    logger.error(f"🚨 {msg}; merging it into the local database")
+    _snapshot_generation = local
+    if remote:
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            conn.executescript(SCHEMA)
+            _merge_snapshot(conn, path, blob, target)
+        finally:
+            conn.close()
+    _mark_dirty()  # the local rows the snapshot lacks go up with the next one
+
+
+def _merge_snapshot(conn: sqlite3.Connection, path: str, blob, target: str) -> None:
+    """
+    Pull the current snapshot and merge it into the local database, which then
+    holds both instances' state and is synced with that generation. Caller holds
+    _lock (or owns conn exclusively).
+    """
+    from google.api_core import exceptions as gcs_exceptions
+    try:
+        blob.reload()
+    except gcs_exceptions.NotFound:
+        return  # removed: the next upload (generation 0 fails) reports it
+    generation = blob.generation
+    fd, tmp = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        blob.download_to_filename(tmp, if_generation_match=generation)
+        conn.execute("ATTACH DATABASE ? AS snap", (tmp,))
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for stmt in _MERGE:
+                    conn.execute(stmt)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.execute("DETACH DATABASE snap")
+    finally:
+        os.remove(tmp)
+    _record_generation(path, generation)
+    logger.warning(f"[STATE_DB] merged {target} (generation {generation}) written by another instance")
+
+
+# Local (main) <- snapshot (snap). "WHERE true" keeps the upsert parseable after a SELECT.
+_MERGE = (
+    "INSERT OR IGNORE INTO processed SELECT msg_id, processed_at FROM snap.processed",
+    "INSERT INTO dead_letters SELECT msg_id, reason, attempts, dead_at FROM snap.dead_letters WHERE true "
+    "ON CONFLICT (msg_id) DO UPDATE SET reason = excluded.reason, attempts = excluded.attempts, "
+    "dead_at = excluded.dead_at WHERE excluded.dead_at > dead_letters.dead_at",
+    "INSERT INTO failures (msg_id, reason, attempts, next_retry_at, updated_at) "
+    "SELECT msg_id, reason, attempts, next_retry_at, updated_at FROM snap.failures WHERE true "
+    "ON CONFLICT (msg_id) DO UPDATE SET reason = excluded.reason, attempts = excluded.attempts, "
+    "next_retry_at = excluded.next_retry_at, updated_at = excluded.updated_at "
+    "WHERE excluded.updated_at > failures.updated_at",
+    "DELETE FROM failures WHERE msg_id IN (SELECT msg_id FROM processed) "
+    "OR msg_id IN (SELECT d.msg_id FROM dead_letters d WHERE d.dead_at >= failures.updated_at)",
+    "INSERT INTO checkpoints SELECT name, value, updated_at FROM snap.checkpoints WHERE true "
+    "ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at "
+    "WHERE excluded.updated_at > checkpoints.updated_at",
+)
+
+
+def _import_json(conn: sqlite3.Connection) -> None:
+    """Seed an empty database from the JSON state files."""
+    now = time.time()
+    try:
+        processed = read_json(ensure_str_path(config.PROCESSED_FILE)) or []
+        if isinstance(processed, dict):
+            processed = processed.get("ids", [])
+        conn.executemany("INSERT OR IGNORE INTO processed VALUES (?, ?)", ((str(i), now) for i in processed))
+
+        import failure_journal
+        failed = list(failure_journal.load_json().values())
+        _upsert_failures(conn, [f for f in failed if not f.get("dead_at")], now)
+        conn.executemany("INSERT OR IGNORE INTO dead_letters VALUES (?, ?, ?, ?)",
+                         ((f["msg_id"], f["reason"], f["attempts"], f["dead_at"]) for f in failed if f.get("dead_at")))
+
+        history = read_json(ensure_str_path(config.LAST_HISTORY_FILE))
+        if isinstance(history, dict) and history.get("last_history_id"):
+            _set_checkpoint(conn, "history", history, now)
+    except Exception as e:
+        logger.warning(f"[STATE_DB] JSON state import failed: {e}")
+        return
+    logger.info(f"[STATE_DB] imported {len(processed)} processed ids, {len(failed)} failures from JSON state")
+
+
+def connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        with _lock:
+            if _conn is None:
+                path = ensure_str_path(config.STATE_SQLITE_PATH)
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                _restore_snapshot(path)
+                conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+                if config.STATE_SQLITE_WAL:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(SCHEMA)
+                empty = not any(conn.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone()
+                                for t in ("processed", "failures", "dead_letters", "checkpoints"))
+                if empty:
+                    with conn:
+                        conn.execute("BEGIN")
+                        _import_json(conn)
+                    _mark_dirty()
+                _conn = conn
+    return _conn
+
+
+def _mark_dirty() -> None:
+    global _dirty
+    _dirty = True
+
+
+@contextmanager
+def _tx():
+    """One write transaction under the module lock."""
+    with _lock:
+        conn = connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        _mark_dirty()
+
+
+# ---- processed ids ----
+def is_processed(msg_id: str) -> bool:
+    with _lock:
+        return connect().execute("SELECT 1 FROM processed WHERE msg_id = ?", (str(msg_id),)).fetchone() is not None
+
+
+def add_processed(msg_ids: Iterable[str]) -> None:
+    now = time.time()
+    with _tx() as conn:
+        conn.executemany("INSERT OR IGNORE INTO processed VALUES (?, ?)", ((str(i), now) for i in msg_ids))
+
+
+def load_processed_ids() -> Set[str]:
+    with _lock:
+        return {row[0] for row in connect().execute("SELECT msg_id FROM processed")}
+
+
+# ---- failures ----
+def _upsert_failures(conn: sqlite3.Connection, items: List[Dict[str, Any]], now: float) -> None:
+    conn.executemany(
+        "INSERT INTO failures (msg_id, reason, attempts, next_retry_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (msg_id) DO UPDATE SET reason = excluded.reason, attempts = excluded.attempts, "
+        "next_retry_at = excluded.next_retry_at, updated_at = excluded.updated_at",
+        ((str(i["msg_id"]), i.get("reason"), int(i.get("attempts") or 1), float(i.get("next_retry_at") or now), now)
+         for i in items))
+
+
+def load_failures() -> List[Dict[str, Any]]:
+    with _lock:
+        rows = connect().execute(
+            "SELECT msg_id, reason, attempts, next_retry_at FROM failures ORDER BY next_retry_at").fetchall()
+    return [{"msg_id": m, "reason": r, "attempts": a, "next_retry_at": n} for m, r, a, n in rows]
+
+
+def get_failure(msg_id: str) -> Optional[Dict[str, Any]]:
+    with _lock:
+        row = connect().execute("SELECT msg_id, reason, attempts, next_retry_at FROM failures WHERE msg_id = ?",
+                                (str(msg_id),)).fetchone()
+    return {"msg_id": row[0], "reason": row[1], "attempts": row[2], "next_retry_at": row[3]} if row else None
+
+
+def due_failures(now: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    """Failures whose next retry time has come (index range scan)."""
+    with _lock:
+        rows = connect().execute(
+            "SELECT msg_id, reason, attempts, next_retry_at FROM failures WHERE next_retry_at <= ? "
+            "ORDER BY next_retry_at LIMIT ?", (time.time() if now is None else now, limit)).fetchall()
+    return [{"msg_id": m, "reason": r, "attempts": a, "next_retry_at": n} for m, r, a, n in rows]
+
+
+def record_failure(msg_id: str, reason: str, attempts: int = 1, next_retry_at: Optional[float] = None) -> None:
+    with _tx() as conn:
+        _upsert_failures(conn, [{"msg_id": msg_id, "reason": reason, "attempts": attempts,
+                                 "next_retry_at": next_retry_at}], time.time())
+
+
+def clear_failure(msg_id: str) -> None:
+    with _tx() as conn:
+        conn.execute("DELETE FROM failures WHERE msg_id = ?", (str(msg_id),))
+        conn.execute("DELETE FROM dead_letters WHERE msg_id = ?", (str(msg_id),))
+
+
+def replace_failures(items: List[Dict[str, Any]]) -> None:
+    """Make the table hold exactly items (upserts + deletes of the rest, one transaction)."""
+    keep = {str(i["msg_id"]) for i in items if i.get("msg_id")}
+    with _tx() as conn:
+        stale = [(m,) for (m,) in conn.execute("SELECT msg_id FROM failures") if m not in keep]
+        conn.executemany("DELETE FROM failures WHERE msg_id = ?", stale)
+        _upsert_failures(conn, [i for i in items if i.get("msg_id")], time.time())
+
+
+def dead_letter(msg_id: str, reason: str) -> None:
+    """Move msg_id from failures to dead_letters (one transaction)."""
+    with _tx() as conn:
+        row = conn.execute("SELECT attempts FROM failures WHERE msg_id = ?", (str(msg_id),)).fetchone()
+        conn.execute("DELETE FROM failures WHERE msg_id = ?", (str(msg_id),))
+        conn.execute("INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?)",
+                     (str(msg_id), reason, (row[0] if row else 0) + 1, time.time()))
+
+
+def load_dead_letters() -> List[Dict[str, Any]]:
+    with _lock:
+        rows = connect().execute("SELECT msg_id, reason, attempts, dead_at FROM dead_letters ORDER BY dead_at").fetchall()
+    return [{"msg_id": m, "reason": r, "attempts": a, "dead_at": d} for m, r, a, d in rows]
+
+
+# ---- checkpoints ----
+def _set_checkpoint(conn: sqlite3.Connection, name: str, value: Any, now: float) -> None:
+    conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                 (name, json.dumps(value, ensure_ascii=False), now))
+
+
+def get_checkpoint(name: str) -> Optional[Any]:
+    with _lock:
+        row = connect().execute("SELECT value FROM checkpoints WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def set_checkpoint(name: str, value: Any) -> None:
+    with _tx() as conn:
+        _set_checkpoint(conn, name, value, time.time())
+
+
+# ---- documents (state_session) ----
+def read_doc(name: str) -> Any:
+    return get_checkpoint(name)
+
+
+def write_doc(name: str, data: Any) -> None:
+    set_checkpoint(name, data)
+
+
+# ---- GCS snapshot ----
+SNAPSHOT_ATTEMPTS = 3
+
+
+def refresh() -> None:
+    """Merge a snapshot another instance uploaded since this one synced (start of a webhook run)."""
+    from google.api_core import exceptions as gcs_exceptions
+    blob, target = _snapshot_blob()
+    if blob is None:
+        return
+    connect()
+    try:
+        blob.reload()
+    except gcs_exceptions.NotFound:
+        return
+    if blob.generation == _snapshot_generation:
+        return
+    with _lock:
+        _merge_snapshot(connect(), ensure_str_path(config.STATE_SQLITE_PATH), blob, target)
+
+
+def snapshot() -> bool:
+    """
+    Consistent copy of the database (sqlite backup API) uploaded to
+    STATE_SQLITE_SNAPSHOT, conditional on the generation this instance last
+    synced with. If another instance uploaded since, its snapshot is merged in
+    and the upload retried; StaleWriteError after SNAPSHOT_ATTEMPTS races.
+    """
+    global _dirty
+    from google.api_core import exceptions as gcs_exceptions
+    blob, target = _snapshot_blob()
+    if blob is None:
+        return False
+    connect()
+    if _snapshot_generation is None:
+        raise StaleWriteError(f"{target}: local database was not restored from it, not uploading")
+    path = ensure_str_path(config.STATE_SQLITE_PATH)
+    start = time.perf_counter()
+    for attempt in range(SNAPSHOT_ATTEMPTS):
+        fd, tmp = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            dest = sqlite3.connect(tmp)
+            with _lock:
+                connect().backup(dest)
+                generation = _snapshot_generation
+                _dirty = False
+            dest.close()
+            try:
+                blob.upload_from_filename(tmp, content_type="application/x-sqlite3",
+                                          if_generation_match=generation)
+            except gcs_exceptions.PreconditionFailed:
+                _mark_dirty()
+                with _lock:
+                    _merge_snapshot(connect(), path, blob, target)
+                continue
+            except Exception:
+                _mark_dirty()
+                raise
+        finally:
+            os.remove(tmp)
+        _record_generation(path, blob.generation)
+        logger.info(f"[STATE_DB] snapshot -> {target} (generation {blob.generation}) "
+                    f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return True
+    raise StaleWriteError(f"{target} kept changing during {SNAPSHOT_ATTEMPTS} merge attempts: "
+                          f"other instances are writing state")
+
+
+def maybe_snapshot() -> None:
+    """Upload a snapshot if anything was written since the last one (end of a webhook run)."""
+    if not _dirty:
+        return
+    try:
+        snapshot()
+    except StaleWriteError as e:
+        logger.error(f"🚨 State snapshot refused: {e}")
+    except Exception as e:
+        logger.warning(f"⚠️ State snapshot failed: {e}")
+
+
+def snapshot_on_sigterm() -> None:
+    """Upload pending changes when the platform stops the instance (install from the main thread)."""
+    import signal
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        maybe_snapshot()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    try:
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        logger.warning("[STATE_DB] not on the main thread, no SIGTERM snapshot")
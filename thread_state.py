@@ -0,0 +1,183 @@
+"""
+Incremental per-thread analysis state.
+
+Instead of sending the whole (growing) thread to the LLM for every reply, each
+thread keeps a small record in the state store:
+
+    {
+      "thread_id": "...",
+      "subject": "...",
+      "last_msg_id": "...",          # last message analyzed
+      "candidates": [{"time": "YYYY-MM-DD HH:MM", "proposer": "a@x.com", "msg_id": "..."}],
+      "last_proposal": ["YYYY-MM-DD HH:MM", ...],   # times of the latest proposing message
+      "acceptances": [{"time": "...", "by": "b@x.com", "msg_id": "..."}],
+      "participants": ["a@x.com", ...],
+      "last_result": {...},          # result of the last analysis (served again on redelivery)
+      "updated_at": "YYYY-MM-DD HH:MM:SS"
+    }
+
+Only the newest message plus this summary is analyzed (by the LLM, or by the
+local rule engine with THREAD_ANALYSIS_ENGINE=rules), so prompt size stays
+constant per reply. The first message seen of a thread gets one full analysis.
+"""
+import re
+import time
+from typing import Any, Dict, Optional
+
+import config_bucket as config
+import llm_metrics
+from logger_config import logger
+from meeting_rules import decide, extract_emails, turn_facts
+from state_manager_bucket import ensure_str_path, read_json, write_json
+from token_budget import split_turn_header, split_turns
+
+# Cap the stored history so the summary (and the prompt) stay small
+MAX_CANDIDATES = 20
+MAX_ACCEPTANCES = 20
+
+
+def _state_path(thread_id: str) -> str:
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", thread_id or "unknown")
+    return f"{ensure_str_path(config.THREAD_STATE_DIR).rstrip('/')}/{safe_id}.json"
+
+
+def load_thread_state(thread_id: str) -> Optional[Dict[str, Any]]:
+    path = _state_path(thread_id)
+    try:
+        data = read_json(path)
+    except Exception as e:
+        logger.warning(f"Failed to read thread state {path}: {e}")
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def save_thread_state(state: Dict[str, Any]) -> None:
+    path = _state_path(state["thread_id"])
+    state["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    try:
+        write_json(path, state)
+    except Exception as e:
+        logger.warning(f"Failed to save thread state {path}: {e}")
+
+
+def new_thread_state(thread_id: str, subject: str = "") -> Dict[str, Any]:
+    return {
+        "thread_id": thread_id,
+        "subject": subject,
+        "last_msg_id": None,
+        "candidates": [],
+        "last_proposal": [],
+        "acceptances": [],
+        "participants": [],
+        "last_result": None,
+    }
+
+
+def apply_message(state: Dict[str, Any], msg_id: Optional[str], sender: Optional[str],
+                  proposed: list, accepted: list, emails: list) -> None:
+    """Fold the facts of one message into the state."""
+    for t in proposed:
+        state["candidates"].append({"time": t, "proposer": sender, "msg_id": msg_id})
+    if proposed:
+        state["last_proposal"] = list(proposed)
+    for t in accepted:
+        state["acceptances"].append({"time": t, "by": sender, "msg_id": msg_id})
+    state["candidates"] = state["candidates"][-MAX_CANDIDATES:]
+    state["acceptances"] = state["acceptances"][-MAX_ACCEPTANCES:]
+    for e in emails + ([sender] if sender else []):
+        if e and e not in state["participants"]:
+            state["participants"].append(e)
+    if msg_id:
+        state["last_msg_id"] = msg_id
+
+
+def seed_from_history(state: Dict[str, Any], older_turns: list) -> None:
+    """Build the initial state from the quoted history (oldest first), locally."""
+    for turn in reversed(older_turns):
+        facts = turn_facts(turn)
+        apply_message(state, None, facts["sender"], facts["times"], [], extract_emails(turn))
+
+
+def state_summary(state: Dict[str, Any]) -> str:
+    """Compact text form of the state for the incremental prompt."""
+    lines = []
+    if state.get("subject"):
+        lines.append(f"Subject: {state['subject']}")
+    if state["candidates"]:
+        lines.append("Proposed times:")
+        lines += [f"- {c['time']} proposed by {c.get('proposer') or 'unknown'}" for c in state["candidates"]]
+    if state["last_proposal"]:
+        lines.append(f"Latest proposal: {', '.join(state['last_proposal'])}")
+    if state["acceptances"]:
+        lines.append("Acceptances:")
+        lines += [f"- {a['time']} accepted by {a.get('by') or 'unknown'}" for a in state["acceptances"]]
+    if state["participants"]:
+        lines.append(f"Participants: {', '.join(state['participants'])}")
+    return "\n".join(lines) or "(no scheduling information yet)"
+
+
+def _rules_update(state: Dict[str, Any], facts: Dict[str, Any], baseline_date: str) -> Dict[str, Any]:
+    proposal = {"times": state["last_proposal"]} if state["last_proposal"] else None
+    result = decide(facts, proposal, baseline_date)
+    result.update({
+        "status": "ok",
+        "meeting_intent": bool(facts["times"] or state["candidates"]),
+        "meeting_subject": state.get("subject", ""),
+        "attendees": list(state["participants"]),
+        "proposed_times": [] if result["meeting_time"] else facts["times"],
+        "accepted_times": [result["meeting_time"]] if result["meeting_time"] else [],
+    })
+    return result
+
+
+def analyze_thread_incremental(thread_id: str, msg_id: str, body: str, sender: str,
+                               baseline_date: str, subject: str = "") -> Dict[str, Any]:
+    """
+    Analyze one new message of a thread using (and updating) the stored thread state.
+    Returns the same fields as deepseek_client.analyze_meeting_schedule.
+    """
+    # Imported here: deepseek_client pulls in the LLM SDKs
+    from deepseek_client import analyze_meeting_schedule, analyze_meeting_update
+
+    turns = split_turns(body) or [body or ""]
+    newest_text = split_turn_header(turns[0])[1]
+    state = load_thread_state(thread_id)
+
+    if state and state.get("last_msg_id") == msg_id and state.get("last_result"):
+        logger.info(f"[THREAD_STATE] thread={thread_id} msg={msg_id} already analyzed, reusing result")
+        llm_metrics.incr("thread_state_reused")
+        return dict(state["last_result"])
+
+    engine = config.THREAD_ANALYSIS_ENGINE
+    facts = turn_facts(newest_text)
+
+    if state is None:
+        # First message seen of this thread: seed from the quoted history, analyze once in full
+        state = new_thread_state(thread_id, subject)
+        seed_from_history(state, turns[1:])
+        if engine == "rules":
+            result = _rules_update(state, facts, baseline_date)
+        else:
+            result = analyze_meeting_schedule(body, baseline_date)
+            result["proposed_times"] = [] if result.get("meeting_time") else facts["times"]
+            result["accepted_times"] = [result["meeting_time"]] if result.get("meeting_time") else []
+        mode = "full"
+    else:
+        if engine == "rules":
+            result = _rules_update(state, facts, baseline_date)
+            llm_metrics.incr("rules_engine_calls")
+        else:
+            result = analyze_meeting_update(state_summary(state), newest_text, sender, baseline_date)
+        mode = "incremental"
+
+    if result.get("status") == "error":
+        # Leave the state untouched so the retry analyzes this message again
+        return result
+
+    apply_message(state, msg_id, sender, result.get("proposed_times") or [],
+                  result.get("accepted_times") or [], extract_emails(newest_text))
+    state["last_result"] = {k: v for k, v in result.items() if k not in ("proposed_times", "accepted_times")}
+    save_thread_state(state)
+    logger.info(f"[THREAD_STATE] thread={thread_id} msg={msg_id} mode={mode} engine={engine} "
+                f"candidates={len(state['candidates'])} meeting_time={result.get('meeting_time') or '-'}")
+    return result
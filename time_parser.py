@@ -1,78 +1,173 @@
+import os
 import re
-import pytz
-import dateparser
-from datetime import datetime, timedelta
-from dateutil import tz as dateutil_tz
+import threading
+from datetime import date, datetime, time as dt_time, timedelta
+from functools import lru_cache
 from email.utils import parsedate_tz
+from lazy_imports import lazy_module
 from logger_config import logger   
 
+# dateparser loads its language data on import; only pay for it when the fast path misses
+dateparser = lazy_module("dateparser")
+pytz = lazy_module("pytz")
 
+DEFAULT_TZ = os.getenv("DEFAULT_TZ", "Asia/Shanghai")
+PARSER_LANGUAGES = ["en", "zh"]
 
-def normalize_time_text(raw: str) -> str:
+
+
+# -------------------------
+# Fast path: the exact forms the LLM prompt asks for, without dateparser
+# -------------------------
+_CLOCK = r"(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([ap])?\.?(?:m\.?)?"
+_DATE_TIME_RE = re.compile(rf"^(\d{{4}})\s*[-/.]\s*(\d{{1,2}})\s*[-/.]\s*(\d{{1,2}})(?:(?:\s+|T){_CLOCK})?$", re.I)
+_TIME_DATE_RE = re.compile(rf"^{_CLOCK}\s+(\d{{4}})\s*[-/.]\s*(\d{{1,2}})\s*[-/.]\s*(\d{{1,2}})$", re.I)
+_CJK_RE = re.compile(
+    r"^(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*[日号]"
+    r"(?:\s*(上午|早上|中午|下午|晚上)?\s*(\d{1,2})\s*(?:[:：]\s*(\d{2})|点\s*(?:(\d{1,2})\s*分|(半))?))?$"
+)
+
+_fast_path_lock = threading.Lock()
+_fast_path_stats = {"hits": 0, "misses": 0}
+
+
+def _count(key: str) -> None:
+    with _fast_path_lock:
+        _fast_path_stats[key] += 1
+
+
+def _build(y, mo, d, h=None, mi=None, sec=None, ampm=None) -> datetime | None:
+    hour, minute = int(h or 0), int(mi or 0)
+    ampm = (ampm or "").lower()
+    if ampm == "p" and hour < 12:        # '20:00 PM' keeps 20:00
+        hour += 12
+    elif ampm == "a" and hour == 12:
+        hour = 0
+    try:
+        return datetime(int(y), int(mo), int(d), hour, minute, int(sec or 0))
+    except ValueError:
+        return None
+
+
+def fast_parse_datetime(text: str) -> datetime | None:
     """
-Normalize common human expressions to improve parsability.
-    e.g. '5PM, NEXT Tuesday' -> 'next tuesday 5 pm'
+    Naive datetime for the unambiguous absolute forms, or None:
+      '2025-11-07 14:00', '2025/11/7 2:00 PM', '2025-11-07T14:00:00',
+      '10:00 AM 2025/11/5', '2025年11月4日', '2025年11月4日下午3点半'.
+    A date without a time is midnight (as dateparser returns it).
+    Hits and misses are counted (fast_path_stats).
     """
-    if not raw:
-        return raw
-    text = raw.strip()
+    s = (text or "").strip()
+    dt = None
+    m = _DATE_TIME_RE.match(s)
+    if m:
+        dt = _build(*m.groups())
+    elif (m := _TIME_DATE_RE.match(s)):
+        h, mi, sec, ampm, y, mo, d = m.groups()
+        dt = _build(y, mo, d, h, mi, sec, ampm)
+    elif (m := _CJK_RE.match(s)):
+        y, mo, d, period, h, colon_min, cjk_min, half = m.groups()
+        hour = int(h or 0)
+        if period in ("下午", "晚上") and hour < 12:
+            hour += 12
+        elif period == "中午" and hour < 11:
+            hour += 12
+        minute = colon_min or cjk_min or (30 if half else 0)
+        dt = _build(y, mo, d, hour, minute)
 
-    # Strip redundant punctuation and normalize whitespaces.
-    text = re.sub(r"[,\u3001]+", " ", text)      # Remove commas and ideographic commas.
-    text = re.sub(r"\s+", " ", text)
+    _count("hits" if dt else "misses")
+    return dt
 
-    # Normalize text to lowercase for better compatibility with dateparser.
-    text = text.lower()
 
-    # Common notation conversion:tues. -> tuesday, sth -> ...
-    repl = {
-        "mon.": "monday", "tues.": "tuesday", "wed.": "wednesday",
-        "thur.": "thursday", "fri.": "friday", "sat.": "saturday", "sun.": "sunday",
-        "next tues": "next tuesday",
-        "pm.": "pm", "am.": "am",
-        "@": " at ",                          # User-friendly 'next tue @ 5pm'
-    }
-    for k, v in repl.items():
-        text = text.replace(k, v)
+def fast_path_stats() -> dict:
+    with _fast_path_lock:
+        stats = dict(_fast_path_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+    return stats
+
+
+_SEPARATOR_RE = re.compile(r"[,\u3001]+")
+_SPACES_RE = re.compile(r"\s+")
+_WEEKDAY_ABBR = {"mon": "monday", "tues": "tuesday", "wed": "wednesday", "thur": "thursday",
+                 "fri": "friday", "sat": "saturday", "sun": "sunday"}
+# One pass instead of a chain of str.replace: 'tues.' -> 'tuesday', 'next tues' -> 'next tuesday', 'pm.' -> 'pm', '@' -> ' at '
+_ABBREV_RE = re.compile(r"\b(mon|tues|wed|thur|fri|sat|sun)\.|\b(next tues)\b|([ap]m)\.|@")
+
 
-    
-    # If only a time is provided without a date, proceed to the next handling step. dateparser + 'PREFER_DATES_FROM=future'
-    return text
+def _expand_abbrev(m) -> str:
+    if m.group(1):
+        return _WEEKDAY_ABBR[m.group(1)]
+    if m.group(2):
+        return "next tuesday"
+    if m.group(3):
+        return m.group(3)
+    return " at "                          # User-friendly 'next tue @ 5pm'
 
-def parse_human_time(human_text: str, base_dt: datetime | None = None) -> datetime | None:
+
+def normalize_time_text(raw: str) -> str:
     """
-    Attempt multi-round parsing of natural language time expressions.
-        1) dateparser first try
-        2) Retry after secondary normalization.
-        3) Map a standalone time expression to its closest future occurrence relative to now (e.g., if 5 PM today has passed, schedule for 5 PM tomorrow).
-        Returns: a timezone-aware datetime object or None.
+Normalize common human expressions to improve parsability.
+    e.g. '5PM, NEXT Tuesday' -> 'next tuesday 5 pm'
     """
-    if not human_text:
-        return None
+    if not raw:
+        return raw
+    # Strip redundant punctuation (commas, ideographic commas), normalize whitespace, lowercase for dateparser.
+    text = _SPACES_RE.sub(" ", _SEPARATOR_RE.sub(" ", raw.strip())).lower()
+    # Common notation conversion:tues. -> tuesday, sth -> ...
+    return _ABBREV_RE.sub(_expand_abbrev, text)
 
-    if base_dt is None:
-        # Use the current time in the local timezone as the relative reference.
-        tz = pytz.timezone(DEFAULT_TZ)
-        base_dt = datetime.now(tz)
+# An explicit day ("tomorrow", "fri", "nov 12", "11/12", "明天", "周五") and nothing finer than
+# a day relative to the base ("in 2 hours", "now"): dateparser's answer depends on the base date only
+_DAY_ANCHOR_RE = re.compile(
+    r"\b(?:today|tomorrow|(?:mon|tue|tues|wed|thu|thur|thurs|fri|sat|sun)(?:day)?"
+    r"|monday|tuesday|wednesday|thursday|friday|saturday|sunday"
+    r"|jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?"
+    r"|sept?(?:ember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b"
+    r"|\d{4}\s*[-/.年]\s*\d{1,2}|\b\d{1,2}/\d{1,2}\b|\d{1,2}\s*月\s*\d{1,2}|今天|明天|后天|[周星礼拜期]+[一二三四五六日天]|\d{1,2}\s*[日号]"
+)
+_SUB_DAY_RE = re.compile(r"\b(?:now|ago|later|hours?|hrs?|minutes?|mins?|in \d+)\b|现在|小时|分钟|刚才")
 
-    text1 = normalize_time_text(human_text)
+_dateparser_lock = threading.Lock()
 
+
+def _dateparse(text: str, base_dt: datetime, tz_name: str) -> datetime | None:
     settings = {
         "PREFER_DATES_FROM": "future",
-        "TIMEZONE": DEFAULT_TZ,
+        "TIMEZONE": tz_name,
         "RETURN_AS_TIMEZONE_AWARE": True,
         "RELATIVE_BASE": base_dt,
-         }
+    }
+    # dateparser hands equal settings the same shared Settings object and changes it while parsing
+    with _dateparser_lock:
+        return dateparser.parse(text, languages=PARSER_LANGUAGES, settings=settings)
 
-    # First parse
-    dt = dateparser.parse(text1, settings=settings, languages=["en", "zh"])
+
+def _dateparse_passes(text1: str, base_dt: datetime, tz_name: str) -> datetime | None:
+    """First dateparser pass, then a second one after renormalizing am/pm."""
+    dt = _dateparse(text1, base_dt, tz_name)
     if dt:
         return dt
-
-    # Second pass: apply normalization (e.g., forcibly insert "at").
     text2 = re.sub(r"\b(\d{1,2})(am|pm)\b", r"\1 \2", text1)  # '5pm' -> '5 pm'
     text2 = re.sub(r"\b(\d{1,2}):(\d{2})(am|pm)\b", r"\1:\2 \3", text2)
-    dt = dateparser.parse(text2, settings=settings, languages=["en", "zh"])
+    if text2 != text1:
+        return _dateparse(text2, base_dt, tz_name)
+    return None
+
+
+@lru_cache(maxsize=2048)
+def _dateparse_day(text1: str, day: date, tz_name: str) -> datetime | None:
+    """_dateparse_passes for a day-anchored text, relative to the start of `day` (memoized)."""
+    base_dt = pytz.timezone(tz_name).localize(datetime.combine(day, dt_time()))
+    return _dateparse_passes(text1, base_dt, tz_name)
+
+
+def _parse_normalized(text1: str, base_dt: datetime, tz_name: str) -> datetime | None:
+    """The three parsing passes for an already normalized text."""
+    if _DAY_ANCHOR_RE.search(text1) and not _SUB_DAY_RE.search(text1):
+        dt = _dateparse_day(text1, base_dt.astimezone(pytz.timezone(tz_name)).date(), tz_name)
+    else:
+        dt = _dateparse_passes(text1, base_dt, tz_name)
     if dt:
         return dt
 
@@ -95,6 +190,46 @@ def parse_human_time(human_text: str, base_dt: datetime | None = None) -> dateti
 
     return None
 
+
+def parse_human_time(human_text: str, base_dt: datetime | float | None = None,
+                     tz_name: str | None = None) -> datetime | None:
+    """
+    Attempt multi-round parsing of natural language time expressions.
+        0) Regex fast path for absolute forms ('2025-11-07 14:00', '2025年11月4日 ...')
+        1) dateparser first try
+        2) Retry after secondary normalization.
+        3) Map a standalone time expression to its closest future occurrence relative to now (e.g., if 5 PM today has passed, schedule for 5 PM tomorrow).
+        `base_dt` may be a datetime (naive = in tz_name) or an epoch timestamp; default now.
+        Texts naming a day ("tomorrow 3pm", "fri 4pm") are cached on (normalized text,
+        base date, timezone); relative phrases ("in 2 hours", "5pm") are parsed per call.
+        Returns: a timezone-aware datetime object or None.
+    """
+    if not human_text:
+        return None
+
+    tz_name = tz_name or DEFAULT_TZ
+    tz = pytz.timezone(tz_name)
+
+    fast = fast_parse_datetime(human_text)
+    if fast:
+        return tz.localize(fast)
+
+    if base_dt is None:
+        # Use the current time in the local timezone as the relative reference.
+        base_dt = datetime.now(tz)
+    elif isinstance(base_dt, (int, float)):
+        base_dt = datetime.fromtimestamp(base_dt, tz)
+    elif base_dt.tzinfo is None:
+        base_dt = tz.localize(base_dt)
+
+    return _parse_normalized(normalize_time_text(human_text), base_dt, tz_name)
+
+
+def parse_cache_info() -> dict:
+    """Hit/miss counters of the parse cache (for logs and benchmarks)."""
+    info = _dateparse_day.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
 def get_sender_timezone(headers: dict,default_tz):
     """
     Extract the sender's timezone from the email headers. If parsing fails, fall back to the default timezone.
@@ -0,0 +1,144 @@
+"""
+Token budgeting for LLM prompts.
+
+- estimate_tokens(): cheap token estimate (no tokenizer dependency)
+- trim_thread(): keep an email thread within an input token budget
+- max_tokens_for_schema(): size max_tokens from the expected JSON output
+"""
+import re
+from typing import Dict, List, Tuple
+
+from logger_config import logger
+
+
+# CJK characters are roughly one token each; other text is ~4 characters per token.
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+# Header lines that start a quoted (older) message inside a thread body
+_TURN_HEADER_RE = re.compile(
+    r"^(?:"
+    r"On .{5,200}wrote:\s*$"                       # Gmail: On Mon, Nov 3, 2025 at 10:00 AM X <x@y> wrote:
+    r"|.{0,200}于\s*\d{4}年\d{1,2}月\d{1,2}日.{0,100}写道[:：]\s*$"   # Gmail (zh)
+    r"|-{2,}\s*(?:Original Message|原始邮件)\s*-{2,}\s*$"
+    r"|From:\s.+$"                                 # Outlook style quoted header
+    r")",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# Turns that mention a date or time are always kept (they carry the proposals)
+_TIME_EXPR_RE = re.compile(
+    r"\d{4}\s*[-/.年]\s*\d{1,2}"
+    r"|\d{1,2}\s*[:：]\s*\d{2}"
+    r"|\b\d{1,2}\s*(?:am|pm)\b"
+    r"|\b(?:mon|tue|tues|wed|thu|thur|thurs|fri|sat|sun)\b"
+    r"|\b(?:monday|tuesday|wednesday|thursday|friday|saturday|sunday)s?\b"
+    r"|\b(?:today|tomorrow|tonight|next week|noon)\b"
+    r"|上午|下午|晚上|明天|后天|周[一二三四五六日天]|星期[一二三四五六日天]|\d{1,2}\s*[点號号日]",
+    re.IGNORECASE,
+)
+
+_OMITTED = "[... {n} earlier message(s) omitted ...]"
+_TRUNCATED = "\n...[truncated]"
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def cut_to_tokens(text: str, budget_tokens: int) -> str:
+    """Longest prefix of text within budget_tokens (bisect on length; the estimate grows with it)."""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def split_turns(body: str) -> List[str]:
+    """Split a thread body into turns, newest first (the body starts with the latest message)."""
+    if not body:
+        return []
+    starts = [m.start() for m in _TURN_HEADER_RE.finditer(body)]
+    bounds = [0] + [s for s in starts if s > 0] + [len(body)]
+    turns = [body[a:b].strip("\n") for a, b in zip(bounds, bounds[1:])]
+    return [t for t in turns if t.strip()]
+
+
+def split_turn_header(turn: str) -> Tuple[str, str]:
+    """(quote header line, message text) of one turn; header is "" for the newest message."""
+    turn = turn or ""
+    m = _TURN_HEADER_RE.match(turn)
+    if not m:
+        return "", turn
+    return m.group(0), turn[m.end():]
+
+
+def has_time_expression(turn: str) -> bool:
+    """Time expression in the turn's text (the quote header's own send date does not count)."""
+    return bool(_TIME_EXPR_RE.search(split_turn_header(turn)[1]))
+
+
+def trim_thread(body: str, budget_tokens: int, keep_newest: int = 2) -> str:
+    """
+    Trim a thread to `budget_tokens`:
+      1) the newest `keep_newest` turns are always kept
+      2) every turn with a time expression is kept, newest first, while it fits
+      3) remaining turns fill what is left of the budget, newest first
+    Order of the kept turns is preserved. The newest turn is cut as a last resort.
+    A budget <= 0 (the prompt alone used it up) keeps the newest turn only, uncut.
+    """
+    if budget_tokens > 0 and estimate_tokens(body) <= budget_tokens:
+        return body
+    if budget_tokens <= 0:
+        keep_newest = 1
+
+    turns = split_turns(body)
+    costs = [estimate_tokens(t) for t in turns]
+    keep = set(range(min(keep_newest, len(turns))))
+    used = sum(costs[i] for i in keep)
+
+    for want_time in (True, False):
+        for i, turn in enumerate(turns):
+            if i in keep or has_time_expression(turn) != want_time:
+                continue
+            if used + costs[i] <= budget_tokens:
+                keep.add(i)
+                used += costs[i]
+
+    out = []
+    omitted = 0
+    for i, turn in enumerate(turns):
+        if i in keep:
+            if omitted:
+                out.append(_OMITTED.format(n=omitted))
+                omitted = 0
+            out.append(turn)
+        else:
+            omitted += 1
+    if omitted:
+        out.append(_OMITTED.format(n=omitted))
+
+    trimmed = "\n\n".join(out)
+    if budget_tokens > 0 and estimate_tokens(trimmed) > budget_tokens:
+        # Kept turns alone are too large: hard cut by the same estimate (CJK ~1 char/token)
+        trimmed = cut_to_tokens(trimmed, max(budget_tokens - estimate_tokens(_TRUNCATED), 0)) + _TRUNCATED
+
+    logger.info(f"[TOKEN_BUDGET] thread trimmed: turns {len(turns)} -> {len(keep)}, "
+                f"tokens ~{estimate_tokens(body)} -> ~{estimate_tokens(trimmed)} (budget {budget_tokens})")
+    return trimmed
+
+
+def max_tokens_for_schema(field_tokens: Dict[str, int], headroom: int = 0, margin: float = 1.5) -> int:
+    """
+    max_tokens sized from the output schema: expected tokens per field value
+    plus key/punctuation overhead, times a safety margin, plus headroom
+    (e.g. for models that spend output tokens on thinking).
+    """
+    body = sum(v + estimate_tokens(k) + 4 for k, v in field_tokens.items()) + 4
+    return int(body * margin) + headroom